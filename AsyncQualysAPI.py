@@ -0,0 +1,301 @@
+import asyncio
+import json
+import aiohttp
+import xml.etree.ElementTree as ET
+from time import monotonic, time
+import sys
+from QualysAPI import RateLimitScheduler, isIdempotent
+from api_metrics import ApiMetrics, CallRecord, endpoint_name
+
+# Connection timeouts are reported separately from read timeouts from aiohttp 3.10
+CONNECT_TIMEOUT_ERRORS = getattr(aiohttp, 'ConnectionTimeoutError', ())
+
+
+class AsyncRateLimitScheduler(RateLimitScheduler):
+    """A RateLimitScheduler for coroutines running on a single asyncio event loop.  Waiting is done with
+    acquireAsync(), which suspends the coroutine instead of blocking the loop
+
+    Class Methods
+    =============
+
+    acquireAsync()
+
+        Wait (without blocking the event loop) until a call can be made without exceeding the known limits, then take a
+        lease for it.  Returns the number of seconds spent waiting
+    """
+
+    def __init__(self, maxRetries=20, baseBackoff=2.0, maxBackoff=60.0, maxConcurrency=0):
+        super().__init__(maxRetries=maxRetries, baseBackoff=baseBackoff, maxBackoff=maxBackoff,
+                         maxConcurrency=maxConcurrency)
+        # Created on first use so that it belongs to the running event loop
+        self.changed = None
+
+    async def acquireAsync(self):
+        if self.changed is None:
+            self.changed = asyncio.Event()
+        waited = 0.0
+        while True:
+            # Clear before checking so a release between the check and the wait is not missed
+            self.changed.clear()
+            with self.cond:
+                delay = self._admitDelay()
+            if delay == 0:
+                break
+            start = monotonic()
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout=1.0 if delay is None else min(delay, 1.0))
+            except asyncio.TimeoutError:
+                pass
+            waited += monotonic() - start
+        with self.cond:
+            self.waitTime += waited
+        return waited
+
+    def release(self, headers=None, statusCode=None):
+        throttled = super().release(headers=headers, statusCode=statusCode)
+        if self.changed is not None:
+            self.changed.set()
+        return throttled
+
+    def pause(self, seconds):
+        super().pause(seconds)
+        if self.changed is not None:
+            self.changed.set()
+
+
+class AsyncQualysAPI:
+    """Asyncio equivalent of QualysAPI, for use from code which is already running an event loop.  Connections are
+    pooled and kept alive by an aiohttp.ClientSession, and calls are paced by the same rate and concurrency limit
+    handling as QualysAPI
+
+    Class Members
+    =============
+
+    server          : String  : The FQDN of the API server (with https:// prefix)
+    user            : String  : The username of an API user in the subscription
+    password        : String  : The password of the API user
+    proxy           : String  : The FQDN of the proxy server to be used for connections (with https:// prefix)
+    debug           : Boolean : If True, will output debug information to the console during member function execution
+    enableProxy     : Boolean : If True will force connections via the proxy defined in the 'proxy' class member
+    callCount       : Integer : The number of API calls made during the life of the API object
+    connectionLimit : Integer : The maximum number of pooled connections to the API server
+    scheduler       : AsyncRateLimitScheduler : Paces every call made through this object to fit the subscription's
+                                                rate and concurrency limits
+    metrics         : ApiMetrics : Per-endpoint measurements of the calls made through this object, as for QualysAPI
+    connectTimeout  : Float   : Seconds to wait for a connection to the API server
+    readTimeout     : Float   : Seconds to wait for the API server to send data before the call is abandoned
+
+    Class Methods
+    =============
+
+    __init__(svr, usr, passwd, proxy, enableProxy, debug, scheduler, connectionLimit, metrics, connectTimeout,
+             readTimeout, compress)
+
+        Called when an object of type AsyncQualysAPI is created, arguments are as for QualysAPI with the addition of
+
+            connectionLimit : Integer : The maximum number of pooled connections to the API server
+                                        Default value = 100
+
+    make_call(url, payload, headers, method, returnwith, idempotent)
+
+        Coroutine which makes a Qualys API call and returns the response in the format given by 'returnwith' ('xml',
+        'json', 'text' or 'bytes'), as QualysAPI.makeCall does.  Calls which time out waiting for a response are only
+        retried if 'idempotent' (worked out from the method and URL if None, as for QualysAPI.makeCall).  Returns None
+        if the call could not be made
+
+    close()
+
+        Coroutine which closes the pooled connections.  The object can also be used as an async context manager,
+        which closes the connections on exit
+
+        Example :
+            async with AsyncQualysAPI(svr='https://qualysapi.qualys.com', usr='username', passwd='password') as api:
+                response = await api.make_call(url='%s/full/path/to/api/call' % api.server, payload='')
+    """
+
+    server: str
+    user: str
+    password: str
+    proxy: str
+    debug: bool
+    enableProxy: bool
+    callCount: int
+    connectionLimit: int
+    scheduler: AsyncRateLimitScheduler
+    metrics: ApiMetrics
+    connectTimeout: float
+    readTimeout: float
+
+    def __init__(self, svr="", usr="", passwd="", proxy="", enableProxy=False, debug=False, scheduler=None,
+                 connectionLimit=100, metrics=None, connectTimeout=10, readTimeout=300, compress=True):
+        self.server = svr
+        self.user = usr
+        self.password = passwd
+        self.proxy = proxy
+        self.enableProxy = enableProxy
+        self.debug = debug
+        self.callCount = 0
+        self.connectionLimit = connectionLimit
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.compress = compress
+        if scheduler is None:
+            self.scheduler = AsyncRateLimitScheduler()
+        else:
+            self.scheduler = scheduler
+        if metrics is None:
+            self.metrics = ApiMetrics()
+        else:
+            self.metrics = metrics
+        # The session must be created inside the running event loop, so it is created on first use
+        self.sess = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def __session(self):
+        if self.sess is None:
+            connector = aiohttp.TCPConnector(limit=self.connectionLimit, keepalive_timeout=60)
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.connectTimeout, sock_read=self.readTimeout)
+            self.sess = aiohttp.ClientSession(auth=aiohttp.BasicAuth(self.user, self.password),
+                                              headers={'X-Requested-With': 'python3/aiohttp',
+                                                       'Accept-Encoding': 'gzip, deflate' if self.compress
+                                                       else 'identity'},
+                                              connector=connector, timeout=timeout)
+        return self.sess
+
+    async def close(self):
+        if self.sess is not None:
+            await self.sess.close()
+            self.sess = None
+
+    async def make_call(self, url, payload="", headers=None, method='POST', returnwith='xml', idempotent=None):
+        sess = self.__session()
+        if idempotent is None:
+            idempotent = isIdempotent(method, url)
+        if self.debug:
+            print("AsyncQualysAPI.make_call: RequestURL")
+            print(url)
+            print("AsyncQualysAPI.make_call: RequestBody")
+            print(payload)
+        if self.enableProxy:
+            proxy = self.proxy
+        else:
+            proxy = None
+
+        # Measurements of the call for self.metrics, covering every attempt
+        endpoint = endpoint_name(url)
+        started = time()
+        networkTime = 0.0
+        limitWait = 0.0
+        retrySleep = 0.0
+        if isinstance(payload, (str, bytes)):
+            bytesOut = len(payload)
+        else:
+            bytesOut = 0
+        status = None
+
+        retryCount = 0
+        while True:
+            body = None
+            throttled = None
+            limitWait += await self.scheduler.acquireAsync()
+            sendStart = monotonic()
+            try:
+                async with sess.request(method, url, data=payload, headers=headers, proxy=proxy) as resp:
+                    body = await resp.read()
+                    respheaders = resp.headers
+                    status = resp.status
+            except aiohttp.ServerTimeoutError as e:
+                if not idempotent and not isinstance(e, CONNECT_TIMEOUT_ERRORS):
+                    # The call may have been carried out, so making it again could (for example) create a user twice
+                    print('API Error: No response within %s seconds, returning \'None\' to caller' % self.readTimeout)
+                    self.metrics.record(CallRecord(endpoint, method, None, started,
+                                                   networkTime + monotonic() - sendStart, bytesOut, 0, retryCount,
+                                                   limitWait, retrySleep, False))
+                    return None
+                print('API Error: No response within %s seconds, retrying' % self.readTimeout)
+            except aiohttp.ClientConnectionError as e:
+                if not idempotent and not isinstance(e, aiohttp.ClientConnectorError):
+                    # Only a connection which could not be made shows the request was never sent, otherwise (such as
+                    # ServerDisconnectedError) the call may have been carried out
+                    print('API Error: Connection lost after the request was sent, returning \'None\' to caller')
+                    self.metrics.record(CallRecord(endpoint, method, None, started,
+                                                   networkTime + monotonic() - sendStart, bytesOut, 0, retryCount,
+                                                   limitWait, retrySleep, False))
+                    return None
+                print('API Error: Connection Error, retrying connection')
+            except UnicodeEncodeError:  # Problem encoding request data
+                print('API Error: UnicodeEncodeError exception caught, returning \'None\' to caller')
+                self.metrics.record(CallRecord(endpoint, method, None, started, networkTime, bytesOut, 0, retryCount,
+                                               limitWait, retrySleep, False))
+                return None
+            except asyncio.CancelledError:
+                raise
+            except:  # Unhandled exception
+                print('API Error: Unhandled Exception :', sys.exc_info()[0])
+                print('Returning \'None\' to the caller')
+                self.metrics.record(CallRecord(endpoint, method, None, started, networkTime, bytesOut, 0, retryCount,
+                                               limitWait, retrySleep, False))
+                return None
+            finally:
+                networkTime += monotonic() - sendStart
+                # Return the lease, learning the current limits from the response headers
+                if body is None:
+                    self.scheduler.release()
+                else:
+                    throttled = self.scheduler.release(headers=respheaders, statusCode=status)
+
+            if self.debug and body is not None:
+                print("AsyncQualysAPI.make_call: Response Headers...")
+                print("%s" % str(respheaders))
+                print("AsyncQualysAPI.make_call: Response text...")
+                print("%s" % body.decode('utf-8', errors='replace'))
+
+            if body is not None and throttled is None:
+                break
+
+            retryCount = retryCount + 1
+            if retryCount > self.scheduler.maxRetries:
+                print("AsyncQualysAPI.make_call: Retry count > %s, returning 'None' to the caller" %
+                      self.scheduler.maxRetries)
+                self.metrics.record(CallRecord(endpoint, method, None if body is None else status, started,
+                                               networkTime, bytesOut, 0, retryCount - 1, limitWait, retrySleep,
+                                               False))
+                return None
+
+            if throttled == 'rate':
+                suggested = int(respheaders['X-RateLimit-ToWait-Sec'])
+                print("AsyncQualysAPI.make_call: Rate limit reached, suggested wait time: %s seconds" % suggested)
+                waittime = self.scheduler.backoff(retryCount, suggested)
+            else:
+                if throttled == 'concurrency':
+                    print("AsyncQualysAPI.make_call: Concurrency limit hit.  %s/%s running calls" %
+                          (self.scheduler.concurrencyRunning, self.scheduler.concurrencyLimit))
+                waittime = self.scheduler.backoff(retryCount)
+            print("AsyncQualysAPI.make_call: Waiting %.1f seconds, then retrying (retryCount = %s)" %
+                  (waittime, retryCount))
+
+            if throttled is not None:
+                # Hold back every coroutine, not just this one, the scheduler will release them when the wait is over
+                self.scheduler.pause(waittime)
+            else:
+                await asyncio.sleep(waittime)
+                retrySleep += waittime
+
+        # Increment the API call count (failed calls are not included in the count)
+        self.callCount = self.callCount + 1
+        self.metrics.record(CallRecord(endpoint, method, status, started, networkTime, bytesOut, len(body), retryCount,
+                                       limitWait, retrySleep, True))
+
+        if returnwith == 'xml':
+            return ET.fromstring(body)
+        if returnwith == 'json':
+            return json.loads(body)
+        if returnwith == 'text':
+            return body.decode('utf-8')
+        if returnwith == 'bytes':
+            return body
@@ -1,8 +1,391 @@
 import json
+import os
+import random
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ConnectTimeoutError
 import xml.etree.ElementTree as ET
-from time import sleep
+from time import sleep, monotonic, time
 import sys
+import threading
+from api_metrics import ApiMetrics, CallRecord, endpoint_name
+from api_cache import is_cacheable
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, where limits cannot be shared between processes
+    fcntl = None
+
+# HTTP methods which can safely be sent again if the response is lost
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+
+def isIdempotent(method, url):
+    # Searches and counts only read data, so they can be repeated even though they are POSTed
+    return method.upper() in IDEMPOTENT_METHODS or '/search/' in url or '/count/' in url
+
+
+def requestNotSent(error):
+    # True if a requests ConnectionError shows the connection was never made, so the server cannot have seen the
+    #   request.  Anything else (such as the server dropping the connection after reading the request) may have been
+    #   carried out
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if len(error.args) > 0 else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def iterElements(chunks, tags):
+    # Incrementally parse an XML document from an iterable of byte strings, yielding each element whose tag is in
+    #   'tags' (and which is not inside another such element) as soon as it is complete.  Each element is cleared when
+    #   the caller asks for the next one, so memory use depends on the size of one element rather than the document
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    depth = 0
+
+    def events():
+        nonlocal depth
+        for event, elem in parser.read_events():
+            if elem.tag not in tags:
+                continue
+            if event == 'start':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    yield elem
+                    elem.clear()
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from events()
+    parser.close()
+    yield from events()
+
+
+def elementToDict(elem):
+    # Convert an element into the structure the JSON form of the API would have returned.  Elements without children
+    #   become their text, repeated child tags become lists
+    children = list(elem)
+    if len(children) == 0:
+        return elem.text
+    result = {}
+    for child in children:
+        value = elementToDict(child)
+        if child.tag not in result:
+            result[child.tag] = value
+        elif isinstance(result[child.tag], list):
+            result[child.tag].append(value)
+        else:
+            result[child.tag] = [result[child.tag], value]
+    return result
+
+
+# The limits learned from the API, shared by RateLimitScheduler (which keeps them as attributes, passing vars(self)) and
+#   SharedRateLimitScheduler (which keeps them in the lease file).  Missing keys mean nothing has been learned yet
+def limitHeadroom(state):
+    if not state.get('learned'):
+        return 1
+    if not state.get('concurrencyLimit'):
+        return None
+    return max(1, state['concurrencyLimit'] - state.get('externalRunning', 0))
+
+
+def admitDelay(state, inFlight, maxConcurrency, baseBackoff, now):
+    # Returns 0 (having counted a call against the tokens) if a call can be made now, otherwise the number of seconds
+    #   to wait before trying again, or None to wait until another call finishes.  The caller takes the lease
+    if state.get('blockedUntil', 0) > now:
+        return state['blockedUntil'] - now
+
+    width = limitHeadroom(state)
+    if maxConcurrency > 0:
+        width = maxConcurrency if width is None else min(width, maxConcurrency)
+    if width is not None and inFlight >= width:
+        return None
+
+    tokens = state.get('tokens')
+    if tokens is not None and tokens <= 0:
+        # The calls left in the window are used up.  Wait for outstanding calls to report fresh counters, then
+        #   let calls through one at a time at the average rate the window allows
+        if inFlight > 0:
+            return None
+        if state.get('rateLimit') and state.get('rateWindow'):
+            interval = state['rateWindow'] / state['rateLimit']
+        else:
+            interval = baseBackoff
+        state['blockedUntil'] = now + interval
+        state['tokens'] = 1
+        return interval
+
+    if tokens is not None:
+        state['tokens'] = tokens - 1
+    return 0
+
+
+def observeLimits(state, headers, statusCode, inFlight, now):
+    # Learn the limits from a response's headers, 'inFlight' being the calls still in flight after the one which
+    #   returned them.  Returns None if the call was not throttled, otherwise 'rate' or 'concurrency'
+    state['learned'] = True
+    throttled = None
+    if 'X-Concurrency-Limit-Limit' in headers.keys() and 'X-Concurrency-Limit-Running' in headers.keys():
+        state['concurrencyLimit'] = int(headers['X-Concurrency-Limit-Limit'])
+        state['concurrencyRunning'] = int(headers['X-Concurrency-Limit-Running'])
+        # The running count includes our own calls in flight (and the call which reported it), anything beyond
+        #   those belongs to other clients
+        state['externalRunning'] = max(0, state['concurrencyRunning'] - (inFlight + 1))
+        if state['concurrencyRunning'] > state['concurrencyLimit']:
+            throttled = 'concurrency'
+
+    if 'X-RateLimit-Limit' in headers.keys():
+        state['rateLimit'] = int(headers['X-RateLimit-Limit'])
+    if 'X-RateLimit-Window-Sec' in headers.keys():
+        state['rateWindow'] = int(headers['X-RateLimit-Window-Sec'])
+    if 'X-RateLimit-Remaining' in headers.keys():
+        # Calls still in flight will use up some of what remains
+        state['tokens'] = int(headers['X-RateLimit-Remaining']) - inFlight
+
+    if 'X-RateLimit-ToWait-Sec' in headers.keys() and int(headers['X-RateLimit-ToWait-Sec']) > 0:
+        state['blockedUntil'] = max(state.get('blockedUntil', 0), now + int(headers['X-RateLimit-ToWait-Sec']))
+        throttled = 'rate'
+    elif statusCode == 409 and throttled is None:
+        throttled = 'concurrency'
+    return throttled
+
+
+class RateLimitScheduler:
+    """Paces the API calls made by one or more threads so they stay within the subscription's rate and concurrency
+    limits, learning those limits from the response headers of every call
+
+    Class Members
+    =============
+
+    maxRetries      : Integer : The number of times a throttled or failed call is retried before giving up
+    baseBackoff     : Float   : The first retry delay in seconds, doubled on each subsequent retry
+    maxBackoff      : Float   : The maximum retry delay in seconds (before any X-RateLimit-ToWait-Sec is added)
+    maxConcurrency  : Integer : A local cap on the number of calls in flight, 0 for no cap other than the
+                                subscription's concurrency limit
+    concurrencyLimit: Integer : The concurrency limit reported by the last X-Concurrency-Limit-Limit response header
+                                (0 until a response carrying the header has been received)
+    concurrencyRunning : Integer : The running call count reported by the last X-Concurrency-Limit-Running header
+    inFlight        : Integer : The number of calls currently holding a lease
+    rateLimit       : Integer : The number of calls allowed per rate limit window (X-RateLimit-Limit)
+    rateWindow      : Integer : The length of the rate limit window in seconds (X-RateLimit-Window-Sec)
+    tokens          : Integer : The number of calls believed to be left in the current window, None if unknown
+    waitTime        : Float   : The total number of seconds callers have spent waiting for a lease
+
+    Class Methods
+    =============
+
+    acquire()
+
+        Block until a call can be made without exceeding the known limits, then take a lease for it.  Returns the
+        number of seconds spent waiting
+
+    release(headers, statusCode)
+
+        Return a lease, learning the limits from the response headers if there was a response.  Returns None if the
+        call was not throttled, otherwise 'rate' or 'concurrency' to indicate which limit rejected it
+
+    pause(seconds)
+
+        Hold back every caller for the given number of seconds
+
+    blockedFor()
+
+        Return the number of seconds callers are currently being held back for by a rate limit wait or pause, 0 if
+        they are not
+
+    backoff(attempt, suggested)
+
+        Return the delay before retry number 'attempt', exponential with jitter, capped at maxBackoff and never less
+        than the 'suggested' delay from the server
+    """
+
+    def __init__(self, maxRetries=20, baseBackoff=2.0, maxBackoff=60.0, maxConcurrency=0):
+        self.maxRetries = maxRetries
+        self.baseBackoff = baseBackoff
+        self.maxBackoff = maxBackoff
+        self.maxConcurrency = maxConcurrency
+        self.concurrencyLimit = 0
+        self.concurrencyRunning = 0
+        # Calls made by other clients of the subscription at the time of the last response, used to calculate headroom
+        self.externalRunning = 0
+        self.inFlight = 0
+        self.rateLimit = 0
+        self.rateWindow = 0
+        self.tokens = None
+        self.blockedUntil = 0.0
+        self.waitTime = 0.0
+        # Until the first response arrives the limits are unknown, so only one call is allowed in flight
+        self.learned = False
+        self.cond = threading.Condition()
+
+    def headroom(self):
+        with self.cond:
+            if not self.learned:
+                return None
+            return self._headroom()
+
+    def _headroom(self):
+        return limitHeadroom(vars(self))
+
+    def _admitDelay(self):
+        # Returns 0 (and takes a lease) if a call can be made now, otherwise the number of seconds to wait before
+        #   trying again, or None to wait until another call finishes
+        delay = admitDelay(vars(self), self.inFlight, self.maxConcurrency, self.baseBackoff, monotonic())
+        if delay == 0:
+            self.inFlight += 1
+        return delay
+
+    def acquire(self):
+        waited = 0.0
+        with self.cond:
+            while True:
+                delay = self._admitDelay()
+                if delay == 0:
+                    break
+                start = monotonic()
+                # Limits can change as responses arrive, so never wait for more than a second without re-checking
+                self.cond.wait(timeout=1.0 if delay is None else min(delay, 1.0))
+                waited += monotonic() - start
+            self.waitTime += waited
+        return waited
+
+    def release(self, headers=None, statusCode=None):
+        with self.cond:
+            self.inFlight -= 1
+            throttled = None
+            if headers is not None:
+                throttled = self._observe(headers, statusCode)
+            self.cond.notify_all()
+        return throttled
+
+    def _observe(self, headers, statusCode):
+        return observeLimits(vars(self), headers, statusCode, self.inFlight, monotonic())
+
+    def pause(self, seconds):
+        with self.cond:
+            self.blockedUntil = max(self.blockedUntil, monotonic() + seconds)
+            self.cond.notify_all()
+
+    def blockedFor(self):
+        with self.cond:
+            return max(0.0, self.blockedUntil - monotonic())
+
+    def backoff(self, attempt, suggested=0):
+        delay = min(self.maxBackoff, self.baseBackoff * (2 ** (attempt - 1)))
+        # Full jitter over the upper half of the delay stops parallel callers from retrying in lock-step
+        delay = random.uniform(delay / 2, delay)
+        if suggested > 0:
+            return suggested + random.uniform(0, self.baseBackoff)
+        return delay
+
+
+def processAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedRateLimitScheduler(RateLimitScheduler):
+    """A RateLimitScheduler which also shares the subscription's rate and concurrency limits with other processes,
+    through a lease file they all use.  Every call takes a lease in the file (as well as the usual lease within the
+    process), and the limits learned from each response are written back to the file, so the combined calls of all the
+    processes stay within the limits.  Leases held by processes which have exited are ignored
+
+    Class Members
+    =============
+
+    leaseFile       : String  : The lease file shared by the processes
+    pollInterval    : Float   : Seconds between checks of the lease file while waiting for a lease
+
+    Class Methods
+    =============
+
+    As RateLimitScheduler
+    """
+
+    leaseFile: str
+    pollInterval: float
+
+    def __init__(self, leaseFile, pollInterval=0.05, **kwargs):
+        if fcntl is None:
+            raise RuntimeError('Sharing rate limits between processes needs file locking, which is not available')
+        super().__init__(**kwargs)
+        self.leaseFile = leaseFile
+        self.pollInterval = pollInterval
+        self.pid = str(os.getpid())
+        self.fd = os.open(leaseFile, os.O_RDWR | os.O_CREAT, 0o600)
+        # Threads of this process take turns with the file, flock() only serializes processes
+        self.fileLock = threading.Lock()
+
+    def _shared(self, update):
+        # Call update(state) with the lease file locked and write the state back, returning update's result
+        with self.fileLock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                data = b''
+                while True:
+                    chunk = os.read(self.fd, 65536)
+                    if not chunk:
+                        break
+                    data += chunk
+                try:
+                    state = json.loads(data) if data else {}
+                except ValueError:
+                    state = {}
+                state['inFlight'] = {pid: n for pid, n in state.get('inFlight', {}).items()
+                                     if n > 0 and (pid == self.pid or processAlive(int(pid)))}
+                result = update(state)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.ftruncate(self.fd, 0)
+                os.write(self.fd, json.dumps(state).encode())
+                return result
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _sharedAdmit(self, state):
+        # The shared equivalent of _admitDelay(), returns True (having taken a lease) if a call can be made now.  The
+        #   file holds wall clock times, as monotonic() is not comparable between processes
+        delay = admitDelay(state, sum(state['inFlight'].values()), self.maxConcurrency, self.baseBackoff, time())
+        if delay != 0:
+            return False
+        state['inFlight'][self.pid] = state['inFlight'].get(self.pid, 0) + 1
+        return True
+
+    def acquire(self):
+        waited = super().acquire()
+        start = monotonic()
+        while not self._shared(self._sharedAdmit):
+            sleep(self.pollInterval)
+        sharedWait = monotonic() - start
+        with self.cond:
+            self.waitTime += sharedWait
+        return waited + sharedWait
+
+    def release(self, headers=None, statusCode=None):
+        def update(state):
+            state['inFlight'][self.pid] = max(0, state['inFlight'].get(self.pid, 0) - 1)
+            if headers is not None:
+                observeLimits(state, headers, statusCode, sum(state['inFlight'].values()), time())
+
+        self._shared(update)
+        return super().release(headers=headers, statusCode=statusCode)
+
+    def pause(self, seconds):
+        def update(state):
+            state['blockedUntil'] = max(state.get('blockedUntil', 0), time() + seconds)
+
+        self._shared(update)
+        super().pause(seconds)
+
 
 class QualysAPI:
     """Class to simplify the making and handling of API calls to the Qualys platform
@@ -17,11 +400,20 @@ class QualysAPI:
     debug           : Boolean : If True, will output debug information to the console during member function execution
     enableProxy     : Boolean : If True will force connections via the proxy defined in the 'proxy' class member
     callCount       : Integer : The number of API calls made during the life of the API object
+    scheduler       : RateLimitScheduler : Paces every call made through this object (from any thread) to fit the
+                                           subscription's rate and concurrency limits
+    metrics         : ApiMetrics : Per-endpoint latency, bytes, retries and limit waits of the calls made through this
+                                   object, with hooks for external tracers (see api_metrics.py)
+    connectTimeout  : Float   : Seconds to wait for a connection to the API server
+    readTimeout     : Float   : Seconds to wait for the API server to send data before the call is abandoned
+    cache           : ResponseCache : Where the responses to searches are cached, or None to make every call (see
+                                      api_cache.py)
 
     Class Methods
     =============
 
-    __init__(svr, usr, passwd, proxy, enableProxy, debug)
+    __init__(svr, usr, passwd, proxy, enableProxy, debug, scheduler, metrics, poolSize, connectTimeout, readTimeout,
+             compress, cache)
 
         Called when an object of type QualysAPI is created
 
@@ -45,15 +437,44 @@ class QualysAPI:
                                     execution
                                     Default value = False
 
+            scheduler   : RateLimitScheduler : The scheduler used to pace calls, which may be shared with other
+                                    QualysAPI objects using the same subscription
+                                    Default value = None (a new scheduler is created)
+
+            metrics     : ApiMetrics : Where the measurements of each call are recorded, which may be shared with
+                                    other API objects to report on them together
+                                    Default value = None (a new ApiMetrics is created)
+
+            poolSize    : Integer : The number of kept-alive connections to the API server, which should be at least
+                                    the number of threads making calls through this object
+                                    Default value = 10
+
+            connectTimeout : Float : Seconds to wait for a connection to the API server.  Connections which fail are
+                                    retried for every call
+                                    Default value = 10
+
+            readTimeout : Float   : Seconds to wait for the API server to send data.  Calls which time out are
+                                    retried if they are idempotent (see makeCall), otherwise None is returned
+                                    Default value = 300
+
+            compress    : Boolean : If True, ask for gzip or deflate compressed responses
+                                    Default value = True
+
+            cache       : ResponseCache : Cache for the responses to read-only searches, which may be shared with other
+                                    runs through its directory.  Writes invalidate the searches they affect
+                                    Default value = None (no caching)
+
     podPicker(pod)
 
         Convert a POD string to an API URL
 
             pod         : String  : The Qualys Pod code ('US01', 'US02', 'US03', 'EU01', 'EU02' or 'IN01')
 
-    makeCall(url, payload, headers, retryCount)
+    makeCall(url, payload, headers, retryCount, method, returnwith, streamtags, idempotent, useCache)
 
-        Make a Qualys API call and return the response in XML format as an ElementTree.Element object
+        Make a Qualys API call and return the response in XML format as an ElementTree.Element object.  Calls are
+        paced by the scheduler, and calls rejected by the rate or concurrency limits (or which fail to connect) are
+        retried with capped exponential backoff.  Returns None if the call could not be made
 
             url         : String  : The full URL of the API request, including any URL encoded parameters
                                     NO DEFAULT VALUE, REQUIRED PARAMETER
@@ -61,13 +482,46 @@ class QualysAPI:
             payload     : String  : The payload (body) of the API request
                                     Default value = ""
 
-            headers     : Dict    : HTTP Request headers to be sent in the API call
+            headers     : Dict    : HTTP Request headers to be sent in the API call, merged with the session's
+                                    default headers for this call only
                                     Default value = None
 
             retryCount  : Integer : The number of times this call has been attempted.  Used in rate and concurrency
                                     limit handling, not intended for use by users
                                     Default value = 0
 
+            method      : String  : The HTTP method of the request
+                                    Default value = 'POST'
+
+            returnwith  : String  : The format of the return value
+                                        'xml'       : An ElementTree.Element, parsed from the raw response bytes
+                                        'json'      : The decoded JSON, parsed from the raw response bytes
+                                        'text'      : The response decoded to a string
+                                        'bytes'     : The raw response bytes, for callers which only check the status
+                                        'xmlstream' : A generator of the elements with a tag in 'streamtags', parsed
+                                                      as the response is received and cleared once the caller moves on
+                                    Default value = 'xml'
+
+            streamtags  : List    : The element tags yielded when returnwith is 'xmlstream'.  The call's lease on the
+                                    scheduler is returned once the response headers have been received
+                                    Default value = None
+
+            idempotent  : Boolean : Whether the call can safely be repeated if its response is lost (read timeout).
+                                    Calls which create things must not be, or they could be made twice
+                                    Default value = None (True for GET, PUT, DELETE etc. and for /search/ and
+                                    /count/ calls, otherwise False)
+
+            useCache    : Boolean : Whether a search may be answered from (and stored in) the cache.  Calls which
+                                    poll for changes made by the platform itself, rather than through this object,
+                                    should not be
+                                    Default value = True
+
+    concurrencyHeadroom()
+
+        Return the number of additional calls that can be made in parallel without exceeding the subscription's
+        concurrency limit, based on the most recently received concurrency headers.  Returns None if no concurrency
+        headers have been received yet
+
         Example :
             api = QualysAPI(svr='https://qualysapi.qualys.com',
                             usr='username',
@@ -89,12 +543,17 @@ class QualysAPI:
     debug: bool
     enableProxy: bool
     callCount: int
+    scheduler: RateLimitScheduler
+    metrics: ApiMetrics
+    connectTimeout: float
+    readTimeout: float
 
     headers = {}
 
     sess: requests.Session
 
-    def __init__(self, svr="", usr="", passwd="", proxy="", enableProxy=False, debug=False):
+    def __init__(self, svr="", usr="", passwd="", proxy="", enableProxy=False, debug=False, scheduler=None,
+                 metrics=None, poolSize=10, connectTimeout=10, readTimeout=300, compress=True, cache=None):
         # Set all member variables from the values passed in when object is created
         self.server = svr
         self.user = usr
@@ -103,6 +562,19 @@ class QualysAPI:
         self.enableProxy = enableProxy
         self.debug = debug
         self.callCount = 0
+        if scheduler is None:
+            self.scheduler = RateLimitScheduler()
+        else:
+            self.scheduler = scheduler
+        if metrics is None:
+            self.metrics = ApiMetrics()
+        else:
+            self.metrics = metrics
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.cache = cache
+        # Lock protecting the call count, which is updated by every thread sharing this API object
+        self.lock = threading.Lock()
 
         # Create a session object with the requests library
         self.sess = requests.session()
@@ -110,6 +582,15 @@ class QualysAPI:
         self.sess.auth = (self.user, self.password)
         # Add a default X-Requested-With header (most API calls require it, it doesn't hurt to have it in all calls)
         self.sess.headers['X-Requested-With'] = 'python3/requests'
+        # Responses (particularly user searches) are much smaller compressed, requests decompresses them as they are read
+        self.sess.headers['Accept-Encoding'] = 'gzip, deflate' if compress else 'identity'
+        # Keep enough connections alive for every thread, and retry connections which cannot be made.  Lost responses
+        #   are only retried here for idempotent methods, makeCall() retries idempotent POSTs itself
+        retry = Retry(total=3, connect=3, read=2, status=0, other=0, allowed_methods=IDEMPOTENT_METHODS,
+                      backoff_factor=0.5, raise_on_status=False, respect_retry_after_header=False)
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=poolSize, max_retries=retry)
+        self.sess.mount('https://', adapter)
+        self.sess.mount('http://', adapter)
 
     def podPicker(pod: str):
         switcher = {
@@ -127,114 +608,218 @@ class QualysAPI:
         }
         return switcher.get(pod, "invalid")
 
-    def makeCall(self, url, payload="", headers=None, retryCount=0, method='POST', returnwith='xml'):
-        # Get the headers from our own session object
-        rheaders = self.sess.headers
-        # If there are headers (meaning the __init__ method has been called and the api object was correctly created)
-        if headers is not None:
-            # copy each of the headers passed in via the 'headers' variable to the session headers so they are included
-            #   in the request
-            for h in headers.keys():
-                rheaders[h] = headers[h]
-
-        # Create a Request object using the requests library
-        r = requests.Request(method, url, data=payload, headers=rheaders)
+    def concurrencyHeadroom(self):
+        return self.scheduler.headroom()
+
+    def makeCall(self, url, payload="", headers=None, retryCount=0, method='POST', returnwith='xml', streamtags=None,
+                 idempotent=None, useCache=True):
+        # Create a Request object using the requests library.  The headers passed in are merged with the session's
+        #   headers when the request is prepared, so they only apply to this call
+        r = requests.Request(method, url, data=payload, headers=headers)
         # Prepare the request for sending
         prepped_req = self.sess.prepare_request(r)
-        # If the proxy is enabled, send via the proxy
+        if idempotent is None:
+            idempotent = isIdempotent(method, url)
         if self.debug:
             print("QualysAPI.makeCall: RequestURL")
             print(url)
             print("QualysAPI.makeCall: RequestBody")
             print(payload)
+        # If the proxy is enabled, send via the proxy
         if self.enableProxy:
-            resp = self.sess.send(prepped_req, proxies={'https': self.proxy}, timeout=None)
+            proxies = {'https': self.proxy}
         # Otherwise send direct
         else:
+            proxies = None
+
+        # Only read the response body as the caller asks for it when streaming
+        stream = returnwith == 'xmlstream'
+
+        # Measurements of the call for self.metrics, covering every attempt
+        endpoint = endpoint_name(url)
+        started = time()
+        firstRetry = retryCount
+        networkTime = 0.0
+        limitWait = 0.0
+        retrySleep = 0.0
+        body = prepped_req.body
+        bytesOut = 0 if body is None else len(body)
+
+        # Searches may be answered from the cache, anything else which is not a plain read may change what they return
+        cacheKey = None
+        invalidates = False
+        if self.cache is not None:
+            if is_cacheable(method, url):
+                if useCache:
+                    cacheKey = self.cache.key(self.user, method, url, body, prepped_req.headers.get('Accept'))
+                    cached = self.cache.open(cacheKey)
+                    if cached is not None:
+                        return self.__cachedResponse(cached, returnwith, streamtags)
+            else:
+                invalidates = method.upper() not in ('GET', 'HEAD', 'OPTIONS')
+
+        # Retry iteratively (rather than recursively) until the call is accepted or the retries are exhausted
+        while True:
+            resp = None
+            giveUp = False
+            limitWait += self.scheduler.acquire()
+            sendStart = monotonic()
             try:
-                resp = self.sess.send(prepped_req, timeout=None)
+                resp = self.sess.send(prepped_req, proxies=proxies, timeout=(self.connectTimeout, self.readTimeout),
+                                      stream=stream)
             except UnicodeEncodeError:  # Problem encoding request data
                 print('API Error: UnicodeEncodeError exception caught, returning \'None\' to caller')
-                return None
-            except requests.exceptions.ConnectionError:
-                print('API Error: Connection Error, retrying connection')
-                retryCount += 1
-                resp = self.makeCall(url=url, payload=payload, headers=headers, retryCount=retryCount,
-                                     method=method, returnwith=returnwith)
+                giveUp = True
+            except requests.exceptions.ConnectionError as e:
+                if idempotent or requestNotSent(e):
+                    print('API Error: Connection Error, retrying connection')
+                else:
+                    # The request may have reached the server before the connection was lost, so it is not sent again
+                    print('API Error: Connection lost after the request was sent, returning \'None\' to caller')
+                    giveUp = True
+            except requests.exceptions.ReadTimeout:
+                if idempotent:
+                    print('API Error: No response within %s seconds, retrying' % self.readTimeout)
+                else:
+                    # The call may have been carried out, so making it again could (for example) create a user twice
+                    print('API Error: No response within %s seconds, returning \'None\' to caller' % self.readTimeout)
+                    giveUp = True
             except:  # Unhandled exception
                 print('API Error: Unhandled Exception :', sys.exc_info()[0])
                 print('Returning \'None\' to the caller')
+                giveUp = True
+            finally:
+                networkTime += monotonic() - sendStart
+                # Return the lease, learning the current limits from the response headers
+                if resp is None:
+                    throttled = self.scheduler.release()
+                else:
+                    throttled = self.scheduler.release(headers=resp.headers, statusCode=resp.status_code)
+
+            if giveUp:
+                if invalidates:
+                    # The call may still have been carried out
+                    self.cache.invalidate(url)
+                self.metrics.record(CallRecord(endpoint, method, None, started, networkTime, bytesOut, 0,
+                                               retryCount - firstRetry, limitWait, retrySleep, False))
                 return None
 
-        if self.debug:
-            print("QualysAPI.makeCall: Request Headers")
-            print("%s" % str(rheaders))
-            print("QualysAPI.makeCall: Response Headers...")
-            print("%s" % str(resp.headers))
-            print("QualysAPI.makeCall: Response text...")
-            print("%s" % resp.text)
-
-        # Handle concurrency limit failures
-        if 'X-Concurrency-Limit-Limit' in resp.headers.keys() and 'X-Concurrency-Limit-Running' in resp.headers.keys():
-            climit = int(resp.headers['X-Concurrency-Limit-Limit'])
-            crun = int(resp.headers['X-Concurrency-Limit-Running'])
-            # If crun > climit then we have hit the concurrency limit.  We then wait for a number of seconds depending
-            #   on how many retry attempts there have been
-            if crun >= climit:
-                print("QualysAPI.makeCall: Concurrency limit hit.  %s/%s running calls" % (crun, climit))
-                retryCount = retryCount + 1
-                if retryCount > 15:
-                    print("QualysAPI.makeCall: Retry count > 15, waiting 60 seconds")
-                    waittime = 60
-                elif retryCount > 5:
-                    print("QualysAPI.makeCall: Retry count > 5, waiting 30 seconds")
-                    waittime = 30
-                else:
-                    print("QualysAPI.makeCall: Waiting 15 seconds")
-                    waittime = 15
-                # Sleep here
-                sleep(waittime)
-                print("QualysAPI.makeCall: Retrying (retryCount = %s)" % str(retryCount))
-
-                # Make a self-referential call to this same class method, passing in the retry count so the next
-                #   iteration knows how many attempts have been made so far
-                resp = self.makeCall(url=url, payload=payload, headers=headers, retryCount=retryCount, method=method,
-                                     returnwith=returnwith)
-
-        # Handle rate limit failures
-        if 'X-RateLimit-ToWait-Sec' in resp.headers.keys():
-            if int(resp.headers['X-RateLimit-ToWait-Sec']) > 0:
-                # If this response header has a value > 0, we know we have to wait some time so first we increment
-                #   the retryCount
-                retryCount = retryCount + 1
-
-                # Get the number of seconds to wait from the response header.  Add to this a number of seconds depending
-                #   on how many times we have already tried this call
-                waittime = int(resp.headers['X-RateLimit-ToWait-Sec'])
-                print("QualysAPI.makeCall: Rate limit reached, suggested wait time: %s seconds" % waittime)
-                if retryCount > 15:
-                    print("QualysAPI.makeCall: Retry Count > 15, adding 60 seconds to wait time")
-                    waittime = waittime + 60
-                elif retryCount > 5:
-                    print("QualysAPI.makeCall: Retry Count > 5, adding 30 seconds to wait time")
-                    waittime = waittime + 30
-
-                # Sleep here
-                sleep(waittime)
-                print("QualysAPI.makeCall: Retrying (retryCount = %s)" % str(retryCount))
+            if self.debug and resp is not None:
+                print("QualysAPI.makeCall: Request Headers")
+                print("%s" % str(prepped_req.headers))
+                print("QualysAPI.makeCall: Response Headers...")
+                print("%s" % str(resp.headers))
+                if not stream:
+                    print("QualysAPI.makeCall: Response text...")
+                    print("%s" % resp.text)
+
+            if resp is not None and throttled is None:
+                break
+            if resp is not None:
+                # Give the connection back to the pool without reading the rejected response
+                resp.close()
+
+            retryCount = retryCount + 1
+            if retryCount > self.scheduler.maxRetries:
+                print("QualysAPI.makeCall: Retry count > %s, returning 'None' to the caller" % self.scheduler.maxRetries)
+                if invalidates:
+                    self.cache.invalidate(url)
+                self.metrics.record(CallRecord(endpoint, method, None if resp is None else resp.status_code, started,
+                                               networkTime, bytesOut, 0, retryCount - firstRetry - 1, limitWait,
+                                               retrySleep, False))
+                return None
 
-                # Make a self-referential call to this same class method, passing in the retry count so the next
-                #   iteration knows how many attempts have been made so far
-                resp = self.makeCall(url=url, payload=payload, headers=headers, retryCount=retryCount)
+            if throttled == 'concurrency':
+                print("QualysAPI.makeCall: Concurrency limit hit.  %s/%s running calls" %
+                      (self.scheduler.concurrencyRunning, self.scheduler.concurrencyLimit))
+                waittime = self.scheduler.backoff(retryCount)
+            elif throttled == 'rate':
+                suggested = int(resp.headers['X-RateLimit-ToWait-Sec'])
+                print("QualysAPI.makeCall: Rate limit reached, suggested wait time: %s seconds" % suggested)
+                waittime = self.scheduler.backoff(retryCount, suggested)
+            else:
+                waittime = self.scheduler.backoff(retryCount)
+            print("QualysAPI.makeCall: Waiting %.1f seconds, then retrying (retryCount = %s)" % (waittime, retryCount))
+
+            if throttled is not None:
+                # Hold back every caller, not just this one, the scheduler will release them when the wait is over
+                self.scheduler.pause(waittime)
+            else:
+                sleep(waittime)
+                retrySleep += waittime
 
         # Increment the API call count (failed calls are not included in the count)
-        self.callCount = self.callCount + 1
+        with self.lock:
+            self.callCount = self.callCount + 1
+
+        if invalidates:
+            self.cache.invalidate(url)
+        if cacheKey is not None and resp.status_code == 200 and not stream:
+            self.cache.put(cacheKey, resp.content, started)
+
+        # Streamed responses have not been read yet, their size is added as they are
+        self.metrics.record(CallRecord(endpoint, method, resp.status_code, started, networkTime, bytesOut,
+                                       0 if stream else len(resp.content), retryCount - firstRetry, limitWait,
+                                       retrySleep, True))
 
         if returnwith == 'xml':
-            # Return the response as an ElementTree XML object
-            return ET.fromstring(resp.text)
+            # Return the response as an ElementTree XML object, parsed from the bytes so the body is not decoded twice
+            return ET.fromstring(resp.content)
         if returnwith == 'json':
-            return json.loads(resp.text)
+            return json.loads(resp.content)
         if returnwith == 'text':
             # Return with the response as a text string
             return resp.text
+        if returnwith == 'bytes':
+            return resp.content
+        if returnwith == 'xmlstream':
+            if cacheKey is not None and resp.status_code == 200:
+                return self.__streamElements(resp, streamtags, endpoint, self.cache.writer(cacheKey, started))
+            return self.__streamElements(resp, streamtags, endpoint)
+
+    def __streamElements(self, resp, tags, endpoint, cacheWriter=None):
+        received = 0
+
+        def chunks():
+            nonlocal received
+            for chunk in resp.iter_content(chunk_size=65536):
+                received += len(chunk)
+                if cacheWriter is not None:
+                    cacheWriter.write(chunk)
+                yield chunk
+
+        complete = False
+        try:
+            yield from iterElements(chunks(), tags)
+            complete = True
+        finally:
+            resp.close()
+            self.metrics.add_bytes_in(endpoint, received)
+            # Only a response which was read to the end is cached
+            if cacheWriter is not None:
+                if complete:
+                    cacheWriter.commit()
+                else:
+                    cacheWriter.discard()
+
+    def __cachedResponse(self, cached, returnwith, streamtags):
+        # Return a cached response in the form the caller asked for, as the end of makeCall() does
+        if returnwith == 'xmlstream':
+            return self.__streamCached(cached, streamtags)
+        with cached:
+            content = cached.read()
+        if returnwith == 'xml':
+            return ET.fromstring(content)
+        if returnwith == 'json':
+            return json.loads(content)
+        if returnwith == 'text':
+            return content.decode('utf-8', errors='replace')
+        if returnwith == 'bytes':
+            return content
+
+    @staticmethod
+    def __streamCached(cached, tags):
+        try:
+            yield from iterElements(iter(lambda: cached.read(65536), b''), tags)
+        finally:
+            cached.close()
@@ -0,0 +1,234 @@
+import hashlib
+import os
+import re
+import threading
+from time import time
+
+# Responses are only cached if the request succeeded, which the QPS APIs report (in both XML and JSON) at the start of
+# the body rather than in the HTTP status
+SUCCESS_MARKER = b'SUCCESS'
+SUCCESS_WINDOW = 4096
+
+
+def cache_group(url: str):
+    # The kind of object a call reads or changes, e.g. 'am_user' for /qps/rest/2.0/search/am/user and for user.php,
+    # so that a write only invalidates the cached searches it can affect.  None for calls which could change anything
+    match = re.search(r'/qps/rest/[\d.]+/[a-z]+/([a-z]+)/([a-zA-Z]+)', url)
+    if match is not None:
+        return '%s_%s' % (match.group(1), match.group(2).lower())
+    if '/msp/user.php' in url:
+        return 'am_user'
+    return None
+
+
+def is_cacheable(method: str, url: str):
+    # Only searches and counts, which read data without changing it, are cached
+    return cache_group(url) is not None and ('/search/' in url or '/count/' in url)
+
+
+class CacheWriter:
+    """Writes one response into the cache as it is received, so streamed responses are cached without being held in
+    memory.  The entry only appears once commit() is called, discard() throws it away"""
+
+    def __init__(self, cache, path: str, started: float):
+        self.cache = cache
+        self.path = path
+        self.started = started
+        self.temp = '%s.%s.%s.tmp' % (path, os.getpid(), threading.get_ident())
+        self.file = open(self.temp, 'wb')
+        self.size = 0
+        self.head = b''
+
+    def write(self, chunk: bytes):
+        if len(self.head) < SUCCESS_WINDOW:
+            self.head += chunk[:SUCCESS_WINDOW - len(self.head)]
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self):
+        self.file.close()
+        if SUCCESS_MARKER not in self.head or self.cache.invalidated_since(self.path, self.started):
+            os.remove(self.temp)
+            return
+        os.replace(self.temp, self.path)
+        self.cache.added(self.size)
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.temp):
+            os.remove(self.temp)
+
+
+class ResponseCache:
+    """On-disk cache of the responses to read-only API calls (searches and counts), shared by every run using the same
+    directory.  Entries are keyed on the API user, method, URL, Accept header and request body, expire 'ttl' seconds
+    after they were fetched, and the oldest are evicted when the cache grows beyond 'max_bytes'.  Writes invalidate the
+    cached searches of the kind of object they change (e.g. creating a user invalidates user searches, but not role or
+    tag lookups), in every run sharing the directory
+
+    Class Members
+    =============
+
+    directory       : String  : The directory holding the cache, created readable only by its owner
+    ttl             : Float   : Seconds a cached response is used for
+    max_bytes       : Integer : The size the cache is kept within, evicting the oldest responses first
+    hits            : Integer : The number of calls answered from the cache by this object
+    misses          : Integer : The number of cacheable calls which had to be made
+
+    Class Methods
+    =============
+
+    key(user, method, url, body, accept)
+
+        Return the cache key of a call
+
+    open(key)
+
+        Return a file object reading the cached response, or None if it is not cached (or has expired)
+
+    writer(key, started)
+
+        Return a CacheWriter to store a response in the cache as it is received.  'started' is the time (time.time())
+        the call was made, responses to calls made before an invalidation of their group are not stored
+
+    put(key, content, started)
+
+        Store a response in the cache
+
+    invalidate(url)
+
+        Remove the cached responses a write to 'url' may have made out of date, or every cached response if 'url' is
+        None or its effect is not known
+    """
+
+    directory: str
+    ttl: float
+    max_bytes: int
+    hits: int
+    misses: int
+
+    def __init__(self, directory: str, ttl: float = 300, max_bytes: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # The time each group was last invalidated by this object, so responses to searches which were already in
+        # flight when the write was made are not cached
+        self.invalidated = {}
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.size = sum(size for _, _, size in self.__entries())
+
+    def __entries(self):
+        # Yield (path, modification time, size) for every entry in the cache
+        for group in os.listdir(self.directory):
+            group_dir = os.path.join(self.directory, group)
+            if not os.path.isdir(group_dir):
+                continue
+            for name in os.listdir(group_dir):
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(group_dir, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_mtime, st.st_size
+
+    def key(self, user: str, method: str, url: str, body=None, accept: str = None) -> str:
+        digest = hashlib.sha256()
+        for part in [user or '', method.upper(), url, accept or '']:
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        if body is not None:
+            digest.update(body.encode('utf-8') if isinstance(body, str) else body)
+        return '%s/%s' % (cache_group(url), digest.hexdigest())
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.directory, *key.split('/'))
+
+    def open(self, key: str):
+        path = self.__path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        if time() - os.fstat(f.fileno()).st_mtime > self.ttl:
+            f.close()
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return f
+
+    def writer(self, key: str, started: float = None) -> CacheWriter:
+        path = self.__path(key)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        return CacheWriter(self, path, time() if started is None else started)
+
+    def put(self, key: str, content: bytes, started: float = None):
+        writer = self.writer(key, started)
+        writer.write(content)
+        writer.commit()
+
+    def invalidated_since(self, path: str, started: float) -> bool:
+        # True if this object has invalidated the entry's group since 'started', so the response may be out of date
+        group = os.path.basename(os.path.dirname(path))
+        with self.lock:
+            return max(self.invalidated.get(group, 0), self.invalidated.get(None, 0)) >= started
+
+    def added(self, size: int):
+        with self.lock:
+            self.size += size
+            if self.size <= self.max_bytes:
+                return
+        self.__evict()
+
+    def __evict(self):
+        # Remove expired entries, then the oldest, until the cache is back within max_bytes
+        entries = sorted(self.__entries(), key=lambda e: e[1])
+        now = time()
+        total = sum(size for _, _, size in entries)
+        for path, mtime, size in entries:
+            if total <= self.max_bytes and now - mtime <= self.ttl:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        with self.lock:
+            self.size = total
+
+    def invalidate(self, url: str = None):
+        group = None if url is None else cache_group(url)
+        with self.lock:
+            self.invalidated[group] = time()
+        if group is None:
+            targets = [os.path.join(self.directory, g) for g in os.listdir(self.directory)]
+        else:
+            targets = [os.path.join(self.directory, group)]
+        removed = 0
+        for target in targets:
+            if not os.path.isdir(target):
+                continue
+            for name in os.listdir(target):
+                if name.endswith('.tmp'):
+                    # Responses still being written, which are not committed once they see the invalidation
+                    continue
+                path = os.path.join(target, name)
+                try:
+                    removed += os.stat(path).st_size
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        with self.lock:
+            self.size = max(0, self.size - removed)
@@ -0,0 +1,216 @@
+import json
+import re
+import threading
+from collections import namedtuple
+from time import time
+from file_utils import write_atomic
+
+# Upper bounds (in seconds) of the latency histogram buckets, as used by Prometheus histograms
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# One completed API call, as passed to the hooks.  'status' is the HTTP status of the last attempt (None if no
+# response was received), 'seconds' the time spent on the network over all attempts, 'limit_wait' the time spent
+# held back by the rate and concurrency limits, 'retry_sleep' the time spent sleeping before retrying failed
+# connections and 'ok' whether the call returned a response to the caller
+CallRecord = namedtuple('CallRecord', ['endpoint', 'method', 'status', 'started', 'seconds', 'bytes_out', 'bytes_in',
+                                       'retries', 'limit_wait', 'retry_sleep', 'ok'])
+
+
+def endpoint_name(url: str) -> str:
+    # Reduce a URL to the endpoint it calls, so that calls for different users are counted together:
+    #   https://host/qps/rest/2.0/update/am/user/1234?x=y -> /qps/rest/2.0/update/am/user/{id}
+    path = re.sub(r'^[a-z]+://[^/]*', '', url).split('?', 1)[0]
+    return re.sub(r'/\d+(?=/|$)', '/{id}', path) or '/'
+
+
+class EndpointMetrics:
+    """Totals and a latency histogram for the calls made to one endpoint"""
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.seconds = 0.0
+        self.limit_wait = 0.0
+        self.retry_sleep = 0.0
+        self.statuses = {}
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, record: CallRecord):
+        self.calls += 1
+        if not record.ok:
+            self.failures += 1
+        self.retries += record.retries
+        self.bytes_out += record.bytes_out
+        self.bytes_in += record.bytes_in
+        self.seconds += record.seconds
+        self.limit_wait += record.limit_wait
+        self.retry_sleep += record.retry_sleep
+        status = str(record.status)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if record.seconds <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def as_dict(self):
+        return {'calls': self.calls, 'failures': self.failures, 'retries': self.retries, 'bytes_out': self.bytes_out,
+                'bytes_in': self.bytes_in, 'seconds': round(self.seconds, 3),
+                'limit_wait': round(self.limit_wait, 3), 'retry_sleep': round(self.retry_sleep, 3),
+                'statuses': dict(self.statuses),
+                'latency_buckets': {str(b): n for b, n in zip(LATENCY_BUCKETS + ('+Inf',), self.buckets)}}
+
+
+class ApiMetrics:
+    """Per-endpoint measurements of the calls made by a QualysAPI (or AsyncQualysAPI) object: call counts, a latency
+    histogram, bytes sent and received, retries and the time spent waiting on the subscription's limits.  Updates
+    from several threads are serialized
+
+    Class Members
+    =============
+
+    endpoints       : Dict    : Endpoint name (the URL path with numeric IDs replaced by {id}) to EndpointMetrics
+    timers          : Dict    : Other named durations of the run in seconds (e.g. 'sync_wait'), added with add_time()
+    started         : Float   : The time (time.time()) the object was created
+
+    Class Methods
+    =============
+
+    add_hook(hook)
+
+        Call 'hook' with a CallRecord after every completed API call, for external tracers.  Hooks are called on the
+        thread which made the call, exceptions they raise are printed and otherwise ignored
+
+    remove_hook(hook)
+
+        Stop calling a hook added with add_hook()
+
+    record(record)
+
+        Add a CallRecord to the totals and pass it to the hooks, called by the API objects
+
+    add_bytes_in(endpoint, count)
+
+        Add to the bytes received from an endpoint, for responses which are read after the call has been recorded
+
+    add_time(name, seconds)
+
+        Add to one of the run's other named durations
+
+    report()
+
+        Return the totals as a dictionary, ready for JSON
+
+    write_json(filename)
+
+        Write report() to a JSON file
+
+    write_prometheus(filename)
+
+        Write the totals in the Prometheus text exposition format, for the node_exporter textfile collector
+    """
+
+    endpoints: dict
+    timers: dict
+    started: float
+
+    def __init__(self):
+        self.endpoints = {}
+        self.timers = {}
+        self.started = time()
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook):
+        with self.lock:
+            self.hooks = self.hooks + [hook]
+
+    def remove_hook(self, hook):
+        with self.lock:
+            self.hooks = [h for h in self.hooks if h is not hook]
+
+    def record(self, record: CallRecord):
+        with self.lock:
+            metrics = self.endpoints.get(record.endpoint)
+            if metrics is None:
+                metrics = self.endpoints[record.endpoint] = EndpointMetrics()
+            metrics.add(record)
+            hooks = self.hooks
+        for hook in hooks:
+            try:
+                hook(record)
+            except Exception as e:
+                print('API metrics hook %s failed : %s' % (hook, e))
+
+    def add_bytes_in(self, endpoint: str, count: int):
+        with self.lock:
+            if endpoint in self.endpoints:
+                self.endpoints[endpoint].bytes_in += count
+
+    def add_time(self, name: str, seconds: float):
+        with self.lock:
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def report(self):
+        with self.lock:
+            endpoints = {name: m.as_dict() for name, m in sorted(self.endpoints.items())}
+            timers = {name: round(seconds, 3) for name, seconds in self.timers.items()}
+        totals = {key: sum(e[key] for e in endpoints.values())
+                  for key in ['calls', 'failures', 'retries', 'bytes_out', 'bytes_in', 'seconds', 'limit_wait',
+                              'retry_sleep']}
+        return {'started': self.started, 'elapsed': round(time() - self.started, 3), 'totals': totals,
+                'timers': timers, 'endpoints': endpoints}
+
+    def write_json(self, filename: str):
+        write_atomic(filename, json.dumps(self.report(), indent=2) + '\n')
+
+    def write_prometheus(self, filename: str):
+        report = self.report()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP qualys_api_%s %s' % (name, help_text))
+            lines.append('# TYPE qualys_api_%s %s' % (name, kind))
+            for labels, value in samples:
+                label_text = ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                                      for k, v in labels)
+                lines.append('qualys_api_%s{%s} %s' % (name, label_text, value) if label_text else
+                             'qualys_api_%s %s' % (name, value))
+
+        endpoints = report['endpoints']
+        metric('calls_total', 'counter', 'API calls made', [([('endpoint', e)], m['calls'])
+                                                           for e, m in endpoints.items()])
+        metric('failures_total', 'counter', 'API calls which did not return a response',
+               [([('endpoint', e)], m['failures']) for e, m in endpoints.items()])
+        metric('retries_total', 'counter', 'API call attempts which were retried',
+               [([('endpoint', e)], m['retries']) for e, m in endpoints.items()])
+        metric('sent_bytes_total', 'counter', 'Request body bytes sent',
+               [([('endpoint', e)], m['bytes_out']) for e, m in endpoints.items()])
+        metric('received_bytes_total', 'counter', 'Response body bytes received',
+               [([('endpoint', e)], m['bytes_in']) for e, m in endpoints.items()])
+        metric('limit_wait_seconds_total', 'counter', 'Seconds held back by the rate and concurrency limits',
+               [([('endpoint', e)], m['limit_wait']) for e, m in endpoints.items()])
+        metric('retry_sleep_seconds_total', 'counter', 'Seconds slept before retrying failed connections',
+               [([('endpoint', e)], m['retry_sleep']) for e, m in endpoints.items()])
+        samples = []
+        for e, m in endpoints.items():
+            cumulative = 0
+            for bound, count in m['latency_buckets'].items():
+                cumulative += count
+                samples.append(([('endpoint', e), ('le', bound)], cumulative))
+        lines.append('# HELP qualys_api_call_seconds Time spent on the network per API call')
+        lines.append('# TYPE qualys_api_call_seconds histogram')
+        for labels, value in samples:
+            lines.append('qualys_api_call_seconds_bucket{endpoint="%s",le="%s"} %s' % (labels[0][1], labels[1][1],
+                                                                                      value))
+        for e, m in endpoints.items():
+            lines.append('qualys_api_call_seconds_sum{endpoint="%s"} %s' % (e, m['seconds']))
+            lines.append('qualys_api_call_seconds_count{endpoint="%s"} %s' % (e, m['calls']))
+        metric('run_seconds', 'gauge', 'Other durations of the run',
+               [([('timer', name)], seconds) for name, seconds in report['timers'].items()])
+        metric('elapsed_seconds', 'gauge', 'Seconds since the run started', [([], report['elapsed'])])
+        write_atomic(filename, '\n'.join(lines) + '\n')
@@ -0,0 +1,84 @@
+import json
+from collections import namedtuple
+from xml.etree import ElementTree as ET
+
+# The outcome of an API call, decoded from its response in one pass.
+#   error_code : 0 if the call succeeded, 2 if the API reported an error, 3 if there was no response or it could not
+#                be understood
+#   status     : The status the API reported ('SUCCESS', 'FAILED', an error code ...), None if there was none
+#   message    : The message or error message the API gave, if any
+#   login      : The USER_LOGIN of a user created by /msp/user.php, None otherwise
+#   password   : The PASSWORD of a user created by /msp/user.php, None otherwise
+#   ids        : The IDs of the objects in a /qps JSON response's data list (e.g. the users a bulk update changed)
+ApiResult = namedtuple('ApiResult', ['error_code', 'status', 'message', 'login', 'password', 'ids'])
+
+NO_RESPONSE = ApiResult(3, None, 'No response from API', None, None, ())
+
+
+def api_result(status, message=None, login=None, password=None, ids=()) -> ApiResult:
+    if status is None:
+        return ApiResult(3, None, message or 'Unknown error', login, password, tuple(ids))
+    if status == 'SUCCESS':
+        return ApiResult(0, status, message or '', login, password, tuple(ids))
+    return ApiResult(2, status, message or status, login, password, tuple(ids))
+
+
+def decode_elements(elements) -> ApiResult:
+    # Pick the fields out of the elements of a /msp/user.php or /qps XML response in a single pass (as from
+    # Element.iter(), or the elements of a streaming parse).  The first message is kept, as /qps responses follow the
+    # error message with details
+    status = None
+    message = None
+    login = None
+    password = None
+    for elem in elements:
+        tag = elem.tag
+        if tag == 'RETURN':
+            status = elem.get('status', status)
+        elif tag == 'responseCode':
+            status = (elem.text or '').strip()
+        elif tag in ('MESSAGE', 'errorMessage') and message is None:
+            message = (elem.text or '').strip()
+        elif tag == 'USER_LOGIN':
+            login = elem.text
+        elif tag == 'PASSWORD':
+            password = elem.text
+    return api_result(status, message, login, password)
+
+
+def decode_xml(response) -> ApiResult:
+    # Decode an XML response, given as the raw bytes or an already parsed Element, with one walk of the tree rather
+    # than a search for each field.  Malformed XML is reported as error code 3 rather than raised
+    if response is None:
+        return NO_RESPONSE
+    if not isinstance(response, ET.Element):
+        try:
+            response = ET.fromstring(response)
+        except ET.ParseError as e:
+            return ApiResult(3, None, 'Malformed response : %s' % e, None, None, ())
+    return decode_elements(response.iter())
+
+
+def decode_json(response) -> ApiResult:
+    # Decode a /qps JSON ServiceResponse, given as the raw bytes or the parsed dictionary.  Responses which are not
+    # JSON, or not shaped like a ServiceResponse, are reported as error code 3 rather than raised
+    if response is None:
+        return NO_RESPONSE
+    if isinstance(response, (bytes, str)):
+        try:
+            response = json.loads(response)
+        except ValueError as e:
+            return ApiResult(3, None, 'Malformed response : %s' % e, None, None, ())
+    service_response = response.get('ServiceResponse') if isinstance(response, dict) else None
+    if not isinstance(service_response, dict):
+        return ApiResult(3, None, 'Unrecognised response', None, None, ())
+    details = service_response.get('responseErrorDetails')
+    message = details.get('errorMessage') if isinstance(details, dict) else None
+    ids = []
+    data = service_response.get('data')
+    for entry in data if isinstance(data, list) else []:
+        for value in entry.values() if isinstance(entry, dict) else []:
+            if isinstance(value, dict) and value.get('id') is not None:
+                ids.append(str(value['id']))
+    status = service_response.get('responseCode')
+    return api_result(None if status is None else str(status), None if message is None else str(message), ids=ids)
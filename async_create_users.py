@@ -0,0 +1,236 @@
+import asyncio
+import json
+import api_responses
+import provisioning_journal
+from provisioning_journal import ProvisioningJournal
+from output_writer import OutputWriter
+from AsyncQualysAPI import AsyncQualysAPI
+from create_users_from_csv import QualysUser, PortalUserIndex, PortalSearchError, portal_user_searches, \
+    entitlement_signature, bulk_role_and_scope_url, row_key, search_request_xml
+
+
+# Asyncio equivalents of the create and sync functions in create_users_from_csv, for callers which already run an
+# event loop.  Any number of calls can be awaited at once, the API object's scheduler keeps the number actually in
+# flight within the subscription's rate and concurrency limits.
+
+
+async def get_portal_users_async(api: AsyncQualysAPI, criteria: list = None, limit_results: int = 50) -> list[dict]:
+    # As iter_portal_users, a page which fails or reports an error raises PortalSearchError rather than ending the list
+    all_users = []
+    offset = 0
+    if criteria is None:
+        criteria = [{'field': 'id', 'operator': 'GREATER', 'value': '0'}]
+
+    service_request = {
+        'ServiceRequest': {
+            'filters': {
+                'Criteria': criteria
+            },
+            'preferences': {
+                'limitResults': str(limit_results),
+            }
+        }
+    }
+    headers = {"Accept": "application/json", "Content-Type": "application/json"}
+    more_data = True
+    while more_data:
+        body = await api.make_call(url='%s/qps/rest/2.0/search/am/user' % api.server,
+                                   payload=json.dumps(service_request),
+                                   headers=headers,
+                                   method='POST',
+                                   returnwith='bytes')
+        try:
+            response = None if body is None else json.loads(body)
+        except ValueError as e:
+            raise PortalSearchError('User search at offset %s could not be read : %s' % (offset, e))
+        result = api_responses.decode_json(response)
+        if result.error_code != 0:
+            raise PortalSearchError('User search at offset %s failed : %s' % (offset, result.message))
+        service_response = response['ServiceResponse']
+        if 'hasMoreRecords' in service_response and service_response['hasMoreRecords'] == 'true':
+            more_data = True
+            offset += limit_results
+            service_request['ServiceRequest']['preferences']['startFromOffset'] = str(offset)
+        else:
+            more_data = False
+        all_users += service_response.get('data', [])
+
+    return all_users
+
+
+async def highest_user_id_async(api: AsyncQualysAPI) -> int:
+    # As highest_user_id.  Call it before creating any users, as users created before the call are below the result
+    criteria = [{'field': 'id', 'operator': 'GREATER', 'value': '0'}]
+    headers = {'Accept': 'application/json', 'Content-Type': 'text/xml'}
+    body = await api.make_call(url='%s/qps/rest/2.0/count/am/user' % api.server, payload=search_request_xml(criteria),
+                               headers=headers, returnwith='bytes')
+    try:
+        response = None if body is None else json.loads(body)
+    except ValueError:
+        response = None
+    result = api_responses.decode_json(response)
+    if result.error_code != 0:
+        return 0
+    count = int(response['ServiceResponse'].get('count') or 0)
+    if count == 0:
+        return 0
+    result = api_responses.decode_json(await api.make_call(url='%s/qps/rest/2.0/search/am/user' % api.server,
+                                                           payload=search_request_xml(criteria, limit_results=1,
+                                                                                      offset=count - 1),
+                                                           headers=headers, returnwith='bytes'))
+    if result.error_code != 0 or len(result.ids) == 0:
+        return 0
+    return int(result.ids[-1])
+
+
+async def find_portal_users_async(api: AsyncQualysAPI, pending_usernames, sync_mode: str = 'id', high_water: int = 0,
+                                  page_size: int = 50):
+    # Run the searches concurrently, returning a PortalUserIndex of the users found and the new high-water mark
+    searches = portal_user_searches(pending_usernames=pending_usernames, sync_mode=sync_mode, high_water=high_water,
+                                    batch_size=page_size)
+    results = await asyncio.gather(*[get_portal_users_async(api=api, criteria=criteria, limit_results=page_size)
+                                     for criteria in searches])
+    portal_users = PortalUserIndex()
+    for result in results:
+        for portal_user in result:
+            portal_users.add(portal_user)
+            high_water = max(high_water, int(portal_user['User']['id']))
+    return portal_users, high_water
+
+
+async def create_user_async(api: AsyncQualysAPI, user: QualysUser, user_role: str = 'reader',
+                            send_email: bool = False):
+    url, payload = user.create_url(baseurl=api.server, send_email=send_email, user_role=user_role)
+    result = api_responses.decode_xml(await api.make_call(url=url, payload=payload, returnwith='bytes'))
+    if result.error_code != 0:
+        return result.error_code, result.message
+    if result.login is None or result.password is None:
+        return 3, 'No login or password in response'
+    user.username = result.login
+    user.password = result.password
+    user.created = True
+    return 0, ''
+
+
+async def create_users_async(api: AsyncQualysAPI, users: list, user_role: str = 'reader',
+                             journal: ProvisioningJournal = None):
+    # Returns a list of (user, error_code, error_message) tuples in the same order as 'users'.  With a journal, each
+    # user is recorded as soon as its create call returns, as create_users does
+    async def create_and_record(user):
+        error_code, error_message = await create_user_async(api=api, user=user, user_role=user_role)
+        if error_code == 0 and journal is not None:
+            journal.record(row_key(user), provisioning_journal.CREATED, username=user.username,
+                           password=user.password)
+        return error_code, error_message
+
+    results = await asyncio.gather(*[create_and_record(user) for user in users])
+    return [(user, error_code, error_message) for user, (error_code, error_message) in zip(users, results)]
+
+
+async def set_roles_and_scopes_async(api: AsyncQualysAPI, user: QualysUser):
+    url, payload = user.set_role_and_scope_url(baseurl=api.server)
+    headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+    result = api_responses.decode_json(await api.make_call(url=url, payload=json.dumps(payload), method='POST',
+                                                           returnwith='bytes', headers=headers))
+    return result.error_code, '' if result.error_code == 0 else result.message
+
+
+async def set_roles_and_scopes_bulk_async(api: AsyncQualysAPI, users: list):
+    # As set_roles_and_scopes_bulk, returns a list of (error_code, error_message) in the same order as 'users'
+    if len(users) == 1:
+        return [await set_roles_and_scopes_async(api=api, user=users[0])]
+    url, payload = bulk_role_and_scope_url(baseurl=api.server, users=users)
+    headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+    result = api_responses.decode_json(await api.make_call(url=url, payload=json.dumps(payload), method='POST',
+                                                           returnwith='bytes', headers=headers))
+    updated = set(result.ids) if result.error_code == 0 else set()
+    failed = [user for user in users if str(user.id) not in updated]
+    retried = dict(zip([id(user) for user in failed],
+                       await asyncio.gather(*[set_roles_and_scopes_async(api=api, user=user) for user in failed])))
+    return [retried.get(id(user), (0, '')) for user in users]
+
+
+async def update_roles_and_scopes_async(api: AsyncQualysAPI, users: list, bulk_size: int = 100):
+    # As update_roles_and_scopes, with the groups updated concurrently.  Returns a list of (error_code, error_message)
+    # in the same order as 'users'
+    groups = {}
+    for user in users:
+        groups.setdefault(entitlement_signature(user), []).append(user)
+    chunks = [group[start:start + max(1, bulk_size)] for group in groups.values()
+              for start in range(0, len(group), max(1, bulk_size))]
+    results = await asyncio.gather(*[set_roles_and_scopes_bulk_async(api=api, users=chunk) for chunk in chunks])
+    by_user = {}
+    for chunk, chunk_results in zip(chunks, results):
+        for user, result in zip(chunk, chunk_results):
+            by_user[id(user)] = result
+    return [by_user[id(user)] for user in users]
+
+
+async def sync_users_async(api: AsyncQualysAPI, user_list: list, output_file: str, sleep_time: int = 15,
+                           max_sleep_time: int = 120, sync_mode: str = 'id', page_size: int = 50,
+                           bulk_size: int = 100, output_format: str = 'text', journal: ProvisioningJournal = None,
+                           high_water: int = None):
+    # Wait for created users to appear in the portal, then apply their roles and scopes concurrently, grouping users
+    # with identical roles and scope tags into bulk updates of up to 'bulk_size' users.  Credentials are written
+    # through an OutputWriter as sync_users' are, and with a journal each user's progress is recorded the same way, so
+    # an interrupted run leaves a complete output file and can be resumed (users with a portal ID, such as those
+    # restored by resume_users, are updated without searching for them again).  In 'id' mode created users are looked
+    # for above 'high_water', which should come from highest_user_id_async() before the users were created.  If it is
+    # not given, the mark recorded in the journal (as by create_users_from_csv) is used, otherwise every user is searched
+    def record_updated(keys):
+        for key in keys:
+            journal.record(key, provisioning_journal.UPDATED)
+
+    pending = {u.username: u for u in user_list if u.created and not u.synced and u.id == ''}
+    ready = [u for u in user_list if u.created and not u.synced and u.id != '']
+    if high_water is None:
+        recorded = journal.value('high_water') if journal is not None else None
+        high_water = 0 if recorded is None else int(recorded)
+    wait_time = sleep_time
+    with OutputWriter(filename=output_file, fmt=output_format,
+                      on_flush=record_updated if journal is not None else None) as writer:
+        while len(pending) > 0 or len(ready) > 0:
+            users_to_sync = ready
+            ready = []
+            if len(pending) > 0:
+                print(f'{len(pending)} users not synced')
+                await asyncio.sleep(wait_time)
+                try:
+                    portal_users, high_water = await find_portal_users_async(api=api,
+                                                                             pending_usernames=pending.keys(),
+                                                                             sync_mode=sync_mode,
+                                                                             high_water=high_water,
+                                                                             page_size=page_size)
+                except PortalSearchError as e:
+                    print(f'ERROR: {e}, checking again later')
+                    portal_users = PortalUserIndex()
+                found = [u for username, u in pending.items() if username in portal_users]
+                if len(found) == 0:
+                    wait_time = min(max_sleep_time, wait_time * 2)
+                else:
+                    wait_time = sleep_time
+                for user in found:
+                    del pending[user.username]
+                    user.id = portal_users.get(user.username)['id']
+                users_to_sync += found
+
+            if journal is not None:
+                for user in users_to_sync:
+                    journal.record(row_key(user), provisioning_journal.SYNCED, username=user.username,
+                                   portal_id=user.id)
+            results = await update_roles_and_scopes_async(api=api, users=users_to_sync, bulk_size=bulk_size)
+            for user, (error_code, error_message) in zip(users_to_sync, results):
+                user.synced = True
+                if error_code > 0:
+                    print(f'ERROR: Could not update roles and scopes for {user.username} : Reason ({error_message})')
+                    user.portal_updated = False
+                    if journal is not None:
+                        journal.record(row_key(user), provisioning_journal.UPDATE_FAILED)
+                elif user.existing:
+                    # Users who already had an account have no new credentials to write
+                    user.portal_updated = True
+                    if journal is not None:
+                        journal.record(row_key(user), provisioning_journal.UPDATED)
+                else:
+                    user.portal_updated = True
+                    writer.write(user, key=row_key(user))
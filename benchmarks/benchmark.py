@@ -0,0 +1,191 @@
+import argparse
+import csv
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from urllib.request import urlopen
+
+# Benchmarks create_users_from_csv.py and QualysAPI against the bundled mock server (mock_qualys_server.py).  Each
+# scenario runs in its own process so its peak memory use can be measured, and reports users per second, API calls
+# per user, seconds spent waiting for API limits and peak RSS.
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+SUMMARY_PATTERN = re.compile(r'Summary: (\d+) users processed, (\d+) API calls, ([\d.]+) seconds waiting for API '
+                             r'limits, ([\d.]+) seconds waiting for sync')
+
+
+def start_mock_server(args):
+    # Start the mock server on a free port, returning the process and its URL
+    command = [sys.executable, os.path.join(BENCHMARK_DIR, 'mock_qualys_server.py'), '--port', '0',
+               '--latency', str(args.latency), '--sync_delay', str(args.sync_delay),
+               '--rate_limit', str(args.rate_limit), '--rate_window', str(args.rate_window),
+               '--concurrency_limit', str(args.concurrency_limit)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = server.stdout.readline()
+    if not line.startswith('Listening on '):
+        server.kill()
+        raise RuntimeError('Mock server did not start')
+    return server, line.split()[-1]
+
+
+def mock_stats(url: str) -> dict:
+    with urlopen('%s/mock/stats' % url) as response:
+        return json.load(response)
+
+
+def write_users_csv(filename: str, count: int):
+    with open(filename, 'w', newline='') as f:
+        csvwriter = csv.writer(f)
+        csvwriter.writerow(['#Firstname*', 'Surname*', 'Email*', 'Title*', 'Phone*', 'Address1*', 'City*',
+                            'Country-Code*', 'Business Unit', 'Time Zone Code*', 'External ID', 'Portal Roles',
+                            'Scope Tags'])
+        for i in range(count):
+            csvwriter.writerow(['Bench%s' % i, 'User', 'bench.user%s@example.com' % i, 'Tester', '555-0100',
+                                '1 Test Street', 'Testville', 'US', 'Unassigned', 'US-NY', 'EXT%s' % i,
+                                'Reader;Scanner', '1001;1002'])
+
+
+def run_measured(command: list, log_file: str):
+    # Run a command with its output going to 'log_file', returning (exit code, elapsed seconds, peak RSS in MB)
+    start = monotonic()
+    with open(log_file, 'w') as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=REPO_DIR)
+        _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = usage.ru_maxrss / 1024 if sys.platform != 'darwin' else usage.ru_maxrss / (1024 * 1024)
+    return process.returncode, monotonic() - start, peak
+
+
+def bench_script(args, size: int, workdir: str) -> dict:
+    server, url = start_mock_server(args)
+    try:
+        input_file = os.path.join(workdir, 'users_%s.csv' % size)
+        output_file = os.path.join(workdir, 'users_%s.out' % size)
+        log_file = os.path.join(workdir, 'script_%s.log' % size)
+        write_users_csv(input_file, size)
+        command = [sys.executable, os.path.join(REPO_DIR, 'create_users_from_csv.py'), '-f', input_file,
+                   '-o', output_file, '-u', 'bench', '-p', 'bench', '-a', url, '-w', str(args.workers),
+                   '--sync_interval', '1', '--max_sync_interval', '2', '--page_size', str(args.page_size)]
+        exit_code, elapsed, peak = run_measured(command, log_file)
+        stats = mock_stats(url)
+    finally:
+        server.terminate()
+        server.wait()
+
+    result = {'scenario': 'create_users_from_csv', 'users': size, 'exit_code': exit_code, 'seconds': elapsed,
+              'users_per_sec': size / elapsed, 'api_calls': stats['total_calls'],
+              'calls_per_user': stats['total_calls'] / size, 'rejected_calls': stats['rejected'],
+              'peak_rss_mb': peak, 'limit_wait_sec': None, 'sync_wait_sec': None, 'log': log_file}
+    with open(log_file, 'r') as f:
+        for line in f:
+            match = SUMMARY_PATTERN.match(line)
+            if match is not None:
+                result['limit_wait_sec'] = float(match.group(3))
+                result['sync_wait_sec'] = float(match.group(4))
+    return result
+
+
+def bench_api(args, size: int, workdir: str) -> dict:
+    # Measure QualysAPI on its own: 'size' create calls through one shared object, no sync or role updates
+    server, url = start_mock_server(args)
+    try:
+        log_file = os.path.join(workdir, 'api_%s.log' % size)
+        command = [sys.executable, os.path.abspath(__file__), '--api_scenario', url, '--workers', str(args.workers),
+                   '--sizes', str(size)]
+        exit_code, elapsed, peak = run_measured(command, log_file)
+        stats = mock_stats(url)
+    finally:
+        server.terminate()
+        server.wait()
+
+    result = {'scenario': 'QualysAPI', 'users': size, 'exit_code': exit_code, 'seconds': elapsed,
+              'users_per_sec': size / elapsed, 'api_calls': stats['total_calls'],
+              'calls_per_user': stats['total_calls'] / size, 'rejected_calls': stats['rejected'],
+              'peak_rss_mb': peak, 'limit_wait_sec': None, 'sync_wait_sec': 0.0, 'log': log_file}
+    with open(log_file, 'r') as f:
+        for line in f:
+            if line.startswith('{'):
+                result['limit_wait_sec'] = json.loads(line)['limit_wait_sec']
+    return result
+
+
+def api_scenario(url: str, size: int, workers: int):
+    # Runs in the measured child process started by bench_api()
+    sys.path.insert(0, REPO_DIR)
+    import QualysAPI
+
+    api = QualysAPI.QualysAPI(svr=url, usr='bench', passwd='bench')
+
+    def create(i):
+        payload = {'action': 'add', 'first_name': 'Bench%s' % i, 'last_name': 'User',
+                   'email': 'bench.user%s@example.com' % i, 'user_role': 'reader', 'send_email': '0'}
+        return api.makeCall(url='%s/msp/user.php' % url, payload=payload)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(create, range(size)):
+            pass
+    print(json.dumps({'calls': api.callCount, 'limit_wait_sec': api.scheduler.waitTime}))
+
+
+def print_report(results: list):
+    print('%-22s %8s %10s %11s %10s %12s %12s %10s' % ('Scenario', 'Users', 'Seconds', 'Users/sec', 'Calls/user',
+                                                        'Limit wait', 'Sync wait', 'Peak RSS'))
+    for r in results:
+        limit_wait = '-' if r['limit_wait_sec'] is None else '%.1f' % r['limit_wait_sec']
+        sync_wait = '-' if r['sync_wait_sec'] is None else '%.1f' % r['sync_wait_sec']
+        print('%-22s %8s %10.1f %11.1f %10.2f %12s %12s %8.1fMB%s' %
+              (r['scenario'], r['users'], r['seconds'], r['users_per_sec'], r['calls_per_user'], limit_wait,
+               sync_wait, r['peak_rss_mb'], '' if r['exit_code'] == 0 else '  (exit code %s, see %s)' %
+               (r['exit_code'], r['log'])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark create_users_from_csv.py and QualysAPI against the mock '
+                                                 'Qualys API server')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10000, 100000],
+                        help='Numbers of users to create (default 100 10000 100000)')
+    parser.add_argument('--scenarios', nargs='+', choices=['script', 'api'], default=['script', 'api'],
+                        help='Run the full create_users_from_csv.py pipeline ("script") and/or QualysAPI create calls '
+                             'alone ("api")')
+    parser.add_argument('-w', '--workers', type=int, default=8, help='Parallel create workers (default 8)')
+    parser.add_argument('--page_size', type=int, default=100, help='Search page size (default 100)')
+    parser.add_argument('--latency', type=float, default=0.01, help='Mock server seconds per call (default 0.01)')
+    parser.add_argument('--sync_delay', type=float, default=1.0,
+                        help='Mock server seconds before created users are visible (default 1)')
+    parser.add_argument('--rate_limit', type=int, default=1000000, help='Mock server calls per window (default 1000000)')
+    parser.add_argument('--rate_window', type=int, default=3600, help='Mock server rate window seconds (default 3600)')
+    parser.add_argument('--concurrency_limit', type=int, default=10,
+                        help='Mock server concurrent call limit (default 10)')
+    parser.add_argument('--json', help='Also write the results to this file as JSON')
+    parser.add_argument('--api_scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.api_scenario is not None:
+        api_scenario(args.api_scenario, args.sizes[0], args.workers)
+        sys.exit(0)
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes:
+            if 'script' in args.scenarios:
+                results.append(bench_script(args, size, workdir))
+            if 'api' in args.scenarios:
+                results.append(bench_api(args, size, workdir))
+        print_report(results)
+        failed = [r for r in results if r['exit_code'] != 0]
+        for r in failed:
+            with open(r['log'], 'r') as f:
+                print('\n%s with %s users failed, last output:\n%s' % (r['scenario'], r['users'], f.read()[-2000:]))
+
+    if args.json is not None:
+        for r in results:
+            del r['log']
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,415 @@
+import argparse
+import gzip
+import json
+import re
+import secrets
+import threading
+import xml.etree.ElementTree as ET
+from bisect import bisect_right
+from collections import deque, namedtuple
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import sleep, monotonic
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+
+# A local stand-in for the parts of the Qualys API used by create_users_from_csv.py, for measuring throughput without
+# a live subscription:
+#   POST /msp/user.php?action=add             Create a user, which becomes visible to searches after sync_delay seconds
+#   POST /msp/user.php?action=edit            Change a user's profile
+#   POST /msp/user.php?action=deactivate      Deactivate a user
+#   POST /qps/rest/2.0/search/am/user         Search users (XML or JSON), with limitResults/startFromOffset paging
+#   POST /qps/rest/2.0/count/am/user          Count the users matching the filters (JSON)
+#   POST /qps/rest/2.0/update/am/user/{id}    Add and remove roles and scope tags of a user
+#   POST /qps/rest/2.0/update/am/user         Add and remove roles and scope tags of the users matching id EQUALS/IN
+#                                             filters
+#   POST /qps/rest/2.0/search/am/role         List the roles (JSON)
+#   POST /qps/rest/2.0/search/am/tag          Search tags by id EQUALS/IN filters (JSON), tags 1000-1999 exist
+#   GET  /mock/stats                          Call counts and other statistics, as JSON
+# Every API response carries X-RateLimit-* and X-Concurrency-Limit-* headers, and calls over either limit are
+# rejected with HTTP 409 as the real API does.
+
+
+# The user.php parameters of the profile fields, and the names of the fields in search results
+PROFILE_FIELDS = {'first_name': 'firstName', 'last_name': 'lastName', 'email': 'emailAddress',
+                  'external_id': 'externalId', 'title': 'title', 'phone': 'phone'}
+
+ServiceRequest = namedtuple('ServiceRequest', ['criteria', 'offset', 'limit', 'add_roles', 'add_tags', 'remove_roles',
+                                               'remove_tags'])
+
+ROLES = ['Reader', 'Scanner', 'Manager', 'Unit Manager', 'Remediation User', 'Contact']
+TAG_IDS = range(1000, 2000)
+
+
+class MockQualysState:
+    """The users and limit counters of a mock subscription, shared by all request handler threads"""
+
+    def __init__(self, latency: float = 0.0, sync_delay: float = 2.0, rate_limit: int = 1000000,
+                 rate_window: int = 3600, concurrency_limit: int = 10):
+        self.latency = latency
+        self.sync_delay = sync_delay
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.concurrency_limit = concurrency_limit
+        self.lock = threading.Lock()
+        self.running = 0
+        self.window_start = monotonic()
+        self.window_calls = 0
+        self.next_id = 1000
+        # Users which have been created but are not yet visible to searches, oldest first
+        self.unsynced = deque()
+        self.by_id = {}
+        self.ids = []
+        self.by_username = {}
+        self.emails = set()
+        self.calls = {}
+        self.rejected = 0
+
+    def limit_headers(self):
+        # Called with the lock held, returns the headers and whether the call is over a limit
+        now = monotonic()
+        if now - self.window_start >= self.rate_window:
+            self.window_start = now
+            self.window_calls = 0
+        self.window_calls += 1
+        headers = {
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Window-Sec': str(self.rate_window),
+            'X-RateLimit-Remaining': str(max(0, self.rate_limit - self.window_calls)),
+            'X-Concurrency-Limit-Limit': str(self.concurrency_limit),
+            'X-Concurrency-Limit-Running': str(self.running),
+        }
+        rejected = False
+        if self.window_calls > self.rate_limit:
+            headers['X-RateLimit-ToWait-Sec'] = str(int(self.rate_window - (now - self.window_start)) + 1)
+            rejected = True
+        elif self.running > self.concurrency_limit:
+            rejected = True
+        else:
+            headers['X-RateLimit-ToWait-Sec'] = '0'
+        return headers, rejected
+
+    def sync(self):
+        # Called with the lock held, makes users whose sync delay has passed visible to searches
+        now = monotonic()
+        while len(self.unsynced) > 0 and self.unsynced[0][0] <= now:
+            user = self.unsynced.popleft()[1]
+            self.next_id += 1
+            user['id'] = self.next_id
+            self.by_id[user['id']] = user
+            self.ids.append(user['id'])
+            self.by_username[user['username']] = user
+
+    def add_user(self, params: dict):
+        with self.lock:
+            email = params.get('email', '').lower()
+            if email in self.emails:
+                return None
+            self.emails.add(email)
+            login = 'quays%s' % secrets.token_hex(4)
+            while login in self.by_username:
+                login = 'quays%s' % secrets.token_hex(4)
+            user = {field: params.get(param, '') for param, field in PROFILE_FIELDS.items()}
+            user.update({'username': login, 'status': 'ACTIVE', 'roleList': [], 'scopeTags': []})
+            self.unsynced.append((monotonic() + self.sync_delay, user))
+            return login
+
+    def matching_ids(self, criteria: list):
+        # The IDs of the visible users matching the filter criteria, in ID order.  Called with the lock held
+        self.sync()
+        ids = self.ids
+        for field, operator, value in criteria:
+            if field == 'id' and operator == 'GREATER':
+                ids = ids[bisect_right(ids, int(value)):] if ids is self.ids else [i for i in ids if i > int(value)]
+            elif field == 'id':
+                wanted = set(int(v) for v in value.split(','))
+                ids = [i for i in ids if i in wanted]
+            elif field == 'username':
+                wanted = value.split(',')
+                ids = sorted(set(self.by_username[u]['id'] for u in wanted if u in self.by_username) & set(ids))
+            else:
+                key = {'emailAddress': 'emailAddress', 'externalId': 'externalId'}.get(field, field)
+                wanted = set(value.split(','))
+                ids = [i for i in ids if self.by_id[i].get(key) in wanted]
+        return ids
+
+    def search(self, criteria: list, offset: int, limit: int):
+        with self.lock:
+            ids = self.matching_ids(criteria)
+            page = [dict(self.by_id[i]) for i in ids[offset:offset + limit]]
+            return page, offset + limit < len(ids)
+
+    def count(self, criteria: list):
+        with self.lock:
+            return len(self.matching_ids(criteria))
+
+    def update(self, user_id: int, request: ServiceRequest):
+        with self.lock:
+            user = self.by_id.get(user_id)
+            if user is None:
+                return False
+            user['roleList'] = sorted((set(user['roleList']) | set(request.add_roles)) - set(request.remove_roles))
+            user['scopeTags'] = sorted((set(user['scopeTags']) | set(request.add_tags)) - set(request.remove_tags))
+            return True
+
+    def edit_user(self, params: dict):
+        # Returns False if there is no user with the given login
+        with self.lock:
+            user = self.by_username.get(params.get('login'))
+            if user is None:
+                return False
+            if params.get('action') == 'deactivate':
+                user['status'] = 'INACTIVE'
+            for param, field in PROFILE_FIELDS.items():
+                if param in params:
+                    if param == 'email':
+                        self.emails.discard(user['emailAddress'].lower())
+                        self.emails.add(params[param].lower())
+                    user[field] = params[param]
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'total_calls': sum(self.calls.values()), 'rejected': self.rejected,
+                    'users': len(self.by_id) + len(self.unsynced)}
+
+
+def parse_service_request(body: bytes, content_type: str) -> ServiceRequest:
+    # Parse a JSON or XML ServiceRequest
+    if 'json' in content_type:
+        request = json.loads(body)['ServiceRequest']
+        criteria = [(c['field'], c['operator'], str(c['value'])) for c in request.get('filters', {}).get('Criteria', [])]
+        preferences = request.get('preferences', {})
+        user = request.get('data', {}).get('User', {})
+
+        def names(section, change, data, key):
+            return [str(d[key]) for d in (user.get(section) or {}).get(change, {}).get(data, [])]
+
+        return ServiceRequest(criteria, int(preferences.get('startFromOffset', 0)),
+                              int(preferences.get('limitResults', 100)), names('roleList', 'add', 'RoleData', 'name'),
+                              names('scopeTags', 'add', 'TagData', 'id'), names('roleList', 'remove', 'RoleData', 'name'),
+                              names('scopeTags', 'remove', 'TagData', 'id'))
+    request = ET.fromstring(body) if body else ET.Element('ServiceRequest')
+    criteria = [(c.get('field'), c.get('operator'), c.text or '') for c in request.iter('Criteria')]
+    return ServiceRequest(criteria, int(request.findtext('.//startFromOffset') or 0),
+                          int(request.findtext('.//limitResults') or 100),
+                          [r.text for r in request.iterfind('.//roleList/add/RoleData/name')],
+                          [t.text for t in request.iterfind('.//scopeTags/add/TagData/id')],
+                          [r.text for r in request.iterfind('.//roleList/remove/RoleData/name')],
+                          [t.text for t in request.iterfind('.//scopeTags/remove/TagData/id')])
+
+
+def user_xml(user: dict) -> str:
+    roles = ''.join('<RoleData><name>%s</name></RoleData>' % escape(r) for r in user['roleList'])
+    tags = ''.join('<TagData><id>%s</id></TagData>' % escape(t) for t in user['scopeTags'])
+    fields = ''.join('<%s>%s</%s>' % (k, escape(str(user[k])), k)
+                     for k in ['id', 'username', 'status'] + list(PROFILE_FIELDS.values()))
+    return '<User>%s<roleList><list>%s</list></roleList><scopeTags><list>%s</list></scopeTags></User>' % \
+        (fields, roles, tags)
+
+
+class MockQualysHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state: MockQualysState
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, body: str, content_type: str, headers: dict = None):
+        data = body.encode('utf-8')
+        compressed = len(data) > 1024 and 'gzip' in self.headers.get('Accept-Encoding', '')
+        if compressed:
+            data = gzip.compress(data, compresslevel=5)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/mock/stats':
+            self.send_body(200, json.dumps(self.state.stats()), 'application/json')
+        else:
+            self.send_body(404, 'Not found', 'text/plain')
+
+    def do_POST(self):
+        state = self.state
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = urlparse(self.path).path
+        endpoint = re.sub(r'/\d+$', '', path)
+        with state.lock:
+            state.running += 1
+            state.calls[endpoint] = state.calls.get(endpoint, 0) + 1
+            headers, rejected = state.limit_headers()
+            if rejected:
+                state.rejected += 1
+        try:
+            if rejected:
+                self.send_body(409, '<SIMPLE_RETURN><RESPONSE><CODE>1960</CODE><TEXT>Limit exceeded</TEXT>'
+                                    '</RESPONSE></SIMPLE_RETURN>', 'text/xml', headers)
+                return
+            if state.latency > 0:
+                sleep(state.latency)
+            if path == '/msp/user.php':
+                self.user_php(body, headers)
+            elif path == '/qps/rest/2.0/search/am/user':
+                self.search_users(body, headers)
+            elif path == '/qps/rest/2.0/count/am/user':
+                criteria = parse_service_request(body, self.headers.get('Content-Type', '')).criteria
+                self.send_body(200, json.dumps({'ServiceResponse': {'responseCode': 'SUCCESS',
+                                                                    'count': self.state.count(criteria)}}),
+                               'application/json', headers)
+            elif path.startswith('/qps/rest/2.0/update/am/user/'):
+                self.update_user(int(path.rsplit('/', 1)[1]), body, headers)
+            elif path == '/qps/rest/2.0/update/am/user':
+                self.update_users(body, headers)
+            elif path == '/qps/rest/2.0/search/am/role':
+                data = [{'Role': {'id': i + 1, 'name': name}} for i, name in enumerate(ROLES)]
+                self.send_body(200, json.dumps({'ServiceResponse': {'responseCode': 'SUCCESS', 'count': len(data),
+                                                                    'hasMoreRecords': 'false', 'data': data}}),
+                               'application/json', headers)
+            elif path == '/qps/rest/2.0/search/am/tag':
+                criteria = parse_service_request(body, self.headers.get('Content-Type', '')).criteria
+                ids = [int(v) for field, _, value in criteria if field == 'id' for v in value.split(',')]
+                data = [{'Tag': {'id': i, 'name': 'Tag %s' % i}} for i in ids if i in TAG_IDS]
+                self.send_body(200, json.dumps({'ServiceResponse': {'responseCode': 'SUCCESS', 'count': len(data),
+                                                                    'hasMoreRecords': 'false', 'data': data}}),
+                               'application/json', headers)
+            else:
+                self.send_body(404, 'Not found', 'text/plain', headers)
+        finally:
+            with state.lock:
+                state.running -= 1
+
+    def user_php(self, body: bytes, headers: dict):
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        params.update({k: v[0] for k, v in parse_qs(body.decode('utf-8')).items()})
+        if params.get('action') in ['edit', 'deactivate']:
+            if self.state.edit_user(params):
+                result = '<RETURN status="SUCCESS"><MESSAGE>user %s updated</MESSAGE></RETURN>' % \
+                         escape(params['login'])
+            else:
+                result = '<RETURN status="FAILED" number="2002"><MESSAGE>User %s not found</MESSAGE></RETURN>' % \
+                         escape(params.get('login', ''))
+        elif params.get('action') != 'add':
+            result = '<RETURN status="FAILED" number="999"><MESSAGE>Unsupported action</MESSAGE></RETURN>'
+        else:
+            login = self.state.add_user(params)
+            if login is None:
+                result = '<RETURN status="FAILED" number="2003"><MESSAGE>A user with this email address already ' \
+                         'exists</MESSAGE></RETURN>'
+            else:
+                result = '<RETURN status="SUCCESS"><MESSAGE>user %s added</MESSAGE></RETURN><USER><USER_LOGIN>%s' \
+                         '</USER_LOGIN><PASSWORD>%s</PASSWORD></USER>' % (login, login, secrets.token_urlsafe(12))
+        self.send_body(200, '<?xml version="1.0" encoding="UTF-8" ?><USER_OUTPUT><API name="user.php" '
+                            'username="mock" at="now" />%s</USER_OUTPUT>' % result, 'text/xml', headers)
+
+    def search_users(self, body: bytes, headers: dict):
+        content_type = self.headers.get('Content-Type', '')
+        request = parse_service_request(body, content_type)
+        page, more = self.state.search(request.criteria, request.offset, request.limit)
+        if 'json' in self.headers.get('Accept', ''):
+            response = {'ServiceResponse': {'responseCode': 'SUCCESS', 'count': len(page),
+                                            'hasMoreRecords': 'true' if more else 'false'}}
+            if len(page) > 0:
+                for user in page:
+                    user['roleList'] = {'list': [{'RoleData': {'name': r}} for r in user['roleList']]}
+                    user['scopeTags'] = {'list': [{'TagData': {'id': t}} for t in user['scopeTags']]}
+                response['ServiceResponse']['data'] = [{'User': user} for user in page]
+            self.send_body(200, json.dumps(response), 'application/json', headers)
+        else:
+            self.send_body(200, '<?xml version="1.0" encoding="UTF-8"?><ServiceResponse>'
+                                '<responseCode>SUCCESS</responseCode><count>%s</count>'
+                                '<hasMoreRecords>%s</hasMoreRecords><data>%s</data></ServiceResponse>' %
+                           (len(page), 'true' if more else 'false', ''.join(user_xml(u) for u in page)),
+                           'application/xml', headers)
+
+    def update_user(self, user_id: int, body: bytes, headers: dict):
+        if self.state.update(user_id, parse_service_request(body, self.headers.get('Content-Type', ''))):
+            response = {'ServiceResponse': {'responseCode': 'SUCCESS', 'count': 1, 'data': [{'User': {'id': user_id}}]}}
+        else:
+            response = {'ServiceResponse': {'responseCode': 'NOT_FOUND', 'count': 0, 'responseErrorDetails': {
+                'errorMessage': 'User %s not found' % user_id, 'errorResolution': 'Check the user ID'}}}
+        self.send_body(200, json.dumps(response), 'application/json', headers)
+
+    def update_users(self, body: bytes, headers: dict):
+        request = parse_service_request(body, self.headers.get('Content-Type', ''))
+        ids = []
+        for field, operator, value in request.criteria:
+            if field == 'id' and operator in ['EQUALS', 'IN']:
+                ids += [int(v) for v in value.split(',')]
+        if len(ids) == 0:
+            response = {'ServiceResponse': {'responseCode': 'INVALID_REQUEST', 'count': 0, 'responseErrorDetails': {
+                'errorMessage': 'Bulk updates need an id filter', 'errorResolution': 'Add an id filter'}}}
+        else:
+            updated = [user_id for user_id in ids if self.state.update(user_id, request)]
+            response = {'ServiceResponse': {'responseCode': 'SUCCESS', 'count': len(updated),
+                                            'data': [{'User': {'id': user_id}} for user_id in updated]}}
+        self.send_body(200, json.dumps(response), 'application/json', headers)
+
+
+class MockQualysServer:
+    """Runs a mock subscription on a local port in a background thread
+
+    Class Members
+    =============
+
+    url             : String  : The base URL of the mock API (http://127.0.0.1:port)
+    state           : MockQualysState : The mock subscription's users and counters
+
+    Class Methods
+    =============
+
+    start()
+
+        Start serving requests, returns the object so it can be used as 'server = MockQualysServer().start()'
+
+    stop()
+
+        Stop serving requests
+    """
+
+    def __init__(self, port: int = 0, **settings):
+        self.state = MockQualysState(**settings)
+        handler = type('Handler', (MockQualysHandler,), {'state': self.state})
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self.httpd.daemon_threads = True
+        # Allow plenty of waiting connections, benchmarks open many at once
+        self.httpd.request_queue_size = 256
+        self.url = 'http://127.0.0.1:%s' % self.httpd.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the Qualys user management APIs')
+    parser.add_argument('--port', type=int, default=8443, help='Port to listen on, 0 for any free port (default 8443)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every API call (default 0)')
+    parser.add_argument('--sync_delay', type=float, default=2.0,
+                        help='Seconds before a created user is visible to searches (default 2)')
+    parser.add_argument('--rate_limit', type=int, default=1000000,
+                        help='Calls allowed per rate limit window (default 1000000)')
+    parser.add_argument('--rate_window', type=int, default=3600, help='Rate limit window in seconds (default 3600)')
+    parser.add_argument('--concurrency_limit', type=int, default=10, help='Concurrent calls allowed (default 10)')
+    args = parser.parse_args()
+
+    server = MockQualysServer(port=args.port, latency=args.latency, sync_delay=args.sync_delay,
+                              rate_limit=args.rate_limit, rate_window=args.rate_window,
+                              concurrency_limit=args.concurrency_limit)
+    # The first line of output is read by the benchmark suite to find the port
+    print('Listening on %s' % server.url, flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
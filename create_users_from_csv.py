@@ -2,34 +2,25 @@ import json
 import csv
 from xml.etree import ElementTree as ET
 import QualysAPI
+import api_responses
+from api_cache import ResponseCache
+import time_zones
+import provisioning_journal
+from provisioning_journal import ProvisioningJournal
+import output_writer
+from output_writer import OutputWriter
+import preflight
+import reconcile
+import request_plan
+import sharding
+from progress import Progress
 import argparse
 import sys
 import getpass
 import os.path
-from time import sleep
-
-
-def validate_api_response(response: ET.ElementTree):
-    if response.find('.//RETURN') is not None:
-        if response.find('.//RETURN').attrib['status'] == 'SUCCESS':
-            return 0, ''
-        else:
-            return 2, response.find('.//MESSAGE').text
-
-    elif response.find('.//responseCode') is not None:
-        if response.find('.//responseCode').text == 'SUCCESS':
-            return 0, ''
-        else:
-            return 2, response.find('.//errorMessage').text
-    else:
-        return 3, 'Unknown error'
-
-
-def validate_json_response(response: dict):
-    if response['ServiceResponse']['responseCode'] == 'SUCCESS':
-        return 0, ''
-    else:
-        return 2, f"{response['ServiceResponse']['responseErrorDetails']['errorMessage']}"
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import sleep, monotonic
 
 
 def my_quit(exitcode: int, errormsg: str = None):
@@ -42,7 +33,16 @@ def my_quit(exitcode: int, errormsg: str = None):
     sys.exit(exitcode)
 
 
+# The number of columns expected in each row of the input CSV file
+CSV_COLUMNS = 13
+
+
 class QualysUser:
+    # Users are streamed through the script in large numbers, so they are kept compact without a per-instance __dict__
+    __slots__ = ('forename', 'surname', 'email', 'title', 'phone', 'address1', 'city', 'country', 'external_id',
+                 'asset_groups', 'business_unit', 'time_zone_code', 'id', 'portal_role', 'scope_tags', 'username',
+                 'password', 'synced', 'created', 'portal_updated', 'existing')
+
     forename: str
     surname: str
     email: str
@@ -63,16 +63,15 @@ class QualysUser:
     synced: bool
     created: bool
     portal_updated: bool
+    existing: bool
 
     def __init__(self, forename: str = '', surname: str = '', title: str = '', phone: str = '', email: str = '',
                  address1: str = '', city: str = '', country: str = '', external_id: str = '', asset_groups=None,
                  business_unit: str = '', time_zone_code: str = '', id: str = '', portal_role=None, scope_tags=None,
                  username: str = '', user_password: str = '', synced: bool = False, created: bool = False,
-                 portal_updated: bool = False):
-        with open('time_zone_codes.json', 'r') as f:
-            tzdata = json.load(f)
-        f.close()
-        tzs = [tz['TIME_ZONE_CODE'] for tz in tzdata]
+                 portal_updated: bool = False, existing: bool = False):
+        # The time zone registry is loaded once and shared by every QualysUser
+        tzs = time_zones.get_time_zones()
         self.forename = forename
         self.surname = surname
         self.title = title
@@ -83,17 +82,22 @@ class QualysUser:
         self.country = country
         self.external_id = external_id
         if asset_groups is None:
-            asset_groups = []
+            self.asset_groups = []
         else:
             self.asset_groups = asset_groups
         if business_unit == '' or business_unit is None:
             self.business_unit = 'Unassigned'
         else:
             self.business_unit = business_unit
-        if time_zone_code not in tzs:
-            self.time_zone_code = ''
-        else:
+        if time_zone_code in tzs:
             self.time_zone_code = time_zone_code
+        else:
+            # Correct codes which only differ in case, otherwise leave the time zone unset
+            corrected = tzs.lookup(time_zone_code)
+            if corrected is None:
+                self.time_zone_code = ''
+            else:
+                self.time_zone_code = corrected
         self.id = id
         if portal_role is None:
             self.portal_role = []
@@ -108,6 +112,8 @@ class QualysUser:
         self.synced = synced
         self.created = created
         self.portal_updated = portal_updated
+        # True if the user was already in the subscription, so only needs its roles and scopes applying
+        self.existing = existing
 
     def create_url(self, baseurl: str, send_email: bool = False, user_role: str = 'reader'):
         url = '%s/msp/user.php' % baseurl
@@ -158,45 +164,615 @@ class QualysUser:
         return url, dict_payload
 
 
-def get_portal_users(api: QualysAPI.QualysAPI) -> list[dict]:
-    all_users = []
-    limit_results = 50
-    offset = 0
-
-    service_request = {
-        'ServiceRequest': {
-            'filters': {
-                'Criteria': [{
-                    'field': 'id',
-                    'operator': 'GREATER',
-                    'value': '0'
-                }]
-            },
-            'preferences': {
-                'limitResults': str(limit_results),
-            }
-        }
-    }
-    headers = {"Accept": "application/json", "Content-Type": "application/json"}
-    more_data = True
-    while more_data:
-        response = api.makeCall(url='%s/qps/rest/2.0/search/am/user' % (api.server),
-                                payload=json.dumps(service_request),
-                                headers=headers,
-                                method='POST',
-                                returnwith='json')
-        service_response = response['ServiceResponse']
-        if service_response['responseCode'] != 'SUCCESS':
-            pass
-        if 'hasMoreRecords' in service_response and service_response['hasMoreRecords'] == 'true':
-            more_data = True
+class PlannedUser(QualysUser):
+    # A user whose create call was planned by an earlier --no_call run, which is replayed exactly as it was planned
+    __slots__ = ('planned_url', 'planned_payload')
+
+    def __init__(self, planned_url: str, planned_payload: dict, **kwargs):
+        super().__init__(**kwargs)
+        self.planned_url = planned_url
+        self.planned_payload = planned_payload
+
+    def create_url(self, baseurl: str, send_email: bool = False, user_role: str = 'reader'):
+        return self.planned_url, self.planned_payload
+
+
+def row_key(user: QualysUser) -> str:
+    # The key which identifies a user's row across runs
+    return user.email.strip().lower()
+
+
+def read_rows(filename: str):
+    # Yield (line number, row) for each row of the CSV file, skipping comment lines
+    with open(filename, 'r') as inputfile:
+        csvreader = csv.reader(inputfile, delimiter=',', quotechar='"')
+        for row in csvreader:
+            if len(row) == 0 or row[0].find('#') > -1:
+                continue
+            yield csvreader.line_num, row
+
+
+def parse_users(rows, exit_on_error: bool = False):
+    # Yield a QualysUser for each row, reporting (and skipping) rows which do not have enough columns
+    for line_num, row in rows:
+        if len(row) < CSV_COLUMNS:
+            if exit_on_error:
+                my_quit(1, 'Line %s has %s columns, %s expected' % (line_num, len(row), CSV_COLUMNS))
+            print('ERROR: Line %s has %s columns, %s expected' % (line_num, len(row), CSV_COLUMNS))
+            continue
+        yield QualysUser(forename=row[0],
+                         surname=row[1],
+                         email=row[2],
+                         title=row[3],
+                         phone=row[4],
+                         address1=row[5],
+                         city=row[6],
+                         country=row[7],
+                         business_unit=row[8],
+                         time_zone_code=row[9],
+                         external_id=row[10],
+                         portal_role=row[11].split(';'),
+                         scope_tags=row[12].split(';'),
+                         id='',
+                         synced=False)
+
+
+def plan_users(filename: str, baseurl: str):
+    # Yield a PlannedUser for each request in a plan file written by --no_call, raising PlanError if the plan holds
+    # anything other than user creations for the API server given
+    for line_num, entry in request_plan.read_plan(filename):
+        payload = entry['payload']
+        if entry['method'] != 'POST' or entry['url'] != '%s/msp/user.php' % baseurl or \
+                not isinstance(payload, dict) or payload.get('action') != 'add':
+            raise request_plan.PlanError('%s line %s is not a user creation for %s' % (filename, line_num, baseurl))
+        yield PlannedUser(planned_url=entry['url'],
+                          planned_payload=payload,
+                          forename=payload.get('first_name', ''),
+                          surname=payload.get('last_name', ''),
+                          email=payload.get('email', ''),
+                          title=payload.get('title', ''),
+                          phone=payload.get('phone', ''),
+                          address1=payload.get('address1', ''),
+                          city=payload.get('city', ''),
+                          country=payload.get('country', ''),
+                          business_unit=payload.get('business_unit', ''),
+                          time_zone_code=payload.get('time_zone_code', ''),
+                          external_id=payload.get('external_id', ''),
+                          portal_role=entry.get('roles', []),
+                          scope_tags=entry.get('scope_tags', []),
+                          id='',
+                          synced=False)
+
+
+def resume_users(users, journal: ProvisioningJournal):
+    # Restore the progress recorded by earlier runs onto each user, leaving out users which are already finished
+    for user in users:
+        state = journal.state(row_key(user))
+        if state is None:
+            yield user
+            continue
+        if state['stage'] == provisioning_journal.UPDATED:
+            continue
+        user.username = state['username']
+        user.password = state['password']
+        user.created = True
+        # Users matched to an existing account were never given a password by this script
+        user.existing = state['password'] is None
+        if state['portal_id'] is not None:
+            user.id = state['portal_id']
+        yield user
+
+
+class PortalSearchError(Exception):
+    pass
+
+
+def search_request_xml(criteria: list, limit_results: int = 50, offset: int = 0) -> str:
+    # Build the XML ServiceRequest for a /qps/rest/2.0/search API call
+    service_request = ET.Element('ServiceRequest')
+    filters = ET.SubElement(service_request, 'filters')
+    for criterion in criteria:
+        ET.SubElement(filters, 'Criteria', field=criterion['field'], operator=criterion['operator']).text = \
+            criterion['value']
+    preferences = ET.SubElement(service_request, 'preferences')
+    ET.SubElement(preferences, 'limitResults').text = str(limit_results)
+    if offset > 0:
+        ET.SubElement(preferences, 'startFromOffset').text = str(offset)
+    return ET.tostring(service_request, encoding='unicode')
+
+
+def iter_portal_users(api: QualysAPI.QualysAPI, criteria: list = None, limit_results: int = 50, prefetch: int = 1,
+                      use_cache: bool = True):
+    # Generator yielding each portal user matching the given filter criteria (by default every user) in the same form
+    # as the entries of the JSON response's 'data' list.  With use_cache False the searches are never answered from
+    # the API object's cache.
+    # With prefetch 0 each page is parsed as it streams in, one User element at a time.  Otherwise the next 'prefetch'
+    # pages are fetched in the background while the caller works through the current one, so a full scan is not held
+    # up by the round trip for each page.  Pages after the first are requested as soon as a page reports that there
+    # are more records, which can mean up to prefetch - 1 calls past the last page.  At most prefetch + 1 pages are
+    # held in memory at once.
+    # A page which fails, reports an error or cannot be read raises PortalSearchError, so callers never mistake part of
+    # the list for all of it
+    if criteria is None:
+        criteria = [{'field': 'id', 'operator': 'GREATER', 'value': '0'}]
+    url = '%s/qps/rest/2.0/search/am/user' % (api.server)
+    headers = {"Accept": "application/xml", "Content-Type": "text/xml"}
+    streamtags = ['User', 'hasMoreRecords', 'responseCode', 'errorMessage']
+
+    def read_page(elements, page_offset):
+        # Yield each user on a page, then (None, more_data).  The status comes before the users and the message after
+        # it, so an error is raised at the end of the page, which holds no users
+        status = None
+        message = None
+        more = False
+        try:
+            for elem in elements:
+                if elem.tag == 'responseCode':
+                    status = (elem.text or '').strip()
+                elif elem.tag == 'errorMessage':
+                    message = (elem.text or '').strip()
+                elif elem.tag == 'hasMoreRecords':
+                    more = elem.text == 'true'
+                    yield None, more
+                else:
+                    yield {'User': QualysAPI.elementToDict(elem)}, more
+        except (ET.ParseError, OSError) as e:
+            raise PortalSearchError('User search at offset %s could not be read : %s' % (page_offset, e))
+        if status != 'SUCCESS':
+            raise PortalSearchError('User search at offset %s failed : %s' %
+                                    (page_offset, message or status or 'No response from API'))
+        yield None, more
+
+    if prefetch < 1:
+        offset = 0
+        more_data = True
+        while more_data:
+            more_data = False
+            elements = api.makeCall(url=url,
+                                    payload=search_request_xml(criteria=criteria, limit_results=limit_results,
+                                                               offset=offset),
+                                    headers=headers,
+                                    method='POST',
+                                    returnwith='xmlstream',
+                                    streamtags=streamtags,
+                                    useCache=use_cache)
+            for portal_user, more_data in read_page([] if elements is None else elements, offset):
+                if portal_user is not None:
+                    yield portal_user
             offset += limit_results
-            service_request['ServiceRequest']['preferences']['startFromOffset'] = str(offset)
+        return
+
+    def fetch_page(page_offset):
+        return api.makeCall(url=url,
+                            payload=search_request_xml(criteria=criteria, limit_results=limit_results,
+                                                       offset=page_offset),
+                            headers=headers,
+                            method='POST',
+                            returnwith='bytes',
+                            useCache=use_cache)
+
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        # The pages requested so far, in offset order
+        pages = deque([executor.submit(fetch_page, 0)])
+        next_offset = limit_results
+        try:
+            while len(pages) > 0:
+                page_offset = next_offset - limit_results * len(pages)
+                content = pages.popleft().result()
+                more_data = False
+                elements = [] if content is None else QualysAPI.iterElements([content], streamtags)
+                for portal_user, more_data in read_page(elements, page_offset):
+                    if portal_user is not None:
+                        yield portal_user
+                    elif more_data:
+                        # Start on the following pages before working through this one
+                        while len(pages) < prefetch:
+                            pages.append(executor.submit(fetch_page, next_offset))
+                            next_offset += limit_results
+                if not more_data:
+                    return
+                if len(pages) == 0:
+                    pages.append(executor.submit(fetch_page, next_offset))
+                    next_offset += limit_results
+        finally:
+            # Pages requested beyond the last one (or not needed because the caller stopped early) are dropped
+            for page in pages:
+                page.cancel()
+
+
+class PortalUserIndex:
+    """Index of the User records returned by the /qps/rest/2.0/search/am/user API, keyed by username, email address
+    (case-insensitive), external ID and name (case-insensitive) so that each lookup is a dictionary access rather than a
+    scan of the list.  Names shared by more than one portal user are not matched"""
+
+    def __init__(self, portal_users: list = None):
+        self.by_username = {}
+        self.by_email = {}
+        self.by_external_id = {}
+        self.by_name = {}
+        if portal_users is not None:
+            for portal_user in portal_users:
+                self.add(portal_user)
+
+    def add(self, portal_user: dict):
+        user = portal_user['User']
+        self.by_username[user['username']] = user
+        email = user.get('emailAddress', user.get('email'))
+        if email:
+            self.by_email[email.lower()] = user
+        if user.get('externalId'):
+            self.by_external_id[user['externalId']] = user
+        if user.get('firstName') or user.get('lastName'):
+            name = ((user.get('firstName') or '').lower(), (user.get('lastName') or '').lower())
+            # None marks a name which is not unique
+            self.by_name[name] = None if name in self.by_name else user
+
+    def __len__(self):
+        return len(self.by_username)
+
+    def __contains__(self, username):
+        return username in self.by_username
+
+    def get(self, username: str):
+        return self.by_username.get(username)
+
+    def find(self, username: str = None, email: str = None, external_id: str = None, forename: str = None,
+             surname: str = None):
+        # Return the first portal user matching any of the given keys, or None
+        if username and username in self.by_username:
+            return self.by_username[username]
+        if external_id and external_id in self.by_external_id:
+            return self.by_external_id[external_id]
+        if email and email.lower() in self.by_email:
+            return self.by_email[email.lower()]
+        if forename or surname:
+            return self.by_name.get(((forename or '').lower(), (surname or '').lower()))
+        return None
+
+
+def get_portal_user_index(api: QualysAPI.QualysAPI, criteria: list = None, limit_results: int = 50,
+                          prefetch: int = 1) -> PortalUserIndex:
+    return PortalUserIndex(iter_portal_users(api=api, criteria=criteria, limit_results=limit_results,
+                                             prefetch=prefetch))
+
+
+def partition_existing(users, portal_users: PortalUserIndex, match_names: bool = False):
+    # Mark users which are already in the subscription (matched by external ID or email address, and optionally by
+    # name) as existing, with their portal username and ID, so they skip creation and only have their roles and scopes
+    # applied.  Users which were already created by an earlier run are passed through unchanged
+    for user in users:
+        if not user.created:
+            if match_names:
+                portal_user = portal_users.find(email=user.email, external_id=user.external_id,
+                                                forename=user.forename, surname=user.surname)
+            else:
+                portal_user = portal_users.find(email=user.email, external_id=user.external_id)
+            if portal_user is not None:
+                user.username = portal_user['username']
+                user.id = str(portal_user['id'])
+                user.created = True
+                user.existing = True
+        yield user
+
+
+def portal_user_searches(pending_usernames, sync_mode: str = 'id', high_water: int = 0, batch_size: int = 50):
+    # Return the filter criteria for each search needed to find the pending users in the portal.
+    #   'username' : search for the pending usernames, batch_size names per search
+    #   'id'       : search for users with an ID above the highest ID seen so far (the high-water mark)
+    #   'full'     : search for every user in the subscription
+    if sync_mode == 'username':
+        usernames = sorted(pending_usernames)
+        return [[{'field': 'username', 'operator': 'IN', 'value': ','.join(usernames[i:i + batch_size])}]
+                for i in range(0, len(usernames), batch_size)]
+    if sync_mode == 'id':
+        return [[{'field': 'id', 'operator': 'GREATER', 'value': str(high_water)}]]
+    return [[{'field': 'id', 'operator': 'GREATER', 'value': '0'}]]
+
+
+def highest_user_id(api: QualysAPI.QualysAPI) -> int:
+    # The highest user ID in the subscription, found with a count of the users and a search for the last of them (search
+    # results come in ID order).  Users created after this call all have higher IDs, so it is a safe starting point for
+    # the 'id' sync mode.  Returns 0 (search from the start) if either call fails
+    criteria = [{'field': 'id', 'operator': 'GREATER', 'value': '0'}]
+    headers = {'Accept': 'application/json', 'Content-Type': 'text/xml'}
+    body = api.makeCall(url='%s/qps/rest/2.0/count/am/user' % api.server, payload=search_request_xml(criteria),
+                        headers=headers, returnwith='bytes', useCache=False)
+    try:
+        response = None if body is None else json.loads(body)
+    except ValueError:
+        response = None
+    result = api_responses.decode_json(response)
+    if result.error_code != 0:
+        return 0
+    count = int(response['ServiceResponse'].get('count') or 0)
+    if count == 0:
+        return 0
+    result = api_responses.decode_json(api.makeCall(url='%s/qps/rest/2.0/search/am/user' % api.server,
+                                                    payload=search_request_xml(criteria, limit_results=1,
+                                                                               offset=count - 1),
+                                                    headers=headers, returnwith='bytes', useCache=False))
+    if result.error_code != 0 or len(result.ids) == 0:
+        return 0
+    return int(result.ids[-1])
+
+
+def find_portal_users(api: QualysAPI.QualysAPI, pending_usernames, sync_mode: str = 'id', high_water: int = 0,
+                      page_size: int = 50, prefetch: int = 1):
+    # Returns a PortalUserIndex of the users found and the new high-water mark.  Created users appear in the portal on
+    # their own, so these searches are never answered from the cache
+    portal_users = PortalUserIndex()
+    for criteria in portal_user_searches(pending_usernames=pending_usernames, sync_mode=sync_mode,
+                                         high_water=high_water, batch_size=page_size):
+        for portal_user in iter_portal_users(api=api, criteria=criteria, limit_results=page_size, prefetch=prefetch,
+                                             use_cache=False):
+            portal_users.add(portal_user)
+            high_water = max(high_water, int(portal_user['User']['id']))
+    return portal_users, high_water
+
+
+def create_user(api: QualysAPI.QualysAPI, user: QualysUser, user_role: str = 'reader', send_email: bool = False):
+    # Generate the URL and payload from the user object
+    url, payload = user.create_url(baseurl=api.server, send_email=send_email, user_role=user_role)
+    # The status, login and password are picked out of the raw response in one pass
+    result = api_responses.decode_xml(api.makeCall(url=url, payload=payload, returnwith='bytes'))
+    if result.error_code != 0:
+        return result.error_code, result.message
+    if result.login is None or result.password is None:
+        return 3, 'No login or password in response'
+    # If it was successful, we record the username and password in the user object and set its 'created' attribute
+    user.username = result.login
+    user.password = result.password
+    user.created = True
+    return 0, ''
+
+
+def create_users(api: QualysAPI.QualysAPI, users, workers: int = 1, user_role: str = 'reader',
+                 exit_on_error: bool = False, max_in_flight: int = None, journal: ProvisioningJournal = None,
+                 progress: Progress = None):
+    # Generator which takes users from the 'users' iterable as it needs them and yields each user once its create call
+    # has finished, successful or not.  At most max_in_flight users (by default twice the number of workers) are held
+    # at any one time, so memory use does not depend on the number of users.  Users which are already created (by an
+    # earlier run) are passed straight through.
+    # Each worker only ever touches the QualysUser object it was given, so results always land on the right user.  The
+    # API object's scheduler holds workers back when the subscription's concurrency limit leaves no headroom.  If a
+    # Progress object is given, each user is counted as it leaves this stage
+    if max_in_flight is None:
+        max_in_flight = workers * 2
+    users = iter(users)
+    exhausted = False
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while True:
+                while not exhausted and len(in_flight) < max_in_flight:
+                    user = next(users, None)
+                    if user is None:
+                        exhausted = True
+                    elif user.created:
+                        if progress is not None:
+                            progress.count('create')
+                        yield user
+                    else:
+                        in_flight[executor.submit(create_user, api, user, user_role)] = user
+                if len(in_flight) == 0:
+                    return
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    user = in_flight.pop(future)
+                    error_code, error_message = future.result()
+                    if progress is not None:
+                        progress.count('create' if error_code == 0 else 'create_failed')
+                    if error_code == 0 and journal is not None:
+                        journal.record(row_key(user), provisioning_journal.CREATED, username=user.username,
+                                       password=user.password)
+                    # If the validated error code is not 0, there's an error
+                    if error_code > 0 and exit_on_error:
+                        # If we are running with "-x" or "--exit_on_error" then quit out with a sensible message
+                        my_quit(exitcode=error_code, errormsg='Could not create user %s %s (%s) : Reason (%s)' %
+                                                              (user.forename,
+                                                               user.surname,
+                                                               user.email,
+                                                               error_message))
+                    # Otherwise if there was an error, just report the error and continue
+                    elif error_code > 0:
+                        print('ERROR: Could not create user %s %s (%s) : Reason (%s)' % (user.forename, user.surname,
+                                                                                         user.email, error_message))
+                    else:
+                        print(f'\t{user.username} - {user.forename} {user.surname}')
+                    yield user
+        finally:
+            # If the pipeline is stopped early (an error, or Ctrl-C) cancel the calls which have not started yet, but
+            # let the calls already sent finish and record the users they created so a resumed run does not create
+            # them again
+            executor.shutdown(wait=True, cancel_futures=True)
+            if journal is not None:
+                for user in in_flight.values():
+                    if user.created:
+                        journal.record(row_key(user), provisioning_journal.CREATED, username=user.username,
+                                       password=user.password)
+
+
+def set_roles_and_scopes(api: QualysAPI.QualysAPI, user: QualysUser):
+    url, payload = user.set_role_and_scope_url(baseurl=api.server)
+    headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+    result = api_responses.decode_json(api.makeCall(url=url, payload=json.dumps(payload), method='POST',
+                                                    returnwith='bytes', headers=headers))
+    return result.error_code, '' if result.error_code == 0 else result.message
+
+
+def entitlement_signature(user: QualysUser):
+    # Users with the same signature are given exactly the same roles and scope tags, so can be updated together
+    return tuple(sorted(user.portal_role)), tuple(sorted(user.scope_tags))
+
+
+def bulk_role_and_scope_url(baseurl: str, users: list):
+    # The update for a group of users sharing one signature, applied to all of them through an 'id IN' filter
+    _, payload = users[0].set_role_and_scope_url(baseurl=baseurl)
+    payload['ServiceRequest']['filters'] = {
+        'Criteria': [{'field': 'id', 'operator': 'IN', 'value': ','.join(str(user.id) for user in users)}]
+    }
+    return '%s/qps/rest/2.0/update/am/user' % baseurl, payload
+
+
+def set_roles_and_scopes_bulk(api: QualysAPI.QualysAPI, users: list):
+    # Apply the same roles and scopes to a group of users with one call, returning a list of (user, error_code,
+    # error_message).  Users the bulk update does not report as updated are retried with one call each
+    url, payload = bulk_role_and_scope_url(baseurl=api.server, users=users)
+    headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+    result = api_responses.decode_json(api.makeCall(url=url, payload=json.dumps(payload), method='POST',
+                                                    returnwith='bytes', headers=headers))
+    updated = set(result.ids) if result.error_code == 0 else set()
+    results = []
+    for user in users:
+        if str(user.id) in updated:
+            results.append((user, 0, ''))
         else:
-            more_data = False
-        all_users += service_response['data']
+            error_code, error_message = set_roles_and_scopes(api=api, user=user)
+            results.append((user, error_code, error_message))
+    return results
+
+
+def update_roles_and_scopes(api: QualysAPI.QualysAPI, users: list, bulk_size: int = 100):
+    # Generator yielding (user, error_code, error_message) for each user once its roles and scopes have been applied.
+    # Users are grouped by the roles and scope tags they are given and each group is updated 'bulk_size' users per
+    # call, so the number of calls depends on the number of different entitlements rather than the number of users
+    groups = {}
+    for user in users:
+        groups.setdefault(entitlement_signature(user), []).append(user)
+    for group in groups.values():
+        for start in range(0, len(group), max(1, bulk_size)):
+            chunk = group[start:start + max(1, bulk_size)]
+            print(f'Setting roles & scopes for {len(chunk)} users')
+            if len(chunk) == 1:
+                error_code, error_message = set_roles_and_scopes(api=api, user=chunk[0])
+                yield chunk[0], error_code, error_message
+            else:
+                yield from set_roles_and_scopes_bulk(api=api, users=chunk)
+
+
+def sync_users(api: QualysAPI.QualysAPI, users, exit_on_error: bool = False, sleep_time: int = 15,
+               max_sleep_time: int = 120, sync_mode: str = 'id', page_size: int = 50, max_pending: int = 1000,
+               journal: ProvisioningJournal = None, prefetch: int = 1, stats: dict = None, bulk_size: int = 100,
+               progress: Progress = None, high_water: int = 0):
+    # Generator which takes created users from the 'users' iterable, waits for them to appear in the portal, applies
+    # their roles and scopes and yields each one (with portal_updated set to show whether that worked).  Users which
+    # were not created are ignored.  New users are taken from 'users' while waiting for the next check, so creation
+    # carries on during the wait, but no more than max_pending users are held at any one time.  Users which already
+    # have a portal ID (found by an earlier run) go straight to the roles and scopes update, as soon as max_pending of
+    # them are ready or the next check is due.  If a 'stats' dictionary is given, the time spent waiting for users to
+    # sync is added to its 'sync_wait' entry.  Roles and scopes are applied to up to 'bulk_size' users with identical
+    # entitlements per call (see update_roles_and_scopes).  If a Progress object is given, users are counted as they
+    # sync and as their roles and scopes are applied.
+    # In 'id' mode the searches start above 'high_water', which must be no higher than the ID of any user still to be
+    # found (see highest_user_id), so the first check does not page through the whole subscription
+    # The users waiting to sync are kept in a dictionary keyed by username, removing each one as it is processed, so
+    # each check only costs one lookup per pending user
+    users = iter(users)
+    exhausted = False
+    pending = {}
+    # In 'id' mode a user can show up in a search before it reaches this stage, after which the high-water mark has
+    # moved past it.  New portal users which were not pending are remembered here (most recent max_unclaimed only)
+    unclaimed = {}
+    max_unclaimed = max_pending * 10
+    wait_time = sleep_time
+    next_check = monotonic() + wait_time
+    while True:
+        users_to_sync = []
+        if len(pending) == 0:
+            # Nobody is waiting to sync, so the next check is timed from the next user to be created
+            next_check = monotonic() + wait_time
+        # Users which already have a portal ID count towards max_pending too, so a file of users found by an earlier
+        # run (or by --skip_existing) is updated max_pending at a time rather than all being held until the next check
+        while not exhausted and len(pending) + len(users_to_sync) < max_pending and monotonic() < next_check:
+            user = next(users, None)
+            if user is None:
+                exhausted = True
+            elif user.created and not user.synced:
+                if user.id != '':
+                    users_to_sync.append(user)
+                elif user.username in unclaimed:
+                    user.id = unclaimed.pop(user.username)
+                    users_to_sync.append(user)
+                else:
+                    pending[user.username] = user
 
-    return all_users
+        if progress is not None:
+            progress.pending_sync = len(pending)
+        # When the users ready for an update fill the room left, update them straight away rather than holding them
+        # until the next check, the pending users are checked for once their wait is over
+        ready_full = len(users_to_sync) > 0 and len(pending) + len(users_to_sync) >= max_pending
+        if len(pending) > 0 and not (ready_full and monotonic() < next_check):
+            print(f'{len(pending)} users not synced')
+            remaining = next_check - monotonic()
+            if remaining > 0:
+                print(f'Waiting {int(remaining)} seconds for sync')
+                sleep(remaining)
+                if stats is not None:
+                    stats['sync_wait'] = stats.get('sync_wait', 0.0) + remaining
+            print('Getting Portal Users')
+            try:
+                portal_users, high_water = find_portal_users(api=api, pending_usernames=pending.keys(),
+                                                             sync_mode=sync_mode, high_water=high_water,
+                                                             page_size=page_size, prefetch=prefetch)
+            except PortalSearchError as e:
+                # Nothing from a failed check is used (and the high-water mark stays put), the pending users are
+                # looked for again at the next check
+                if exit_on_error:
+                    my_quit(exitcode=1, errormsg=str(e))
+                print(f'ERROR: {e}, checking again later')
+                portal_users = PortalUserIndex()
+            if sync_mode == 'id':
+                # Only new portal users are returned, so check each of them against the pending users
+                found = 0
+                for username, portal_user in portal_users.by_username.items():
+                    user = pending.pop(username, None)
+                    if user is None:
+                        unclaimed[username] = portal_user['id']
+                        if len(unclaimed) > max_unclaimed:
+                            del unclaimed[next(iter(unclaimed))]
+                    else:
+                        user.id = portal_user['id']
+                        users_to_sync.append(user)
+                        found += 1
+            else:
+                found_users = [u for username, u in pending.items() if username in portal_users]
+                for user in found_users:
+                    del pending[user.username]
+                    user.id = portal_users.get(user.username)['id']
+                users_to_sync += found_users
+                found = len(found_users)
+
+            # Check less often while nothing new is showing up, and go back to the shortest interval once it does
+            if found == 0:
+                wait_time = min(max_sleep_time, wait_time * 2)
+            else:
+                wait_time = sleep_time
+            next_check = monotonic() + wait_time
+        elif len(users_to_sync) == 0:
+            if exhausted:
+                return
+            continue
+
+        if progress is not None:
+            progress.pending_sync = len(pending)
+            progress.count('sync', len(users_to_sync))
+        if journal is not None:
+            for user in users_to_sync:
+                journal.record(row_key(user), provisioning_journal.SYNCED, username=user.username, portal_id=user.id)
+        for user, error_code, error_message in update_roles_and_scopes(api=api, users=users_to_sync,
+                                                                       bulk_size=bulk_size):
+            user.synced = True
+            if progress is not None:
+                progress.count('update' if error_code == 0 else 'update_failed')
+            if error_code > 0:
+                print(f'ERROR: Could not update roles and scopes for {user.username}')
+                user.portal_updated = False
+                if exit_on_error:
+                    my_quit(exitcode=error_code, errormsg=error_message)
+            else:
+                user.portal_updated = True
+            yield user
 
 
 # Script entry point
@@ -208,32 +784,128 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output_file', help='Output file (usernames & passwords')
     parser.add_argument('-u', '--username', help='Qualys Username')
     parser.add_argument('-p', '--password', help='Qualys Password (use - for interactive input')
+    parser.add_argument('--password_env', metavar='VARIABLE',
+                        help='Read the Qualys Password from this environment variable instead of --password')
     parser.add_argument('-P', '--proxy_enable', action='store_true', help='Enable HTTPS proxy')
     parser.add_argument('-U', '--proxy_url', help='HTTPS proxy address')
     parser.add_argument('-a', '--apiurl', help='Qualys API URL (e.g. https://qualysapi.qualys.com)')
-    parser.add_argument('-n', '--no_call', action='store_true', help='Do not make API calls, write URLs to console')
+    parser.add_argument('-n', '--no_call', action='store_true',
+                        help='Do not make API calls, write the requests which would be made to a plan file')
+    parser.add_argument('--plan_file',
+                        help='Plan file written by --no_call, defaults to OUTPUT_FILE.plan.jsonl')
+    parser.add_argument('--replay', metavar='PLAN',
+                        help='Create the users in a plan file written by --no_call instead of reading a CSV file')
     parser.add_argument('-R', '--role', help='Default user role, defaults to "READER" ("SCANNER" | "READER" | "MANAGER")')
     parser.add_argument('-d', '--debug', action='store_true', help='Provide debugging output from API calls')
     parser.add_argument('-x', '--exit_on_error', action='store_true', help='Exit on error')
+    parser.add_argument('-t', '--time_zone_file',
+                        help='Time zone codes file, defaults to the time_zone_codes.json supplied with this script')
+    parser.add_argument('--sync_mode', choices=['id', 'username', 'full'], default='id',
+                        help='How to look for created users in the portal: users above the highest ID already seen '
+                             '("id", the default), the pending usernames ("username") or every user ("full")')
+    parser.add_argument('--page_size', type=int, default=50,
+                        help='Number of portal users requested per search call (default 50)')
+    parser.add_argument('--prefetch_pages', type=int, default=1,
+                        help='Number of search result pages fetched ahead (in parallel) while the current page is '
+                             'processed, 0 to fetch one page at a time (default 1)')
+    parser.add_argument('--sync_interval', type=int, default=15,
+                        help='Seconds to wait between checks for synced users (default 15), doubled each time no '
+                             'new users are found')
+    parser.add_argument('--max_sync_interval', type=int, default=120,
+                        help='Maximum seconds to wait between checks for synced users (default 120)')
+    parser.add_argument('--max_pending', type=int, default=1000,
+                        help='Maximum number of created users waiting to sync at any one time (default 1000)')
+    parser.add_argument('-F', '--output_format', choices=output_writer.FORMATS, default='text',
+                        help='Output file format, "text" ("* username, password" lines, the default), "csv" or '
+                             '"jsonl"')
+    parser.add_argument('-j', '--journal',
+                        help='Journal file recording the progress of each user, defaults to OUTPUT_FILE.journal')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='Resume an interrupted run from its journal, skipping work which has already been done')
+    parser.add_argument('-e', '--skip_existing', action='store_true',
+                        help='Fetch the existing users first and only apply roles/scopes to rows matching one of them '
+                             'by external ID or email address, instead of creating them again')
+    parser.add_argument('--match_names', action='store_true',
+                        help='With --skip_existing or --reconcile, also match rows to existing users by first and last name when the '
+                             'name is unique in the subscription')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Maximum number of users to create in parallel, limited by the subscription\'s '
+                             'concurrency limit (default 1)')
+    parser.add_argument('--validation_report',
+                        help='Where to write the JSON report of the checks made on the input file before any users '
+                             'are created, defaults to OUTPUT_FILE.validation.json')
+    parser.add_argument('--validate_only', action='store_true',
+                        help='Check the input file and write the validation report, without creating any users')
+    parser.add_argument('--skip_entitlement_check', action='store_true',
+                        help='Do not check that the role names and scope tag IDs in the input file exist')
+    parser.add_argument('--bulk_size', type=int, default=100,
+                        help='Maximum number of users with identical roles and scope tags updated by one API call, '
+                             '1 to update each user separately (default 100)')
+    parser.add_argument('--connect_timeout', type=float, default=10,
+                        help='Seconds to wait for a connection to the API server (default 10)')
+    parser.add_argument('--read_timeout', type=float, default=300,
+                        help='Seconds to wait for the API server to respond before abandoning a call (default 300). '
+                             'Searches are retried, user creation is not, in case the user was created')
+    parser.add_argument('--metrics_file',
+                        help='Write per-endpoint API call metrics (latency histograms, bytes, retries, limit waits) '
+                             'to this file as JSON at the end of the run')
+    parser.add_argument('--prometheus_file',
+                        help='Write the API call metrics to this file in the Prometheus text format, for the '
+                             'node_exporter textfile collector')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='Compare the file with the existing users and only make the changes needed: create '
+                             'missing users, update changed profiles and add/remove roles and scope tags')
+    parser.add_argument('--deactivate_missing', action='store_true',
+                        help='With --reconcile, deactivate users with an external ID who are not in the file')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='With --reconcile, print the changes which would be made without making them')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Split the file by email address between this many processes, which share the API '
+                             'limits, and merge their output into OUTPUT_FILE (default 1)')
+    parser.add_argument('--rate_lease_file',
+                        help='Share the API rate and concurrency limits with other runs (on this machine) using the '
+                             'same lease file')
+    parser.add_argument('--cache_dir',
+                        help='Cache the responses to user, role and tag searches in this directory, so runs started '
+                             'within --cache_ttl seconds of each other do not fetch them again')
+    parser.add_argument('--cache_ttl', type=float, default=300,
+                        help='Seconds a cached search response is used for (default 300)')
+    parser.add_argument('--cache_max_mb', type=float, default=64,
+                        help='Size in MB the cache is kept within, oldest responses first (default 64)')
+    parser.add_argument('--progress_interval', type=float, default=30,
+                        help='Seconds between progress lines showing users per second for each stage and the time '
+                             'left, 0 for none (default 30)')
+    parser.add_argument('--status_file',
+                        help='Write the progress of the run to this file as JSON every --status_interval seconds')
+    parser.add_argument('--status_interval', type=float, default=5,
+                        help='Seconds between writes of the status file (default 5)')
 
     # Process the passed arguments
     args = parser.parse_args()
 
     # Validate the configuration file
     # Validate the critical arguments
-    if args.filename is None or args.filename == '':
-        my_quit(1, 'CSV File Not Specified')
+    if args.replay is not None and args.replay != '':
+        if args.filename is not None and args.filename != '':
+            my_quit(1, '--replay and --filename cannot be used together')
+        if args.no_call or args.reconcile:
+            my_quit(1, '--replay cannot be used with --no_call or --reconcile')
+        if not os.path.isfile(args.replay):
+            my_quit(1, 'Plan file %s does not exist' % args.replay)
+    else:
+        if args.filename is None or args.filename == '':
+            my_quit(1, 'CSV File Not Specified')
 
-    if not os.path.exists(args.filename):
-        my_quit(1, 'CSV File %s does not exist' % args.filename)
+        if not os.path.exists(args.filename):
+            my_quit(1, 'CSV File %s does not exist' % args.filename)
 
-    if not os.path.isfile(args.filename):
-        my_quit(1, '%s is not a file' % args.filename)
+        if not os.path.isfile(args.filename):
+            my_quit(1, '%s is not a file' % args.filename)
 
     if args.username is None or args.username == '':
         my_quit(1, 'Username not specified')
 
-    if args.password is None or args.password == '':
+    if (args.password is None or args.password == '') and (args.password_env is None or args.password_env == ''):
         my_quit(1, 'Password not specified or - not used in password option')
 
     if args.proxy_enable and (args.proxy_url is None or args.proxy_url == ''):
@@ -245,6 +917,58 @@ if __name__ == '__main__':
     if args.output_file is None or args.output_file == '':
         my_quit(1, 'Output file not specified')
 
+    if args.time_zone_file is not None and args.time_zone_file != '':
+        if not os.path.isfile(args.time_zone_file):
+            my_quit(1, 'Time zone file %s does not exist' % args.time_zone_file)
+        time_zones.load_time_zones(path=args.time_zone_file)
+
+    if args.page_size < 1:
+        my_quit(1, 'Page size must be at least 1')
+
+    if args.prefetch_pages < 0:
+        my_quit(1, 'Number of pages to prefetch cannot be negative')
+
+    if args.sync_interval < 1 or args.max_sync_interval < args.sync_interval:
+        my_quit(1, 'Sync intervals must be at least 1 second, and the maximum no less than the initial interval')
+
+    if args.match_names and not (args.skip_existing or args.reconcile):
+        my_quit(1, '--match_names requires --skip_existing or --reconcile')
+
+    if args.reconcile and args.skip_existing:
+        my_quit(1, '--reconcile and --skip_existing cannot be used together')
+
+    # Without API calls there is no way to tell which users already exist, so the plan would recreate all of them
+    if args.no_call and (args.reconcile or args.skip_existing):
+        my_quit(1, '--no_call cannot be used with --reconcile or --skip_existing, use --reconcile --dry_run to review '
+                   'the changes instead')
+
+    if (args.deactivate_missing or args.dry_run) and not args.reconcile:
+        my_quit(1, '--deactivate_missing and --dry_run require --reconcile')
+
+    if args.max_pending < 1:
+        my_quit(1, 'Maximum pending users must be at least 1')
+
+    if args.workers < 1:
+        my_quit(1, 'Number of workers must be at least 1')
+
+    if args.bulk_size < 1:
+        my_quit(1, 'Bulk size must be at least 1')
+
+    if args.connect_timeout <= 0 or args.read_timeout <= 0:
+        my_quit(1, 'Timeouts must be greater than 0')
+
+    if args.shards < 1:
+        my_quit(1, 'Number of shards must be at least 1')
+
+    if args.cache_ttl <= 0 or args.cache_max_mb <= 0:
+        my_quit(1, 'Cache TTL and size must be greater than 0')
+
+    if args.progress_interval < 0 or args.status_interval <= 0:
+        my_quit(1, 'Progress interval cannot be negative and status interval must be greater than 0')
+
+    if args.shards > 1 and (args.no_call or args.reconcile or (args.replay is not None and args.replay != '')):
+        my_quit(1, '--shards cannot be used with --no_call, --reconcile or --replay')
+
     if args.role is None or args.role == '':
         args.role = 'reader'
     else:
@@ -254,121 +978,319 @@ if __name__ == '__main__':
             my_quit(1, f'User role not recognised - {args.role}')
 
     # Get the Password interactively if '-' is used in that argument
-    if args.password == '-':
+    if args.password_env is not None and args.password_env != '':
+        password = os.environ.get(args.password_env, '')
+        if password == '':
+            my_quit(1, 'Environment variable %s is not set' % args.password_env)
+    elif args.password == '-':
         password = getpass.getpass(prompt='Enter password : ')
     else:
         password = args.password
 
     # Process the configuration file
 
+    # Runs sharing a lease file (such as the shards of one run) take turns within the subscription's limits
+    if args.rate_lease_file is not None and args.rate_lease_file != '':
+        scheduler = QualysAPI.SharedRateLimitScheduler(leaseFile=args.rate_lease_file)
+    else:
+        scheduler = None
+
+    # Search responses can be shared with runs made shortly before or after this one
+    if args.cache_dir is not None and args.cache_dir != '':
+        cache = ResponseCache(directory=args.cache_dir, ttl=args.cache_ttl,
+                              max_bytes=int(args.cache_max_mb * 1024 * 1024))
+    else:
+        cache = None
+
+    # Keep a connection alive for each create worker, plus the searches running alongside them
+    pool_size = max(10, args.workers + args.prefetch_pages + 1)
     if args.proxy_enable:
         api = QualysAPI.QualysAPI(svr=args.apiurl, usr=args.username, passwd=password, enableProxy=args.proxy_enable,
-                                  proxy=args.proxy_url, debug=args.debug)
+                                  proxy=args.proxy_url, debug=args.debug, scheduler=scheduler, poolSize=pool_size,
+                                  connectTimeout=args.connect_timeout, readTimeout=args.read_timeout, cache=cache)
     else:
-        api = QualysAPI.QualysAPI(svr=args.apiurl, usr=args.username, passwd=password, debug=args.debug)
+        api = QualysAPI.QualysAPI(svr=args.apiurl, usr=args.username, passwd=password, debug=args.debug,
+                                  scheduler=scheduler, poolSize=pool_size, connectTimeout=args.connect_timeout,
+                                  readTimeout=args.read_timeout, cache=cache)
 
-    user_list = []
+    if args.replay is not None and args.replay != '':
+        # The plan was built from a file which had already been validated, but check every line of the plan before
+        # any users are created
+        try:
+            planned = sum(1 for _ in plan_users(filename=args.replay, baseurl=api.server))
+        except request_plan.PlanError as e:
+            my_quit(1, str(e))
+        print('Replaying %s requests from %s' % (planned, args.replay))
+        expected_users = planned
+        users = plan_users(filename=args.replay, baseurl=api.server)
+    else:
+        # Check the whole file before anything is changed, so bad rows are not found one API call at a time.  Role
+        # names and tag IDs are checked with one lookup each per run, which is skipped when no calls are to be made
+        print('Validating %s' % args.filename)
+        if args.no_call or args.skip_entitlement_check:
+            catalog = None
+        else:
+            catalog = preflight.EntitlementCatalog(api)
+        report = preflight.validate_rows(filename=args.filename, rows=read_rows(args.filename), columns=CSV_COLUMNS,
+                                         catalog=catalog)
+        if args.validation_report is None or args.validation_report == '':
+            args.validation_report = '%s.validation.json' % args.output_file
+        report.write(args.validation_report)
+        for issue in sorted(report.issues, key=lambda i: i.line):
+            print('%s: Line %s %s "%s" : %s' % (issue.severity.upper(), issue.line, issue.field, issue.value or '',
+                                               issue.message))
+        print('%s rows checked, %s rejected, report written to %s' % (report.rows, len(report.rejected_lines),
+                                                                      args.validation_report))
+        if args.exit_on_error and len(report.rejected_lines) > 0:
+            my_quit(1, '%s rows failed validation' % len(report.rejected_lines))
+        if args.deactivate_missing and len(report.rejected_lines) > 0:
+            # A rejected row still names someone who should have an account, so nothing can be deactivated safely
+            my_quit(1, '%s rows failed validation, fix them before using --deactivate_missing' %
+                    len(report.rejected_lines))
+        if args.validate_only:
+            my_quit(0, '')
 
-    # Open the CSV input file and start processing the contents into QualysUser objects, adding each to the list
-    # user_list
-    with open(args.filename, 'r') as inputfile:
-        csvreader = csv.reader(inputfile, delimiter=',', quotechar='"')
-        print('Creating users:')
-        for row in csvreader:
-            if row[0].find('#') > -1:
-                continue
-            user = QualysUser(forename=row[0],
-                              surname=row[1],
-                              email=row[2],
-                              title=row[3],
-                              phone=row[4],
-                              address1=row[5],
-                              city=row[6],
-                              country=row[7],
-                              business_unit=row[8],
-                              time_zone_code=row[9],
-                              external_id=row[10],
-                              portal_role=row[11].split(';'),
-                              scope_tags=row[12].split(';'),
-                              id='',
-                              synced=False)
-
-            # Generate the URL and payload from the user object
-            url, payload = user.create_url(baseurl=api.server, send_email=False, user_role=args.role)
-
-            # If we are not running with the "-n" or "--no-call" option, run the API call to create the user
-            if not args.no_call:
-                response = api.makeCall(url=url, payload=payload)
-                error_code, error_message = validate_api_response(response=response)
-                # If the validated error code is not 0, there's an error
-                if error_code > 0 and args.exit_on_error:
-                    # If we are running with "-x" or "--exit_on_error" then quit out with a sensible message
-                    my_quit(exitcode=error_code, errormsg='Could not create user %s %s (%s) : Reason (%s)' %
-                                                          (user.forename,
-                                                           user.surname,
-                                                           user.email,
-                                                           error_message))
-                # Otherwise if there was an error, just report the error and continue
-                elif error_code > 0:
-                    print('ERROR: Could not create user %s %s (%s) : Reason (%s)' % (user.forename, user.surname,
-                                                                                     user.email, error_message))
-                # Otherwise it was successful, so we record the username and password in the user object
-                # and set its 'created' attribute to True
-                else:
-                    user.username = response.find('.//USER_LOGIN').text
-                    user.password = response.find('.//PASSWORD').text
-                    print(f'\t{user.username} - {user.forename} {user.surname}')
-                    user.created = True
+        # Open the CSV input file and stream its contents through the pipeline, one stage feeding the next:
+        #   parse -> create -> wait for sync -> update roles and scopes
+        # Each stage holds a bounded number of users, so memory use stays flat however large the input file is.  Rows
+        # which failed validation are left out
+        users = parse_users(report.accepted(read_rows(args.filename)), exit_on_error=args.exit_on_error)
+        expected_users = report.rows - len(report.rejected_lines)
 
-            else:
-                # We're running with the "-n" or "--no_call" options, so don't run the API call, just output
-                # what we would have sent and the URL we would have sent it to
-                print('NO_CALL: Output URL and Payload\nURL: %s\nPAYLOAD: %s' % (url, payload))
+    if args.shards > 1:
+        # Split the rows which passed validation between shard processes by email address, so parsing and the API
+        # calls are spread over several cores.  The shards share one lease file so their combined calls stay within
+        # the subscription's limits, and their output is merged into the output file at the end
+        shard_dir = '%s.shards' % args.output_file
+        os.makedirs(shard_dir, exist_ok=True)
+        if not args.resume and any(provisioning_journal.unfinished(sharding.shard_file(shard_dir, i, 'journal')) > 0
+                                   for i in range(args.shards)):
+            my_quit(1, 'Shard journals already exist in %s, use --resume to continue the previous run or remove them' %
+                    shard_dir)
+        shard_rows = sharding.split_rows(report.accepted(read_rows(args.filename)), shard_dir, args.shards)
+        if args.rate_lease_file is None or args.rate_lease_file == '':
+            args.rate_lease_file = os.path.join(shard_dir, 'rate.lease')
+        print('Running %s shards (%s users) with logs in %s' % (args.shards, ', '.join(str(n) for n in shard_rows),
+                                                               shard_dir))
+        processes = sharding.start_shards(shard_dir=shard_dir, shards=args.shards, argv=sys.argv[1:],
+                                          password=password, lease_file=args.rate_lease_file,
+                                          metrics_file=args.metrics_file, prometheus_file=args.prometheus_file,
+                                          status_file=args.status_file)
+        interrupted = False
+        try:
+            sharding.wait_for_shards(processes)
+        except KeyboardInterrupt:
+            interrupted = True
+
+        # Whatever happened, collect the credentials the shards wrote before reporting
+        try:
+            writer = OutputWriter(filename=args.output_file, fmt=args.output_format)
+        except output_writer.OutputFileInUse as e:
+            my_quit(1, str(e))
+        merged = 0
+        with writer:
+            for i in range(args.shards):
+                if os.path.exists(sharding.shard_file(shard_dir, i, 'out')):
+                    merged += writer.append_output(sharding.shard_file(shard_dir, i, 'out'))
+        for i in range(args.shards):
+            for suffix in ['out', 'csv']:
+                if os.path.exists(sharding.shard_file(shard_dir, i, suffix)):
+                    os.remove(sharding.shard_file(shard_dir, i, suffix))
 
-            user_list.append(user)
+        logs = [sharding.ShardLog(sharding.shard_file(shard_dir, i, 'log')) for i in range(args.shards)]
+        for i, log in enumerate(logs):
+            for line in log.errors:
+                print('Shard %s: %s' % (i, line))
+        totals = [log.summary for log in logs if log.summary is not None]
+        print('Summary: %s users processed, %s API calls, %.1f seconds waiting for API limits, %.1f seconds waiting '
+              'for sync' % (sum(t[0] for t in totals), sum(t[1] for t in totals), sum(t[2] for t in totals),
+                            max([t[3] for t in totals], default=0.0)))
+        print('%s users written to %s' % (merged, args.output_file))
+        not_updated = [username for log in logs for username in log.not_updated]
+        print(f'{len(not_updated)} users did not have roles/scopes applied')
+        for username in not_updated:
+            print(username)
+        failed = [i for i, p in enumerate(processes) if p.returncode != 0]
+        for i in failed:
+            print('Shard %s exited with code %s, see %s' % (i, processes[i].returncode,
+                                                            sharding.shard_file(shard_dir, i, 'log')))
+        if interrupted or len(failed) > 0:
+            my_quit(1, 'Not every shard finished, run again with --resume to carry on')
+        my_quit(0, '')
 
-        # Check to make sure there we actually created users
-        if len(user_list) == 0:
+    if args.no_call:
+        # We're running with the "-n" or "--no_call" options, so don't run the API calls, just write the requests we
+        # would have sent to a plan file which can be reviewed and sent later with --replay
+        if args.plan_file is None or args.plan_file == '':
+            args.plan_file = '%s.plan.jsonl' % args.output_file
+        with request_plan.PlanWriter(args.plan_file) as plan_writer:
+            for user in users:
+                url, payload = user.create_url(baseurl=api.server, send_email=False, user_role=args.role)
+                plan_writer.write(key=row_key(user), method='POST', url=url, payload=payload, roles=user.portal_role,
+                                  scope_tags=user.scope_tags)
+        if plan_writer.count == 0:
             print('No users created, exiting')
             my_quit(0, '')
+        print('No API calls made, %s requests written to %s' % (plan_writer.count, args.plan_file))
+        my_quit(0, '')
 
-        if args.no_call:
-            my_quit(0, 'No API calls made, nothing to synchronize')
+    existing_users = None
+    if args.reconcile:
+        # Load the subscription's users once and work out the smallest set of changes which brings them into line
+        # with the file, before anything is changed.  Users to add go through the pipeline below as usual
+        print('Getting existing Portal Users')
+        try:
+            existing_users = get_portal_user_index(api=api, limit_results=args.page_size, prefetch=args.prefetch_pages)
+        except PortalSearchError as e:
+            my_quit(1, '%s, no changes made' % e)
+        print(f'{len(existing_users)} existing users found')
+        # Rows which failed validation are still people in the file, so their accounts are never deactivated
+        present = [(row[preflight.EMAIL] if len(row) > preflight.EMAIL else None,
+                    row[preflight.EXTERNAL_ID] if len(row) > preflight.EXTERNAL_ID else None)
+                   for line_num, row in read_rows(args.filename) if line_num in report.rejected_lines]
+        plan = reconcile.plan_changes(users=users, portal_users=existing_users, keep_roles=[args.role],
+                                      deactivate_missing=args.deactivate_missing, match_names=args.match_names,
+                                      present=present)
+        plan.print_summary(verbose=args.dry_run, bulk_size=args.bulk_size)
+        if args.dry_run:
+            my_quit(0, 'Dry run, no changes made')
+        users = iter(plan.adds)
+        expected_users = len(plan.adds)
 
-        # Now we need to start a cycle validating user synchronization
-        sleep_time = 15
-        while len([u for u in user_list if u.created and not u.synced]) > 0:
-            print(f'{len([u for u in user_list if u.created and not u.synced])} users not synced')
-            print(f'Waiting {sleep_time} seconds for sync')
-            sleep(sleep_time)
-            print('Getting Portal Users')
-            portal_users = get_portal_users(api=api)
-            users_to_sync = [u for u in user_list if u.username in [pu['User']['username'] for pu in portal_users] and not u.synced]
+    # Progress is recorded in the journal as each stage completes, so that an interrupted run can be resumed
+    if args.journal is None or args.journal == '':
+        args.journal = '%s.journal' % args.output_file
+    if os.path.exists(args.journal) and not args.resume:
+        # A journal left by a run which finished every user it recorded is not needed to resume anything
+        left = provisioning_journal.unfinished(args.journal)
+        if left > 0:
+            my_quit(1, 'Journal file %s holds %s unfinished users, use --resume to continue the previous run or '
+                       'remove the file' % (args.journal, left))
+        provisioning_journal.remove(args.journal)
+    journal = ProvisioningJournal(args.journal)
+    if args.resume:
+        counts = journal.counts()
+        print('Resuming from %s : %s users finished, %s created, %s synced, %s failed role/scope updates' %
+              (args.journal, counts.get(provisioning_journal.UPDATED, 0), counts.get(provisioning_journal.CREATED, 0),
+               counts.get(provisioning_journal.SYNCED, 0), counts.get(provisioning_journal.UPDATE_FAILED, 0)))
+        users = resume_users(users, journal)
+        if not args.reconcile:
+            # Users the earlier runs finished are left out
+            expected_users = max(0, expected_users - counts.get(provisioning_journal.UPDATED, 0))
 
-            for user in users_to_sync:
-                print(f'Processing {user.username}')
-                user.id = [u['User']['id'] for u in portal_users if u['User']['username'] == user.username][0]
-                print(f'\t\tSetting roles & scopes... ', end='')
-                url, payload = user.set_role_and_scope_url(baseurl=api.server)
-                headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
-                response = api.makeCall(url=url, payload=json.dumps(payload), method='POST', returnwith='json',
-                                        headers=headers)
-                error_code, error_message = validate_json_response(response)
-                if error_code > 0:
-                    print(f'\nERROR: Could not update roles and scopes for {user.username}')
-                    user.synced = True
-                    user.portal_updated = False
-                    if args.exit_on_error:
-                        my_quit(exitcode=error_code, errormsg=error_message)
-                else:
-                    user.synced = True
-                    user.portal_updated = True
-                    with open(args.output_file, 'a') as f:
-                        f.writelines([f'* {user.username}, {user.password}\n'])
-                    f.close()
-                    print('DONE')
-            print(f'{len([u for u in user_list if not u.synced])} users did not have roles/scopes'
-                  f' applied')
-            for u in [user for user in user_list if not user.synced]:
-                print(u.username)
+    if args.reconcile and len(plan.operations) > 0:
+        print('Updating existing users:')
+        failed_changes = 0
+        for operation, error_code, error_message in reconcile.apply_plan(api=api, plan=plan, workers=args.workers,
+                                                                         bulk_size=args.bulk_size):
+            if error_code != 0:
+                failed_changes += 1
+                print('ERROR: Could not %s %s (%s) : %s' % (operation.kind.replace('_', ' '), operation.key,
+                                                          operation.username, error_message))
+                if args.exit_on_error:
+                    journal.close()
+                    my_quit(1, 'Exit on error specified, exiting')
+        print('%s changes made to existing users, %s failed' % (len(plan.operations) - failed_changes,
+                                                               failed_changes))
+
+    if args.skip_existing:
+        # Fetch the subscription's users once, before any changes are made, so rows for people who already have an
+        # account only have their roles and scopes updated
+        print('Getting existing Portal Users')
+        try:
+            existing_users = get_portal_user_index(api=api, limit_results=args.page_size, prefetch=args.prefetch_pages)
+        except PortalSearchError as e:
+            journal.close()
+            my_quit(1, '%s, no users created' % e)
+        print(f'{len(existing_users)} existing users found')
+        users = partition_existing(users=users, portal_users=existing_users, match_names=args.match_names)
+
+    # In 'id' mode, created users are looked for above the highest user ID at the start of the run, taken from the users
+    # already loaded or found with one search.  A resumed run keeps the mark its first run started from, which is below
+    # every user it created
+    high_water = 0
+    if args.sync_mode == 'id':
+        recorded = journal.value('high_water')
+        if recorded is not None:
+            high_water = int(recorded)
+        elif args.resume and journal.counts().get(provisioning_journal.CREATED, 0) > 0:
+            # Users created by a run which did not record its mark could have any ID, so search from the start
+            high_water = 0
+        else:
+            if existing_users is not None:
+                high_water = max([int(u['id']) for u in existing_users.by_username.values()], default=0)
+            else:
+                high_water = highest_user_id(api)
+            journal.set_value('high_water', high_water)
+
+    run_stats = {'sync_wait': 0.0}
+    # The pipeline stages count the users passing through them, and a background thread reports the rates and the time
+    # left from those counts
+    progress = Progress(scheduler=api.scheduler, total=expected_users, interval=args.progress_interval,
+                        status_file=args.status_file or None, status_interval=args.status_interval)
+    print('Creating users:')
+    created = create_users(api=api, users=users, workers=args.workers, user_role=args.role,
+                           exit_on_error=args.exit_on_error, journal=journal, progress=progress)
+    updated = sync_users(api=api, users=created, exit_on_error=args.exit_on_error, sleep_time=args.sync_interval,
+                         max_sleep_time=args.max_sync_interval, sync_mode=args.sync_mode, page_size=args.page_size,
+                         max_pending=args.max_pending, journal=journal, prefetch=args.prefetch_pages,
+                         stats=run_stats, bulk_size=args.bulk_size, progress=progress, high_water=high_water)
+
+    # Users are only recorded as finished once their credentials have been flushed to disk by the output writer
+    def record_updated(keys):
+        for key in keys:
+            journal.record(key, provisioning_journal.UPDATED)
+
+    try:
+        writer = OutputWriter(filename=args.output_file, fmt=args.output_format, on_flush=record_updated)
+    except output_writer.OutputFileInUse as e:
+        journal.close()
+        my_quit(1, str(e))
+
+    not_updated = []
+    user_count = 0
+    existing_count = 0
+    progress.start()
+    try:
+        for user in updated:
+            user_count += 1
+            if user.portal_updated and user.existing:
+                # There are no new credentials to write for users who already had an account
+                existing_count += 1
+                journal.record(row_key(user), provisioning_journal.UPDATED)
+            elif user.portal_updated:
+                writer.write(user, key=row_key(user))
+            else:
+                journal.record(row_key(user), provisioning_journal.UPDATE_FAILED)
+                not_updated.append(user.username)
+    finally:
+        # Close the pipeline first so the users created by calls still in flight are recorded
+        updated.close()
+        created.close()
+        writer.close()
+        journal.close()
+        progress.stop()
+        api.metrics.add_time('sync_wait', run_stats['sync_wait'])
+        if args.metrics_file is not None and args.metrics_file != '':
+            api.metrics.write_json(args.metrics_file)
+        if args.prometheus_file is not None and args.prometheus_file != '':
+            api.metrics.write_prometheus(args.prometheus_file)
+
+    print('Summary: %s users processed, %s API calls, %.1f seconds waiting for API limits, %.1f seconds waiting for '
+          'sync' % (user_count, api.callCount, api.scheduler.waitTime, run_stats['sync_wait']))
+    # Once every user recorded in the journal is finished it has nothing left to resume, and it holds passwords
+    if provisioning_journal.unfinished(args.journal) == 0:
+        provisioning_journal.remove(args.journal)
+    if cache is not None:
+        print('API cache: %s searches answered from %s, %s made' % (cache.hits, args.cache_dir, cache.misses))
+
+    # Check to make sure there we actually created users
+    if user_count == 0:
+        print('No users created, exiting')
+        my_quit(0, '')
 
+    if existing_count > 0:
+        print(f'{existing_count} users already existed and only had roles/scopes applied')
+    print(f'{len(not_updated)} users did not have roles/scopes applied')
+    for username in not_updated:
+        print(username)
@@ -0,0 +1,272 @@
+import argparse
+import getpass
+import json
+import os
+import subprocess
+import sys
+from time import monotonic, sleep
+import QualysAPI
+
+try:
+    import yaml
+except ImportError:  # PyYAML is optional, JSON job specs work without it
+    yaml = None
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'create_users_from_csv.py')
+
+# Target keys handled here rather than passed on to create_users_from_csv.py as --<key> options
+SPECIAL_KEYS = ['name', 'pod', 'password', 'password_env']
+
+# Options holding input files, which are relative to the job spec rather than the current directory
+INPUT_KEYS = ['filename', 'replay', 'time_zone_file']
+
+
+class SpecError(Exception):
+    pass
+
+
+class Target:
+    """One subscription a job provisions into, run as its own create_users_from_csv.py process so that it has its own
+    API session, rate and concurrency limit state, journal, output file and log
+
+    Class Members
+    =============
+
+    name            : String  : The target's name, used for its output and log files
+    apiurl          : String  : The API URL of the target's platform
+    username        : String  : The Qualys username used for the target
+    command         : List    : The create_users_from_csv.py command line
+    env             : Dict    : Environment variables added for the process (the password, if given in the spec)
+    log_file        : String  : File the process's output is written to
+    exit_code       : Integer : The process's exit code, None until it has finished
+
+    Class Methods
+    =============
+
+    start()
+
+        Start the process
+
+    poll()
+
+        Return True once the process has finished
+
+    last_line()
+
+        Return the last line the process has written to its log, for progress reports
+
+    summary_line()
+
+        Return the 'Summary:' line the script prints at the end of a run, or None
+    """
+
+    name: str
+    apiurl: str
+    username: str
+    command: list
+    env: dict
+    log_file: str
+    exit_code: int
+
+    def __init__(self, name: str, apiurl: str, username: str, command: list, env: dict, log_file: str):
+        self.name = name
+        self.apiurl = apiurl
+        self.username = username
+        self.command = command
+        self.env = env
+        self.log_file = log_file
+        self.exit_code = None
+        self.process = None
+        self.log = None
+        self.started = None
+        self.elapsed = 0.0
+
+    def subscription(self):
+        # Targets with the same API URL and username share the subscription's limits, so are not run at the same time
+        return self.apiurl, self.username.lower()
+
+    def start(self):
+        env = dict(os.environ)
+        env.update(self.env)
+        env['PYTHONUNBUFFERED'] = '1'
+        self.log = open(self.log_file, 'w')
+        self.started = monotonic()
+        self.process = subprocess.Popen(self.command, stdout=self.log, stderr=subprocess.STDOUT,
+                                        stdin=subprocess.DEVNULL, env=env)
+
+    def poll(self):
+        if self.exit_code is None and self.process is not None and self.process.poll() is not None:
+            self.exit_code = self.process.returncode
+            self.elapsed = monotonic() - self.started
+            self.log.close()
+        return self.exit_code is not None
+
+    def __lines(self, size: int = 4096):
+        try:
+            with open(self.log_file, 'rb') as f:
+                f.seek(max(0, f.seek(0, os.SEEK_END) - size))
+                return f.read().decode('utf-8', errors='replace').splitlines()
+        except OSError:
+            return []
+
+    def last_line(self):
+        lines = [line.strip() for line in self.__lines() if line.strip() != '']
+        return lines[-1] if len(lines) > 0 else ''
+
+    def summary_line(self):
+        for line in reversed(self.__lines(16384)):
+            if line.startswith('Summary:'):
+                return line
+        return None
+
+
+def load_spec(filename: str) -> dict:
+    with open(filename, 'r') as f:
+        text = f.read()
+    if filename.lower().endswith(('.yaml', '.yml')):
+        if yaml is None:
+            raise SpecError('PyYAML is needed to read YAML job specs, install it or use a JSON job spec')
+        spec = yaml.safe_load(text)
+    else:
+        spec = json.loads(text)
+    if not isinstance(spec, dict) or not isinstance(spec.get('targets'), list) or len(spec['targets']) == 0:
+        raise SpecError('%s does not contain a list of targets' % filename)
+    return spec
+
+
+def option_args(key: str, value) -> list:
+    # Turn a spec entry into create_users_from_csv.py options: true for flags, lists for repeated values
+    if value is True:
+        return ['--%s' % key]
+    if value is False or value is None:
+        return []
+    if isinstance(value, list):
+        return ['--%s' % key] + [str(v) for v in value]
+    return ['--%s' % key, str(value)]
+
+
+def build_targets(spec: dict, spec_dir: str, output_dir: str, ask_password=getpass.getpass) -> list:
+    # Make a Target for each entry in the spec's 'targets' list, with the spec's 'defaults' (if any) filled in
+    defaults = spec.get('defaults') or {}
+    targets = []
+    names = set()
+    for i, entry in enumerate(spec['targets']):
+        settings = dict(defaults)
+        settings.update(entry)
+        name = str(settings.get('name') or 'target%s' % (i + 1))
+        if name in names:
+            raise SpecError('Target name %s is used more than once' % name)
+        names.add(name)
+
+        if settings.get('pod'):
+            apiurl = QualysAPI.QualysAPI.podPicker(str(settings['pod']).upper())
+            if apiurl == 'invalid':
+                raise SpecError('Target %s has an unknown pod %s' % (name, settings['pod']))
+            settings['apiurl'] = apiurl
+        if not settings.get('apiurl'):
+            raise SpecError('Target %s needs a pod or an apiurl' % name)
+        if not settings.get('username'):
+            raise SpecError('Target %s needs a username' % name)
+        if not settings.get('filename') and not settings.get('replay'):
+            raise SpecError('Target %s needs a filename' % name)
+
+        for key in INPUT_KEYS:
+            if settings.get(key) and not os.path.isabs(settings[key]):
+                settings[key] = os.path.join(spec_dir, settings[key])
+        if not settings.get('output_file'):
+            settings['output_file'] = os.path.join(output_dir, '%s.txt' % name)
+
+        # The password is passed to the process in its environment rather than on its command line.  A password given
+        # for the target itself overrides a password_env in the defaults
+        env = {}
+        if settings.get('password_env') and entry.get('password') is None:
+            settings['password_env'] = str(settings['password_env'])
+        else:
+            password = settings.get('password')
+            if password is None or password == '-':
+                password = ask_password(prompt='Enter password for %s (%s) : ' % (name, settings['username']))
+            env['QUALYS_FAN_OUT_PASSWORD'] = str(password)
+            settings['password_env'] = 'QUALYS_FAN_OUT_PASSWORD'
+
+        command = [sys.executable, SCRIPT]
+        for key, value in settings.items():
+            if key not in SPECIAL_KEYS:
+                command.extend(option_args(key, value))
+        command.extend(option_args('password_env', settings['password_env']))
+        targets.append(Target(name=name, apiurl=settings['apiurl'], username=str(settings['username']),
+                              command=command, env=env, log_file=os.path.join(output_dir, '%s.log' % name)))
+    return targets
+
+
+def run_targets(targets: list, parallel: int = 0, status_interval: float = 30, poll_interval: float = 0.5):
+    # Run the targets' processes, up to 'parallel' at a time (0 for all of them), printing a progress line for each
+    # running target every 'status_interval' seconds.  Targets sharing a subscription are run one after the other so
+    # they do not compete for its limits, other targets never wait for each other
+    if parallel < 1:
+        parallel = len(targets)
+    pending = list(targets)
+    running = []
+    last_status = monotonic()
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            busy = set(t.subscription() for t in running)
+            for target in list(pending):
+                if len(running) >= parallel:
+                    break
+                if target.subscription() in busy:
+                    continue
+                pending.remove(target)
+                busy.add(target.subscription())
+                target.start()
+                running.append(target)
+                print('%s: started (%s)' % (target.name, target.apiurl))
+
+            sleep(poll_interval)
+            for target in list(running):
+                if target.poll():
+                    running.remove(target)
+                    print('%s: finished in %.1f seconds with exit code %s%s' %
+                          (target.name, target.elapsed, target.exit_code,
+                           ' : %s' % target.summary_line() if target.summary_line() else ''))
+            if monotonic() - last_status >= status_interval:
+                last_status = monotonic()
+                for target in running:
+                    print('%s: %.0f seconds : %s' % (target.name, monotonic() - target.started, target.last_line()))
+    except KeyboardInterrupt:
+        # The processes get the interrupt too, wait for them to record their progress so they can be resumed
+        print('Interrupted, waiting for running targets to stop')
+        for target in running:
+            target.process.wait()
+            target.poll()
+        raise
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run create_users_from_csv.py for several subscriptions in parallel')
+    parser.add_argument('job_spec', help='Job spec (JSON, or YAML if PyYAML is installed) listing the targets')
+    parser.add_argument('-O', '--output_dir', default='.',
+                        help='Directory for the output, journal and log files of each target (default .)')
+    parser.add_argument('--parallel', type=int, default=0,
+                        help='Maximum number of targets run at once, 0 for all of them (default 0)')
+    parser.add_argument('--status_interval', type=float, default=30,
+                        help='Seconds between progress lines for the running targets (default 30)')
+    args = parser.parse_args()
+
+    try:
+        job = load_spec(args.job_spec)
+        os.makedirs(args.output_dir, exist_ok=True)
+        job_targets = build_targets(spec=job, spec_dir=os.path.dirname(os.path.abspath(args.job_spec)),
+                                    output_dir=args.output_dir)
+    except (OSError, ValueError, SpecError) as e:
+        print('ERROR %s' % e)
+        sys.exit(1)
+
+    try:
+        run_targets(job_targets, parallel=args.parallel, status_interval=args.status_interval)
+    except KeyboardInterrupt:
+        sys.exit(130)
+
+    failed = [t for t in job_targets if t.exit_code != 0]
+    print('%s targets succeeded, %s failed%s' % (len(job_targets) - len(failed), len(failed),
+                                               ' : %s' % ', '.join(t.name for t in failed) if failed else ''))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,38 @@
+import os
+import tempfile
+
+# Read once at import, before any threads start, as os.umask() can only be read by setting it.  Files written through
+#   a temporary file get the permissions open() would have given them
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def sync_directory(filename: str):
+    # Make sure a rename into the file's directory is on disk.  Not possible (or needed) where directories cannot be
+    #   opened, as on Windows
+    if hasattr(os, 'O_DIRECTORY'):
+        dirfd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_DIRECTORY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+
+def write_atomic(filename: str, text: str):
+    # Write to a temporary file of its own in the same directory and rename it over the file, so readers (such as a
+    #   monitoring job polling a status file or the Prometheus textfile collector) never see a partial file, and two
+    #   writers of the same file never write into each other's temporary file
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                prefix='.%s.' % os.path.basename(filename), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp, 0o666 & ~UMASK)
+        os.replace(temp, filename)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    sync_directory(filename)
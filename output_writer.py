@@ -0,0 +1,170 @@
+import csv
+import io
+import json
+import os
+import shutil
+import threading
+from time import monotonic
+from file_utils import sync_directory
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, where concurrent runs are not detected
+    fcntl = None
+
+FORMATS = ['text', 'csv', 'jsonl']
+CSV_FIELDS = ['username', 'password', 'email', 'forename', 'surname', 'external_id', 'portal_id']
+
+
+class OutputFileInUse(Exception):
+    pass
+
+
+class OutputWriter:
+    """Writes the credentials of provisioned users to the output file through a single buffered handle.
+
+    Records are written to OUTPUT_FILE.partial, which is flushed to disk every 'flush_every' records or
+    'flush_interval' seconds and renamed over the output file by close(), so a partly written output file never
+    appears.  Existing output is carried over as the old append mode did, and the .partial file left by an interrupted
+    run is picked up again.  Writes from several threads are serialized
+
+    Class Members
+    =============
+
+    filename        : String  : The output file
+    fmt             : String  : 'text' ("* username, password" lines), 'csv' or 'jsonl'
+    on_flush        : Function: Called with the list of keys passed to write() each time the records are safely on
+                                disk, or None
+
+    Class Methods
+    =============
+
+    write(user, key)
+
+        Write the credentials of a QualysUser, 'key' is passed to on_flush once the record is on disk
+
+    append_output(filename)
+
+        Copy the records of another output file in the same format (such as one written by a shard) into this one,
+        returning the number of records copied
+
+    flush()
+
+        Flush the buffered records to disk
+
+    close()
+
+        Flush the buffered records and replace the output file with the completed file
+    """
+
+    filename: str
+    fmt: str
+
+    def __init__(self, filename: str, fmt: str = 'text', flush_every: int = 100, flush_interval: float = 5.0,
+                 on_flush=None):
+        if fmt not in FORMATS:
+            raise ValueError('Unknown output format %s' % fmt)
+        self.filename = filename
+        self.fmt = fmt
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        self.partial = '%s.partial' % filename
+        self.lock = threading.Lock()
+        self.unflushed = []
+        self.last_flush = monotonic()
+
+        # The output holds passwords, so only the owner may read it
+        fd = os.open(self.partial, os.O_RDWR | os.O_CREAT, 0o600)
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                raise OutputFileInUse('%s is being written by another run' % filename)
+        raw = io.open(fd, 'r+b', buffering=1024 * 1024)
+        size = raw.seek(0, os.SEEK_END)
+        if size == 0 and os.path.exists(filename):
+            with open(filename, 'rb') as existing:
+                shutil.copyfileobj(existing, raw)
+        elif size > 0:
+            # Left by an interrupted run, drop anything after the last complete record
+            raw.truncate(self.__last_line_end(raw, size))
+            raw.seek(0, os.SEEK_END)
+        new_file = raw.tell() == 0
+        self.f = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+        self.csvwriter = csv.writer(self.f)
+        if fmt == 'csv' and new_file:
+            self.csvwriter.writerow(CSV_FIELDS)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def __last_line_end(raw, size):
+        # Search backwards from the end of the file for the last newline, a block at a time
+        pos = size
+        while pos > 0:
+            start = max(0, pos - 65536)
+            raw.seek(start)
+            end = raw.read(pos - start).rfind(b'\n')
+            if end >= 0:
+                return start + end + 1
+            pos = start
+        return 0
+
+    def write(self, user, key: str = None):
+        with self.lock:
+            if self.fmt == 'text':
+                self.f.write(f'* {user.username}, {user.password}\n')
+            elif self.fmt == 'csv':
+                self.csvwriter.writerow([user.username, user.password, user.email, user.forename, user.surname,
+                                         user.external_id, user.id])
+            else:
+                self.f.write(json.dumps({'username': user.username, 'password': user.password, 'email': user.email,
+                                         'forename': user.forename, 'surname': user.surname,
+                                         'external_id': user.external_id, 'portal_id': user.id}) + '\n')
+            self.unflushed.append(key)
+            if len(self.unflushed) >= self.flush_every or monotonic() - self.last_flush >= self.flush_interval:
+                self.__flush()
+
+    def append_output(self, filename: str):
+        count = 0
+        with self.lock, open(filename, 'r', encoding='utf-8', newline='') as f:
+            if self.fmt == 'csv':
+                # Each file starts with its own header row
+                f.readline()
+            for line in f:
+                if not line.endswith('\n'):
+                    # An incomplete last record left by an interrupted run
+                    break
+                self.f.write(line)
+                count += 1
+            self.__flush()
+        return count
+
+    def flush(self):
+        with self.lock:
+            self.__flush()
+
+    def __flush(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.last_flush = monotonic()
+        keys = self.unflushed
+        self.unflushed = []
+        if self.on_flush is not None and len(keys) > 0:
+            self.on_flush(keys)
+
+    def close(self):
+        with self.lock:
+            if self.f is None:
+                return
+            self.__flush()
+            self.f.close()
+            self.f = None
+            os.replace(self.partial, self.filename)
+            sync_directory(self.filename)
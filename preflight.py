@@ -0,0 +1,268 @@
+import json
+import re
+from collections import namedtuple
+import api_responses
+import time_zones
+from file_utils import write_atomic
+
+# Severity of a validation issue: rows with errors are not processed, warnings are only reported
+ERROR = 'error'
+WARNING = 'warning'
+
+# Column positions in the input CSV file
+FORENAME, SURNAME, EMAIL, TITLE, PHONE, ADDRESS1, CITY, COUNTRY, BUSINESS_UNIT, TIME_ZONE_CODE, EXTERNAL_ID, \
+    PORTAL_ROLES, SCOPE_TAGS = range(13)
+REQUIRED_COLUMNS = {FORENAME: 'forename', SURNAME: 'surname', EMAIL: 'email', TITLE: 'title', PHONE: 'phone',
+                    ADDRESS1: 'address1', CITY: 'city', COUNTRY: 'country'}
+
+EMAIL_PATTERN = re.compile(r'^[^@\s,;]+@[^@\s,;]+\.[^@\s,;]+$')
+
+# The number of scope tag references held before they are checked against the catalog, so validating a file does not
+#   hold state for every row.  Tags already looked up are answered by the catalog without another call
+TAG_CHECK_ROWS = 1000
+
+ValidationIssue = namedtuple('ValidationIssue', ['line', 'key', 'field', 'value', 'message', 'severity'])
+
+
+def split_list(value: str) -> tuple:
+    # The roles and scope tags columns are ';' separated lists, which may be empty
+    return tuple(sorted(set(v.strip() for v in value.split(';') if v.strip() != '')))
+
+
+class EntitlementCatalog:
+    """The role names and scope tag IDs which exist in the subscription, looked up once per run and cached.  Only the
+    tag IDs actually used are looked up, in batches, so the cost does not depend on the number of tags in the
+    subscription
+
+    Class Members
+    =============
+
+    api             : QualysAPI : The API object used for the lookups
+
+    Class Methods
+    =============
+
+    roles()
+
+        Return a dictionary of the upper-cased name of every role in the subscription to its name, or None if the
+        roles could not be listed
+
+    tags(ids)
+
+        Return the set of the given tag IDs which exist, or None if the tags could not be looked up
+    """
+
+    def __init__(self, api, batch_size: int = 100):
+        self.api = api
+        self.batch_size = batch_size
+        self.__roles = None
+        self.__roles_loaded = False
+        self.__tags = {}
+
+    def __search(self, endpoint: str, criteria: list = None):
+        # Yield each object returned by a /qps/rest/2.0/search call, following the pages of results
+        service_request = {'ServiceRequest': {'preferences': {'limitResults': '1000'}}}
+        if criteria is not None:
+            service_request['ServiceRequest']['filters'] = {'Criteria': criteria}
+        headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+        offset = 0
+        while True:
+            body = self.api.makeCall(url='%s/qps/rest/2.0/search/am/%s' % (self.api.server, endpoint),
+                                     payload=json.dumps(service_request), headers=headers, returnwith='bytes')
+            # A proxy or maintenance page, or an XML error body, is not JSON
+            try:
+                response = None if body is None else json.loads(body)
+            except ValueError as e:
+                raise LookupError('Could not search %s : Malformed response : %s' % (endpoint, e))
+            result = api_responses.decode_json(response)
+            if result.error_code != 0:
+                raise LookupError('Could not search %s : %s' % (endpoint, result.message))
+            service_response = response['ServiceResponse']
+            yield from service_response.get('data', [])
+            if service_response.get('hasMoreRecords') != 'true':
+                return
+            offset += 1000
+            service_request['ServiceRequest']['preferences']['startFromOffset'] = str(offset)
+
+    def roles(self):
+        if not self.__roles_loaded:
+            self.__roles_loaded = True
+            try:
+                self.__roles = {}
+                for role in self.__search('role'):
+                    name = role['Role']['name']
+                    self.__roles[name.upper()] = name
+            except (LookupError, KeyError, TypeError) as e:
+                print('WARNING: Could not list the subscription\'s roles (%s), role names will not be checked' % e)
+                self.__roles = None
+        return self.__roles
+
+    def tags(self, ids):
+        wanted = [i for i in sorted(set(ids)) if i not in self.__tags]
+        try:
+            for start in range(0, len(wanted), self.batch_size):
+                batch = wanted[start:start + self.batch_size]
+                for tag_id in batch:
+                    self.__tags[tag_id] = False
+                for tag in self.__search('tag', [{'field': 'id', 'operator': 'IN', 'value': ','.join(batch)}]):
+                    self.__tags[str(tag['Tag']['id'])] = True
+        except (LookupError, KeyError, TypeError) as e:
+            print('WARNING: Could not look up scope tags (%s), tag IDs will not be checked' % e)
+            for tag_id in wanted:
+                self.__tags.pop(tag_id, None)
+            return None
+        return set(i for i in ids if self.__tags.get(i))
+
+
+class PreflightReport:
+    """The result of validating an input file.  Rows with errors are listed in 'rejected_lines' and left out by
+    accepted()
+
+    Class Members
+    =============
+
+    filename        : String  : The input file which was validated
+    rows            : Integer : The number of user rows in the file
+    issues          : List    : A ValidationIssue (line, key, field, value, message, severity) for each problem found
+    rejected_lines  : Set     : The line numbers of the rows with errors
+
+    Class Methods
+    =============
+
+    add(line, key, field, value, message, severity)
+
+        Record a problem with the row on the given line
+
+    accepted(rows)
+
+        Generator passing through the (line number, row) pairs from read_rows() which have no errors
+
+    as_dict()
+
+        Return the report as a dictionary, ready for JSON
+
+    write(filename)
+
+        Write the report to a JSON file
+    """
+
+    filename: str
+    rows: int
+    issues: list
+    rejected_lines: set
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.rows = 0
+        self.issues = []
+        self.rejected_lines = set()
+
+    def add(self, line: int, key: str, field: str, value: str, message: str, severity: str = ERROR):
+        self.issues.append(ValidationIssue(line, key, field, value, message, severity))
+        if severity == ERROR:
+            self.rejected_lines.add(line)
+
+    def accepted(self, rows):
+        for line_num, row in rows:
+            if line_num not in self.rejected_lines:
+                yield line_num, row
+
+    def as_dict(self):
+        return {'file': self.filename, 'rows': self.rows, 'accepted': self.rows - len(self.rejected_lines),
+                'rejected': len(self.rejected_lines),
+                'errors': sum(1 for i in self.issues if i.severity == ERROR),
+                'warnings': sum(1 for i in self.issues if i.severity == WARNING),
+                'issues': [i._asdict() for i in sorted(self.issues, key=lambda i: i.line)]}
+
+    def write(self, filename: str):
+        write_atomic(filename, json.dumps(self.as_dict(), indent=2) + '\n')
+
+
+def validate_rows(filename: str, rows, columns: int = 13, catalog: EntitlementCatalog = None) -> PreflightReport:
+    # Check every (line number, row) pair from read_rows() without making any changes to the subscription, returning
+    # a PreflightReport.  Every check is made as the rows are read: role names against the catalog's roles (listed
+    # once), and tag IDs in batches of TAG_CHECK_ROWS references, so only the email addresses and external IDs seen
+    # (for the duplicate checks) are kept for the whole file
+    report = PreflightReport(filename)
+    tzs = time_zones.get_time_zones()
+    emails = {}
+    external_ids = {}
+    # (line number, key, tag ID) of the tag references not checked yet
+    unchecked_tags = []
+    check_tags = catalog is not None
+
+    def flush_tags():
+        nonlocal check_tags
+        tags = catalog.tags(set(tag for _, _, tag in unchecked_tags))
+        if tags is None:
+            # The lookup failed and has been reported, so stop checking tags
+            check_tags = False
+        else:
+            for tag_line, tag_key, tag in unchecked_tags:
+                if tag not in tags:
+                    report.add(tag_line, tag_key, 'scope_tags', tag, 'Scope tag does not exist')
+        unchecked_tags.clear()
+
+    for line_num, row in rows:
+        report.rows += 1
+        if len(row) < columns:
+            report.add(line_num, None, 'row', None, 'Row has %s columns, %s expected' % (len(row), columns))
+            continue
+        key = row[EMAIL].strip().lower()
+
+        for column, field in REQUIRED_COLUMNS.items():
+            if row[column].strip() == '':
+                report.add(line_num, key, field, row[column], '%s is required' % field)
+
+        if key != '':
+            if EMAIL_PATTERN.match(row[EMAIL].strip()) is None:
+                report.add(line_num, key, 'email', row[EMAIL], 'Not a valid email address')
+            elif key in emails:
+                report.add(line_num, key, 'email', row[EMAIL],
+                           'Duplicate email address, first used on line %s' % emails[key])
+            else:
+                emails[key] = line_num
+
+        external_id = row[EXTERNAL_ID].strip()
+        if external_id != '':
+            if external_id in external_ids:
+                report.add(line_num, key, 'external_id', external_id,
+                           'Duplicate external ID, first used on line %s' % external_ids[external_id])
+            else:
+                external_ids[external_id] = line_num
+
+        time_zone_code = row[TIME_ZONE_CODE].strip()
+        if time_zone_code != '' and time_zone_code not in tzs:
+            corrected = tzs.lookup(time_zone_code)
+            if corrected is None:
+                report.add(line_num, key, 'time_zone_code', time_zone_code, 'Unknown time zone code')
+            else:
+                report.add(line_num, key, 'time_zone_code', time_zone_code,
+                           'Time zone code will be corrected to %s' % corrected, WARNING)
+
+        country = row[COUNTRY].strip()
+        if country != '' and tzs.country(country) is None:
+            if len(country) == 2:
+                report.add(line_num, key, 'country', country, 'Unknown country code')
+            else:
+                # Country names are passed on as they are, the API may know names which are not in the time zone list
+                report.add(line_num, key, 'country', country, 'Country name not recognised', WARNING)
+
+        row_roles = split_list(row[PORTAL_ROLES])
+        # The roles are listed on first use, later calls return the same (cached) result
+        roles = catalog.roles() if catalog is not None and len(row_roles) > 0 else None
+        if roles is not None:
+            for role in row_roles:
+                if role.upper() not in roles:
+                    report.add(line_num, key, 'portal_roles', role, 'Role does not exist')
+        for tag in split_list(row[SCOPE_TAGS]):
+            if not tag.isdigit():
+                report.add(line_num, key, 'scope_tags', tag, 'Scope tag IDs must be numbers')
+            elif check_tags:
+                unchecked_tags.append((line_num, key, tag))
+        if check_tags and len(unchecked_tags) >= TAG_CHECK_ROWS:
+            flush_tags()
+
+    if check_tags and len(unchecked_tags) > 0:
+        flush_tags()
+    return report
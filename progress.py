@@ -0,0 +1,194 @@
+import json
+import threading
+from collections import deque
+from time import monotonic, time
+from file_utils import write_atomic
+
+# The pipeline stages counted, in the order users pass through them.  'create_failed' users leave the pipeline after
+# the create stage, every other user leaves it after 'update' (whether or not its roles and scopes could be applied)
+STAGES = ['create', 'create_failed', 'sync', 'update', 'update_failed']
+
+
+def format_seconds(seconds) -> str:
+    if seconds is None:
+        return 'unknown'
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '%dh%02dm%02ds' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+    if seconds >= 60:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    return '%ds' % seconds
+
+
+class Progress:
+    """Live progress of a run through the create, sync and update stages: users per second for each stage, and an
+    estimate of the time left from the recent rate at which users leave the pipeline plus any wait the API limits are
+    currently imposing.  The pipeline only increments counters, a background thread prints a progress line every
+    'interval' seconds and writes the status file every 'status_interval' seconds, so reporting never holds up the
+    API calls
+
+    Class Members
+    =============
+
+    total           : Integer : The number of users the run is expected to process, None if not known
+    counts          : Dict    : Stage name (see STAGES) to the number of users which have passed it
+    pending_sync    : Integer : The number of created users waiting to show up in the portal
+    interval        : Float   : Seconds between progress lines, 0 for none
+    status_file     : String  : File the status is written to as JSON, None for none
+    status_interval : Float   : Seconds between writes of the status file
+    window          : Float   : Seconds of recent history the rates are measured over
+    started         : Float   : The time (time.time()) the object was created
+
+    Class Methods
+    =============
+
+    count(stage, n)
+
+        Add n users to a stage's count.  Only called from the thread running the pipeline
+
+    start()
+
+        Start the background thread which prints progress lines and writes the status file
+
+    stop()
+
+        Stop the background thread, writing the status file one last time with 'finished' set
+
+    status()
+
+        Return the current status as a dictionary, ready for JSON
+
+    line(status)
+
+        Return a status as a one line summary for the console
+    """
+
+    total: int
+    counts: dict
+    pending_sync: int
+    interval: float
+    status_file: str
+    status_interval: float
+    window: float
+    started: float
+
+    def __init__(self, scheduler=None, total: int = None, interval: float = 30, status_file: str = None,
+                 status_interval: float = 5, window: float = 60):
+        self.scheduler = scheduler
+        self.total = total
+        self.counts = {stage: 0 for stage in STAGES}
+        self.pending_sync = 0
+        self.interval = interval
+        self.status_file = status_file
+        self.status_interval = status_interval
+        self.window = window
+        self.started = time()
+        self.start_time = monotonic()
+        # (monotonic time, counts, seconds waited for the API limits) taken on each status, for the recent rates
+        self.samples = deque()
+        self.finished = False
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def count(self, stage: str, n: int = 1):
+        # Only the pipeline's own thread updates the counts, the reporting thread just takes copies of them
+        self.counts[stage] += n
+
+    def __sample(self):
+        now = monotonic()
+        counts = dict(self.counts)
+        counts['done'] = counts['create_failed'] + counts['update'] + counts['update_failed']
+        wait_time = self.scheduler.waitTime if self.scheduler is not None else 0.0
+        self.samples.append((now, counts, wait_time))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+        return now, counts, wait_time
+
+    def status(self) -> dict:
+        now, counts, wait_time = self.__sample()
+        elapsed = now - self.start_time
+        then, then_counts, then_wait = self.samples[0]
+        if now - then < 1.0:
+            # Too little history for a recent rate yet, so use the whole run
+            then, then_counts, then_wait = self.start_time, {stage: 0 for stage in counts}, 0.0
+        span = max(now - then, 1e-6)
+        rates = {stage: (counts[stage] - then_counts[stage]) / span for stage in counts}
+
+        blocked_for = self.scheduler.blockedFor() if self.scheduler is not None else 0.0
+        remaining = None if self.total is None else max(0, self.total - counts['done'])
+        if remaining == 0:
+            eta = 0.0
+        elif remaining is not None and rates['done'] > 0:
+            eta = remaining / rates['done'] + blocked_for
+        else:
+            eta = None
+
+        return {'started': self.started, 'updated': time(), 'elapsed': round(elapsed, 3), 'finished': self.finished,
+                'total': self.total, 'done': counts['done'], 'remaining': remaining,
+                'pending_sync': self.pending_sync,
+                'stages': {stage: {'count': counts[stage], 'rate': round(rates[stage], 3),
+                                   'average_rate': round(counts[stage] / max(elapsed, 1e-6), 3)}
+                           for stage in STAGES},
+                'recent_seconds': round(span, 3), 'limit_wait': round(wait_time, 3),
+                'recent_limit_wait': round(wait_time - then_wait, 3),
+                'limit_blocked_for': round(blocked_for, 3),
+                'eta_seconds': None if eta is None else round(eta, 1)}
+
+    @staticmethod
+    def line(status: dict) -> str:
+        stages = status['stages']
+        if status['total'] is None:
+            done = '%s users done' % status['done']
+        else:
+            done = '%s/%s users done' % (status['done'], status['total'])
+        return ('Progress: %s, %.1f created/s, %.1f synced/s, %.1f updated/s, %s waiting to sync, %.1f seconds '
+                'waiting for API limits in the last %s, ETA %s' %
+                (done, stages['create']['rate'], stages['sync']['rate'], stages['update']['rate'],
+                 status['pending_sync'], status['recent_limit_wait'], format_seconds(status['recent_seconds']),
+                 format_seconds(status['eta_seconds'])))
+
+    def __write(self, status: dict):
+        write_atomic(self.status_file, json.dumps(status, indent=2) + '\n')
+
+    def __run(self):
+        ticks = [t for t in [self.interval, self.status_interval if self.status_file else 0] if t > 0]
+        if len(ticks) == 0:
+            return
+        next_line = monotonic() + self.interval
+        next_write = monotonic()
+        while not self.stopping.wait(min(ticks)):
+            now = monotonic()
+            status = None
+            if self.status_file and now >= next_write:
+                status = self.status()
+                next_write = now + self.status_interval
+                try:
+                    self.__write(status)
+                except OSError as e:
+                    print('Could not write status file %s : %s' % (self.status_file, e))
+            if self.interval > 0 and now >= next_line:
+                print(self.line(status if status is not None else self.status()))
+                next_line = now + self.interval
+
+    def start(self):
+        self.__sample()
+        self.thread = threading.Thread(target=self.__run, name='progress', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.finished = True
+        if self.status_file:
+            try:
+                self.__write(self.status())
+            except OSError as e:
+                print('Could not write status file %s : %s' % (self.status_file, e))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
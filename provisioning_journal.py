@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import threading
+from time import time
+
+# The stages recorded for each user, in the order they are reached
+CREATED = 'created'
+SYNCED = 'synced'
+UPDATED = 'updated'
+UPDATE_FAILED = 'update_failed'
+
+
+def unfinished(filename: str) -> int:
+    # The number of rows in a journal which did not get as far as UPDATED, 0 if there is no journal
+    if not os.path.exists(filename):
+        return 0
+    with ProvisioningJournal(filename) as journal:
+        counts = journal.counts()
+    return sum(count for stage, count in counts.items() if stage != UPDATED)
+
+
+def remove(filename: str):
+    # Delete a journal, along with the write-ahead log SQLite keeps beside it
+    for path in [filename, '%s-wal' % filename, '%s-shm' % filename]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class ProvisioningJournal:
+    """Append-only record of how far each input row has got through provisioning, kept in a SQLite database so that an
+    interrupted run can be resumed without repeating work that has already been done.  Every record is committed as
+    it is made, so a crash loses nothing that was recorded before it
+
+    Class Members
+    =============
+
+    filename        : String  : The journal file.  It holds the passwords of created users, so it is only readable by
+                                its owner
+
+    Class Methods
+    =============
+
+    record(key, stage, username, password, portal_id)
+
+        Record that the row identified by 'key' has reached 'stage' (CREATED, SYNCED, UPDATED or UPDATE_FAILED),
+        along with any of the user's login, password and portal ID which are known at that stage
+
+    state(key)
+
+        Return a dictionary of the latest stage, username, password and portal_id recorded for the row, or None if
+        nothing has been recorded
+
+    counts()
+
+        Return a dictionary of the number of rows whose latest stage is each of the stages
+
+    set_value(name, value)
+
+        Record a setting of the run (such as the sync high-water mark it started from) for runs resuming it
+
+    value(name)
+
+        Return a setting recorded with set_value(), or None
+
+    close()
+
+        Close the journal
+    """
+
+    filename: str
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        new_file = not os.path.exists(filename)
+        # Records are made from the main thread, but the connection may be closed from an exit handler
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        if new_file:
+            os.chmod(filename, 0o600)
+        # Write-ahead logging makes each commit an append rather than a rewrite of the database
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS events ('
+                          'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                          'key TEXT NOT NULL, '
+                          'stage TEXT NOT NULL, '
+                          'username TEXT, '
+                          'password TEXT, '
+                          'portal_id TEXT, '
+                          'recorded REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS events_key ON events (key, seq)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)')
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(DISTINCT key) FROM events').fetchone()[0]
+
+    def record(self, key: str, stage: str, username: str = None, password: str = None, portal_id: str = None):
+        with self.lock:
+            self.conn.execute('INSERT INTO events (key, stage, username, password, portal_id, recorded) '
+                              'VALUES (?, ?, ?, ?, ?, ?)', (key, stage, username, password, portal_id, time()))
+            self.conn.commit()
+
+    def state(self, key: str):
+        with self.lock:
+            rows = self.conn.execute('SELECT stage, username, password, portal_id FROM events WHERE key = ? '
+                                     'ORDER BY seq', (key,)).fetchall()
+        if len(rows) == 0:
+            return None
+        # Later records only carry what was learned at that stage, so merge them over the earlier ones
+        state = {'stage': None, 'username': None, 'password': None, 'portal_id': None}
+        for stage, username, password, portal_id in rows:
+            state['stage'] = stage
+            if username is not None:
+                state['username'] = username
+            if password is not None:
+                state['password'] = password
+            if portal_id is not None:
+                state['portal_id'] = portal_id
+        return state
+
+    def counts(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT e.stage, COUNT(*) FROM events e '
+                                     'JOIN (SELECT key, MAX(seq) AS seq FROM events GROUP BY key) latest '
+                                     'ON e.seq = latest.seq GROUP BY e.stage').fetchall()
+        return dict(rows)
+
+    def set_value(self, name: str, value):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)', (name, str(value)))
+            self.conn.commit()
+
+    def value(self, name: str):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM settings WHERE name = ?', (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.commit()
+                self.conn.close()
+                self.conn = None
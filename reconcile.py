@@ -0,0 +1,293 @@
+import json
+from collections import namedtuple
+import api_responses
+from concurrent.futures import ThreadPoolExecutor
+
+# The kinds of change a reconciliation can make
+ADD = 'add'
+UPDATE_PROFILE = 'update_profile'
+CHANGE_ENTITLEMENTS = 'change_entitlements'
+DEACTIVATE = 'deactivate'
+
+# QualysUser attribute, field name in search results and /msp/user.php parameter of each profile field compared
+PROFILE_FIELDS = [('forename', 'firstName', 'first_name'),
+                  ('surname', 'lastName', 'last_name'),
+                  ('email', 'emailAddress', 'email'),
+                  ('external_id', 'externalId', 'external_id'),
+                  ('title', 'title', 'title'),
+                  ('phone', 'phone', 'phone')]
+
+# A change to an existing portal user.  'changes' holds the /msp/user.php parameters and new values for
+# UPDATE_PROFILE, and the 'add_roles', 'remove_roles', 'add_tags' and 'remove_tags' lists for CHANGE_ENTITLEMENTS
+Operation = namedtuple('Operation', ['kind', 'key', 'username', 'portal_id', 'changes'])
+
+
+def collect_values(node, data_tag: str, field: str, values: set):
+    # Add the 'field' of every 'data_tag' entry found anywhere in a search result structure to 'values'.  Role and
+    # tag lists come back as {'list': {'RoleData': [...]}} or {'list': [{'RoleData': {...}}]} depending on the format
+    if isinstance(node, list):
+        for item in node:
+            collect_values(item, data_tag, field, values)
+    elif isinstance(node, dict):
+        for tag, value in node.items():
+            if tag == data_tag:
+                for item in value if isinstance(value, list) else [value]:
+                    if isinstance(item, dict) and item.get(field) is not None:
+                        values.add(str(item[field]))
+            else:
+                collect_values(value, data_tag, field, values)
+    return values
+
+
+def portal_entitlements(portal_user: dict):
+    # The (role names, scope tag IDs) a portal user currently has
+    return collect_values(portal_user.get('roleList'), 'RoleData', 'name', set()), \
+        collect_values(portal_user.get('scopeTags'), 'TagData', 'id', set())
+
+
+def wanted(values) -> set:
+    return set(v.strip() for v in values if v is not None and v.strip() != '')
+
+
+def profile_changes(user, portal_user: dict) -> dict:
+    # The /msp/user.php parameters needed to bring the portal user's profile into line with the CSV row.  Fields the
+    # search results do not include, and fields left empty in the CSV, are not compared
+    changes = {}
+    for attribute, field, param in PROFILE_FIELDS:
+        value = (getattr(user, attribute) or '').strip()
+        if value == '' or field not in portal_user:
+            continue
+        current = (portal_user[field] or '').strip()
+        if field == 'emailAddress':
+            differs = value.lower() != current.lower()
+        else:
+            differs = value != current
+        if differs:
+            changes[param] = value
+    return changes
+
+
+def entitlement_changes(user, portal_user: dict, keep_roles=()) -> dict:
+    # The roles and scope tags to add to and remove from the portal user.  Role names are compared case-insensitively,
+    # and roles in 'keep_roles' (such as the default role given when users are created) are never removed
+    current_roles, current_tags = portal_entitlements(portal_user)
+    roles = wanted(user.portal_role)
+    tags = wanted(user.scope_tags)
+    current_upper = set(r.upper() for r in current_roles)
+    roles_upper = set(r.upper() for r in roles) | set(r.upper() for r in keep_roles)
+    changes = {'add_roles': sorted(r for r in roles if r.upper() not in current_upper),
+               'remove_roles': sorted(r for r in current_roles if r.upper() not in roles_upper),
+               'add_tags': sorted(tags - current_tags),
+               'remove_tags': sorted(current_tags - tags)}
+    if any(len(v) > 0 for v in changes.values()):
+        return changes
+    return {}
+
+
+class ReconcilePlan:
+    """The changes needed to bring the portal into line with the input file
+
+    Class Members
+    =============
+
+    adds            : List    : The QualysUsers for rows with no matching portal user, to be created
+    operations      : List    : An Operation for each change to an existing portal user
+    unchanged       : Integer : The number of rows whose portal user needs no changes
+    unmanaged       : Integer : The number of active portal users with no row in the file which are not deactivated,
+                                because they have no external ID or deactivation was not asked for
+
+    Class Methods
+    =============
+
+    counts()
+
+        Return a dictionary of the number of users for each kind of change
+
+    print_summary(verbose)
+
+        Print the number of changes of each kind (and each change if 'verbose') and an estimate of the API calls
+        needed to make them
+    """
+
+    adds: list
+    operations: list
+    unchanged: int
+    unmanaged: int
+
+    def __init__(self):
+        self.adds = []
+        self.operations = []
+        self.unchanged = 0
+        self.unmanaged = 0
+
+    def counts(self):
+        counts = {ADD: len(self.adds), UPDATE_PROFILE: 0, CHANGE_ENTITLEMENTS: 0, DEACTIVATE: 0,
+                  'unchanged': self.unchanged, 'unmanaged': self.unmanaged}
+        for operation in self.operations:
+            counts[operation.kind] += 1
+        return counts
+
+    def estimated_calls(self, bulk_size: int = 100):
+        # One call per create, profile update and deactivation, and one per bulk update of identical changes, for
+        # both the existing users and the new ones (whose roles and scopes are set after they sync)
+        groups = {}
+        for operation in self.operations:
+            if operation.kind == CHANGE_ENTITLEMENTS:
+                signature = tuple(tuple(operation.changes[k]) for k in sorted(operation.changes))
+                groups[signature] = groups.get(signature, 0) + 1
+        for user in self.adds:
+            signature = (tuple(sorted(wanted(user.portal_role))), tuple(sorted(wanted(user.scope_tags))))
+            groups[signature] = groups.get(signature, 0) + 1
+        counts = self.counts()
+        return counts[ADD] + counts[UPDATE_PROFILE] + counts[DEACTIVATE] + \
+            sum(-(-n // max(1, bulk_size)) for n in groups.values())
+
+    def print_summary(self, verbose: bool = False, bulk_size: int = 100):
+        if verbose:
+            for user in self.adds:
+                print('ADD %s (%s %s)' % (user.email, user.forename, user.surname))
+            for operation in self.operations:
+                details = ', '.join('%s=%s' % (k, v) for k, v in operation.changes.items() if v not in ([], ''))
+                print('%s %s (%s)%s' % (operation.kind.upper(), operation.key, operation.username,
+                                        ' : %s' % details if details != '' else ''))
+        counts = self.counts()
+        print('Reconcile: %s to add, %s profile updates, %s role/scope changes, %s to deactivate, %s unchanged, '
+              '%s portal users not in the file left alone' %
+              (counts[ADD], counts[UPDATE_PROFILE], counts[CHANGE_ENTITLEMENTS], counts[DEACTIVATE],
+               counts['unchanged'], counts['unmanaged']))
+        print('Reconcile: about %s API calls needed, plus searches for new users to sync' %
+              self.estimated_calls(bulk_size=bulk_size))
+
+
+def plan_changes(users, portal_users, keep_roles=(), deactivate_missing: bool = False,
+                 match_names: bool = False, present=()) -> ReconcilePlan:
+    # Compare each user from the input file with the portal users (a PortalUserIndex loaded once), keyed on external
+    # ID and then email address, and work out the smallest set of changes.  Portal users with an external ID but no
+    # row in the file are deactivated if 'deactivate_missing', portal users without one (such as administrators and
+    # API accounts, which are not provisioned from the file) are never touched.  'present' lists the (email address,
+    # external ID) of rows which are in the file but not in 'users' (such as rows which failed validation), whose
+    # portal users are left alone rather than deactivated
+    plan = ReconcilePlan()
+    matched = set()
+    present_emails = set()
+    present_ids = set()
+    for email, external_id in present:
+        if email is not None and email.strip() != '':
+            present_emails.add(email.strip().lower())
+        if external_id is not None and external_id.strip() != '':
+            present_ids.add(external_id.strip())
+    for user in users:
+        if match_names:
+            portal_user = portal_users.find(email=user.email, external_id=user.external_id, forename=user.forename,
+                                            surname=user.surname)
+        else:
+            portal_user = portal_users.find(email=user.email, external_id=user.external_id)
+        if portal_user is None:
+            plan.adds.append(user)
+            continue
+        matched.add(str(portal_user['id']))
+        key = user.email.strip().lower()
+        changed = False
+        changes = profile_changes(user, portal_user)
+        if len(changes) > 0:
+            plan.operations.append(Operation(UPDATE_PROFILE, key, portal_user['username'], str(portal_user['id']),
+                                             changes))
+            changed = True
+        changes = entitlement_changes(user, portal_user, keep_roles=keep_roles)
+        if len(changes) > 0:
+            plan.operations.append(Operation(CHANGE_ENTITLEMENTS, key, portal_user['username'],
+                                             str(portal_user['id']), changes))
+            changed = True
+        if not changed:
+            plan.unchanged += 1
+
+    for portal_user in portal_users.by_username.values():
+        if str(portal_user['id']) in matched or str(portal_user.get('status', '')).upper() == 'INACTIVE':
+            continue
+        if str(portal_user.get('emailAddress') or '').strip().lower() in present_emails or \
+                str(portal_user.get('externalId') or '').strip() in present_ids:
+            plan.unmanaged += 1
+            continue
+        if deactivate_missing and portal_user.get('externalId'):
+            plan.operations.append(Operation(DEACTIVATE, portal_user.get('emailAddress') or portal_user['username'],
+                                             portal_user['username'], str(portal_user['id']), {}))
+        else:
+            plan.unmanaged += 1
+    return plan
+
+
+def entitlement_payload(changes: dict) -> dict:
+    # The /qps/rest/2.0/update/am/user ServiceRequest which makes a CHANGE_ENTITLEMENTS operation's changes
+    user = {}
+    if len(changes['add_tags']) > 0 or len(changes['remove_tags']) > 0:
+        user['scopeTags'] = {}
+        if len(changes['add_tags']) > 0:
+            user['scopeTags']['add'] = {'TagData': [{'id': tag} for tag in changes['add_tags']]}
+        if len(changes['remove_tags']) > 0:
+            user['scopeTags']['remove'] = {'TagData': [{'id': tag} for tag in changes['remove_tags']]}
+    if len(changes['add_roles']) > 0 or len(changes['remove_roles']) > 0:
+        user['roleList'] = {}
+        if len(changes['add_roles']) > 0:
+            user['roleList']['add'] = {'RoleData': [{'name': role} for role in changes['add_roles']]}
+        if len(changes['remove_roles']) > 0:
+            user['roleList']['remove'] = {'RoleData': [{'name': role} for role in changes['remove_roles']]}
+    return {'ServiceRequest': {'data': {'User': user}}}
+
+
+def change_entitlements(api, operations: list):
+    # Make the same CHANGE_ENTITLEMENTS changes to a group of users with one bulk call, falling back to one call per
+    # user for any the bulk call does not report as updated.  Returns a list of (operation, error_code, error_message)
+    headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+    updated = set()
+    if len(operations) > 1:
+        payload = entitlement_payload(operations[0].changes)
+        payload['ServiceRequest']['filters'] = {
+            'Criteria': [{'field': 'id', 'operator': 'IN', 'value': ','.join(o.portal_id for o in operations)}]
+        }
+        result = api_responses.decode_json(api.makeCall(url='%s/qps/rest/2.0/update/am/user' % api.server,
+                                                        payload=json.dumps(payload), headers=headers,
+                                                        returnwith='bytes'))
+        if result.error_code == 0:
+            updated = set(result.ids)
+    results = []
+    for operation in operations:
+        if operation.portal_id in updated:
+            results.append((operation, 0, ''))
+            continue
+        result = api_responses.decode_json(api.makeCall(url='%s/qps/rest/2.0/update/am/user/%s' %
+                                                            (api.server, operation.portal_id),
+                                                        payload=json.dumps(entitlement_payload(operation.changes)),
+                                                        headers=headers, returnwith='bytes'))
+        results.append((operation, result.error_code, result.message if result.error_code != 0 else ''))
+    return results
+
+
+def user_php_change(api, operation: Operation):
+    # Make an UPDATE_PROFILE or DEACTIVATE change through /msp/user.php
+    if operation.kind == DEACTIVATE:
+        payload = {'action': 'deactivate', 'login': operation.username}
+    else:
+        payload = {'action': 'edit', 'login': operation.username}
+        payload.update(operation.changes)
+    result = api_responses.decode_xml(api.makeCall(url='%s/msp/user.php' % api.server, payload=payload,
+                                                   returnwith='bytes'))
+    return operation, result.error_code, result.message if result.error_code != 0 else ''
+
+
+def apply_plan(api, plan: ReconcilePlan, workers: int = 1, bulk_size: int = 100):
+    # Generator making the changes to existing portal users (not the adds, which go through the normal create
+    # pipeline) and yielding (operation, error_code, error_message) for each.  Role and scope changes are grouped by
+    # identical changes into bulk calls of up to 'bulk_size' users, other changes are made 'workers' at a time
+    groups = {}
+    single = []
+    for operation in plan.operations:
+        if operation.kind == CHANGE_ENTITLEMENTS:
+            signature = tuple(tuple(operation.changes[k]) for k in sorted(operation.changes))
+            groups.setdefault(signature, []).append(operation)
+        else:
+            single.append(operation)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        yield from executor.map(lambda operation: user_php_change(api, operation), single)
+    for group in groups.values():
+        for start in range(0, len(group), max(1, bulk_size)):
+            yield from change_entitlements(api, group[start:start + max(1, bulk_size)])
@@ -0,0 +1,85 @@
+import json
+import os
+
+# Fields of each line of a plan file.  'roles' and 'scope_tags' are the entitlements to apply once a created user has
+# synced, which cannot be planned as calls of their own because the user's portal ID is not known until then
+PLAN_FIELDS = ['key', 'method', 'url', 'payload', 'roles', 'scope_tags']
+
+
+class PlanError(Exception):
+    pass
+
+
+class PlanWriter:
+    """Writes the API requests a run would make to a plan file, one compact JSON object per line, through a single
+    buffered handle.  The plan is written to PLAN.tmp and renamed when it is closed, so a partly written plan never
+    appears
+
+    Class Members
+    =============
+
+    filename        : String  : The plan file
+    count           : Integer : The number of requests written
+
+    Class Methods
+    =============
+
+    write(key, method, url, payload, roles, scope_tags)
+
+        Write one request.  'key' identifies the input row the request was made for
+
+    close()
+
+        Flush the plan to disk and rename it into place
+    """
+
+    filename: str
+    count: int
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.count = 0
+        self.temp = '%s.tmp' % filename
+        self.file = open(self.temp, 'w', buffering=1024 * 1024)
+
+    def write(self, key: str, method: str, url: str, payload, roles=None, scope_tags=None):
+        entry = {'key': key, 'method': method, 'url': url, 'payload': payload, 'roles': roles or [],
+                 'scope_tags': scope_tags or []}
+        self.file.write(json.dumps(entry, separators=(',', ':')))
+        self.file.write('\n')
+        self.count += 1
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        os.replace(self.temp, self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Leave no plan behind rather than an incomplete one
+            self.file.close()
+            self.file = None
+            os.remove(self.temp)
+
+
+def read_plan(filename: str):
+    # Yield (line number, request) for each request in a plan file, raising PlanError for lines which are not
+    # requests written by PlanWriter
+    with open(filename, 'r') as f:
+        for line_num, line in enumerate(f, start=1):
+            if line.strip() == '':
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError as e:
+                raise PlanError('%s line %s is not valid JSON : %s' % (filename, line_num, e))
+            if not isinstance(entry, dict) or any(field not in entry for field in PLAN_FIELDS[:4]):
+                raise PlanError('%s line %s is not a planned request' % (filename, line_num))
+            yield line_num, entry
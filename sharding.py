@@ -0,0 +1,118 @@
+import csv
+import os
+import re
+import subprocess
+import sys
+import zlib
+import preflight
+
+SUMMARY_PATTERN = re.compile(r'^Summary: (\d+) users processed, (\d+) API calls, ([\d.]+) seconds waiting for API '
+                             r'limits, ([\d.]+) seconds waiting for sync')
+NOT_UPDATED_PATTERN = re.compile(r'^(\d+) users did not have roles/scopes applied$')
+
+
+def shard_of(key: str, shards: int) -> int:
+    # A stable hash of the row key, so a row is given to the same shard on every run (and a resumed run finds it in the
+    # same shard's journal)
+    return zlib.crc32(key.encode('utf-8')) % shards
+
+
+def shard_file(shard_dir: str, shard: int, suffix: str) -> str:
+    return os.path.join(shard_dir, 'shard-%s.%s' % (shard, suffix))
+
+
+def split_rows(rows, shard_dir: str, shards: int) -> list:
+    # Write the (line number, row) pairs to one CSV file per shard, split by row key (email address), returning the
+    # number of rows given to each shard
+    counts = [0] * shards
+    files = [open(shard_file(shard_dir, i, 'csv'), 'w', newline='') for i in range(shards)]
+    try:
+        writers = [csv.writer(f) for f in files]
+        for _, row in rows:
+            shard = shard_of(row[preflight.EMAIL].strip().lower(), shards)
+            writers[shard].writerow(row)
+            counts[shard] += 1
+    finally:
+        for f in files:
+            f.close()
+    return counts
+
+
+class ShardLog:
+    """What a shard's create_users_from_csv.py process reported in its log
+
+    Class Members
+    =============
+
+    errors          : List    : The ERROR lines
+    not_updated     : List    : The usernames of the users which did not have roles/scopes applied
+    summary         : Tuple   : (users processed, API calls, seconds waiting for API limits, seconds waiting for sync),
+                                None if the shard did not finish
+    """
+
+    errors: list
+    not_updated: list
+    summary: tuple
+
+    def __init__(self, filename: str):
+        self.errors = []
+        self.not_updated = []
+        self.summary = None
+        if not os.path.exists(filename):
+            return
+        with open(filename, 'r', encoding='utf-8', errors='replace') as f:
+            lines = f.read().splitlines()
+        for i, line in enumerate(lines):
+            if line.startswith('ERROR'):
+                self.errors.append(line)
+            match = SUMMARY_PATTERN.match(line)
+            if match is not None:
+                self.summary = (int(match.group(1)), int(match.group(2)), float(match.group(3)),
+                                float(match.group(4)))
+            match = NOT_UPDATED_PATTERN.match(line)
+            if match is not None:
+                self.not_updated.extend(lines[i + 1:i + 1 + int(match.group(1))])
+
+
+def start_shards(shard_dir: str, shards: int, argv: list, password: str, lease_file: str, metrics_file: str = None,
+                 prometheus_file: str = None, status_file: str = None) -> list:
+    # Start a create_users_from_csv.py process for each shard, returning the Popen objects.  Each process is given the
+    # original command line with the shard's own input, output, journal and report files added at the end (where they
+    # take precedence), the shared lease file, and the password in its environment
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'create_users_from_csv.py')
+    env = dict(os.environ)
+    env['QUALYS_SHARD_PASSWORD'] = password
+    env['PYTHONUNBUFFERED'] = '1'
+    processes = []
+    for i in range(shards):
+        command = [sys.executable, script] + argv + [
+            '--filename', shard_file(shard_dir, i, 'csv'),
+            '--output_file', shard_file(shard_dir, i, 'out'),
+            '--journal', shard_file(shard_dir, i, 'journal'),
+            '--validation_report', shard_file(shard_dir, i, 'validation.json'),
+            '--password_env', 'QUALYS_SHARD_PASSWORD',
+            '--rate_lease_file', lease_file,
+            '--skip_entitlement_check',
+            '--shards', '1']
+        if metrics_file is not None and metrics_file != '':
+            command.extend(['--metrics_file', '%s.shard-%s' % (metrics_file, i)])
+        if prometheus_file is not None and prometheus_file != '':
+            command.extend(['--prometheus_file', '%s.shard-%s' % (prometheus_file, i)])
+        if status_file is not None and status_file != '':
+            command.extend(['--status_file', '%s.shard-%s' % (status_file, i)])
+        with open(shard_file(shard_dir, i, 'log'), 'w') as log:
+            processes.append(subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                                              env=env))
+    return processes
+
+
+def wait_for_shards(processes: list) -> list:
+    # Wait for every shard to finish, returning their exit codes.  An interrupt reaches the shards too, so carry on
+    # waiting for them to record their progress before passing it on
+    try:
+        return [p.wait() for p in processes]
+    except KeyboardInterrupt:
+        print('Interrupted, waiting for the shards to stop')
+        for p in processes:
+            p.wait()
+        raise
@@ -0,0 +1,134 @@
+import json
+import os.path
+import re
+import threading
+from collections import namedtuple
+
+# The time zone codes file shipped alongside this module
+DEFAULT_TIME_ZONE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'time_zone_codes.json')
+
+TimeZone = namedtuple('TimeZone', ['code', 'details', 'dst_supported', 'offset'])
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def parse_offset(offset) -> int:
+    # Convert an offset such as '+05:30', '-3', 'GMT -03:30' or a number of minutes into a number of minutes
+    if isinstance(offset, int):
+        return offset
+    match = re.search(r'([+-])?\s*(\d{1,2})(?::?(\d{2}))?', str(offset))
+    if match is None:
+        raise ValueError('Could not parse time zone offset %s' % offset)
+    minutes = int(match.group(2)) * 60 + int(match.group(3) or 0)
+    if match.group(1) == '-':
+        return -minutes
+    return minutes
+
+
+class TimeZoneRegistry:
+    """Indexed, read-only view of the Qualys time zone codes, built once and shared by every QualysUser
+
+    Class Members
+    =============
+
+    codes           : FrozenSet : All valid time zone codes, for constant-time membership checks
+    by_code         : Dict      : Time zone code to TimeZone (code, details, dst_supported, offset in minutes)
+    countries       : Dict      : Two letter country code to country name, taken from the time zone codes (which
+                                  start with the country code) and details
+
+    Class Methods
+    =============
+
+    get(code)
+
+        Return the TimeZone for an exact code, or None if the code is not valid
+
+    lookup(code)
+
+        Return the correctly-cased code for a case-insensitive match of 'code', or None if there is no match
+
+    at_offset(offset)
+
+        Return a list of the TimeZones with the given UTC offset (e.g. '+05:30', '-3' or a number of minutes)
+
+    country(value)
+
+        Return the two letter country code for a case-insensitive country code or name, or None if it is not known
+    """
+
+    codes: frozenset
+    by_code: dict
+    countries: dict
+
+    def __init__(self, tzdata: list):
+        self.by_code = {}
+        self.__by_upper = {}
+        self.__by_offset = {}
+        self.countries = {}
+        self.__by_country_name = {}
+        for tz in tzdata:
+            details = tz['TIME_ZONE_DETAILS']
+            match = re.match(r'\(GMT\s*([^)]*)\)', details)
+            offset = parse_offset(match.group(1)) if match is not None and match.group(1) != '' else 0
+            zone = TimeZone(code=tz['TIME_ZONE_CODE'], details=details, dst_supported=tz['DST_SUPPORTED'] == '1',
+                            offset=offset)
+            self.by_code[zone.code] = zone
+            self.__by_upper[zone.code.upper()] = zone.code
+            self.__by_offset.setdefault(offset, []).append(zone)
+            # 'US-NY', 'UM2' and 'GB' all start with a country code, followed by the country name in the details
+            #   ('(GMT -05:00) United States, New York'), only the odd code such as 'UTC' does not
+            country = re.match(r'([A-Z]{2})(?:-|\d|$)', zone.code)
+            if country is not None:
+                name = re.sub(r'\s*\(.*$', '', re.sub(r'^\([^)]*\)\s*', '', details).split(',')[0]).strip()
+                self.countries.setdefault(country.group(1), name)
+                self.__by_country_name.setdefault(name.upper(), country.group(1))
+        self.codes = frozenset(self.by_code)
+
+    def __contains__(self, code):
+        return code in self.codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def get(self, code):
+        return self.by_code.get(code)
+
+    def lookup(self, code):
+        if code is None:
+            return None
+        return self.__by_upper.get(code.strip().upper())
+
+    def at_offset(self, offset):
+        return list(self.__by_offset.get(parse_offset(offset), []))
+
+    def country(self, value):
+        if value is None:
+            return None
+        value = value.strip().upper()
+        if value in self.countries:
+            return value
+        return self.__by_country_name.get(value)
+
+
+def load_time_zones(path: str = None) -> TimeZoneRegistry:
+    # Load the registry from an explicit file, replacing the shared registry used by get_time_zones()
+    global _registry
+    if path is None:
+        path = DEFAULT_TIME_ZONE_FILE
+    with open(path, 'r') as f:
+        registry = TimeZoneRegistry(json.load(f))
+    with _registry_lock:
+        _registry = registry
+    return registry
+
+
+def get_time_zones() -> TimeZoneRegistry:
+    # Return the shared registry, loading the default file the first time it is needed
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                with open(DEFAULT_TIME_ZONE_FILE, 'r') as f:
+                    _registry = TimeZoneRegistry(json.load(f))
+    return _registry